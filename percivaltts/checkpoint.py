@@ -0,0 +1,220 @@
+'''
+Single-file checkpoint container.
+
+Layout:
+    MAGIC                       8 bytes
+    header size                 uint64, little endian
+    header                      JSON: version, architecture, extras and tensors' locations
+    padding                     up to a multiple of ALIGN
+    extras                      pickled python objects (e.g. [cfg, extras])
+    tensors                     contiguous, each one starting at a multiple of ALIGN
+
+The tensors can be read through a memory map, so that loading a checkpoint
+does not copy the whole weight blob into the memory of the process.
+The file is written in a temporary file first and then renamed, so that an
+interrupted save never leaves a corrupted checkpoint.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+import os
+import glob
+import json
+import threading
+import Queue
+import struct
+import cPickle
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = '\x89PCKPT\r\n'
+VERSION = 1
+ALIGN = 64
+EXT = '.pckpt'
+
+def _aligned(offset):
+    return ((offset+ALIGN-1)//ALIGN)*ALIGN
+
+def save(fpath, tensors, arch=None, extras=None):
+    '''
+    Write the checkpoint fpath.
+    tensors: list of (name, numpy array), or an OrderedDict.
+    arch:    architecture description (e.g. the JSON of a keras model), or None.
+    extras:  any picklable object.
+    '''
+    _write(fpath, tensors, arch, cPickle.dumps(extras, cPickle.HIGHEST_PROTOCOL))
+
+def _write(fpath, tensors, arch, extrasblob):
+    if isinstance(tensors, dict): tensors = tensors.items()
+    tensors = [(name, np.array(value, copy=False, order='C')) for name, value in tensors]
+
+    # The locations are relative to the start of the data, which is aligned
+    offset = len(extrasblob)
+    locations = []
+    for name, value in tensors:
+        offset = _aligned(offset)
+        locations.append({'name':name, 'dtype':value.dtype.str, 'shape':list(value.shape), 'offset':offset})
+        offset += value.nbytes
+    header = json.dumps({'version':VERSION, 'arch':arch, 'extras_size':len(extrasblob), 'tensors':locations})
+
+    ftmp = fpath+'.tmp{}'.format(os.getpid())
+    with open(ftmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write('\0'*(_aligned(f.tell())-f.tell()))
+        datastart = f.tell()
+        f.write(extrasblob)
+        for loc, (_, value) in zip(locations, tensors):
+            f.write('\0'*(datastart+loc['offset']-f.tell()))
+            f.write(value.tostring())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(ftmp, fpath)
+
+def header(fpath):
+    '''
+    Returns the header of the checkpoint fpath and the file position of its data.
+    '''
+    with open(fpath, 'rb') as f:
+        if f.read(len(MAGIC))!=MAGIC: raise ValueError('{} is not a checkpoint file'.format(fpath))
+        size = struct.unpack('<Q', f.read(8))[0]
+        hdr = json.loads(f.read(size))
+        if hdr['version']>VERSION: raise ValueError('{} has been saved with a more recent checkpoint version ({})'.format(fpath, hdr['version']))
+        return hdr, _aligned(f.tell())
+
+def load(fpath, mmap=True):
+    '''
+    Read the checkpoint fpath.
+    Returns (tensors as an OrderedDict, arch, extras).
+    If mmap is True, the tensors are read-only memory maps of the file.
+    '''
+    hdr, datastart = header(fpath)
+
+    with open(fpath, 'rb') as f:
+        f.seek(datastart)
+        extras = cPickle.loads(f.read(hdr['extras_size']))
+
+        tensors = OrderedDict()
+        for loc in hdr['tensors']:
+            dtype = np.dtype(loc['dtype'])
+            shape = tuple(loc['shape'])
+            if mmap and len(shape)>0 and np.prod(shape)>0:
+                tensors[loc['name']] = np.memmap(fpath, dtype=dtype, mode='r', offset=datastart+loc['offset'], shape=shape)
+            else:
+                f.seek(datastart+loc['offset'])
+                tensors[loc['name']] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    return tensors, hdr['arch'], extras
+
+def group(tensors, prefix):
+    '''
+    Returns the list of the tensors whose names start with prefix+'/', in saving order.
+    '''
+    return [value for name, value in tensors.items() if name.startswith(prefix+'/')]
+
+def named(prefix, values):
+    '''
+    Name the list of values as prefix/index, for save(.) and group(.).
+    '''
+    return [(prefix+'/'+str(vi), value) for vi, value in enumerate(values)]
+
+def link(fsrc, fdst):
+    '''
+    Atomically replace fdst by a hard link to fsrc (or a copy if the file system doesn't allow it).
+    '''
+    ftmp = fdst+'.tmp{}'.format(os.getpid())
+    if os.path.lexists(ftmp): os.remove(ftmp)
+    try:
+        os.link(fsrc, ftmp)
+    except OSError:
+        import shutil
+        shutil.copyfile(fsrc, ftmp)
+    os.rename(ftmp, fdst)
+
+def retain(pattern, keep):
+    '''
+    Remove the files matching pattern, except the keep last ones in alphabetical order.
+    '''
+    fpaths = sorted(glob.glob(pattern))
+    for fpath in fpaths[:max(0, len(fpaths)-keep)]: os.remove(fpath)
+
+
+class AsyncWriter:
+    '''
+    Write checkpoints in a background thread, so that the caller (e.g. the
+    training loop) is not blocked by the storage. The tensors and extras are
+    snapshot when submitted. At most maxpending checkpoints wait to be written.
+    With threaded=False, the checkpoints are written immediately instead.
+    An error of the writing thread is raised by the next call to submit or wait.
+    '''
+
+    def __init__(self, threaded=True, maxpending=2):
+        self.threaded = threaded
+        self.error = None
+        if threaded:
+            self.queue = Queue.Queue(maxsize=maxpending)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None: return
+                if self.error is None: self._do(job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _do(self, job):
+        fpath, tensors, arch, extrasblob, after = job
+        _write(fpath, tensors, arch, extrasblob)
+        if not after is None: after()
+
+    def _raise(self):
+        if not self.error is None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fpath, tensors, arch=None, extras=None, after=None):
+        '''
+        Write the checkpoint fpath (see save), then call after() if not None.
+        '''
+        self._raise()
+        if isinstance(tensors, dict): tensors = tensors.items()
+        job = (fpath, [(name, np.array(value, order='C')) for name, value in tensors], arch, cPickle.dumps(extras, cPickle.HIGHEST_PROTOCOL), after)
+        if self.threaded: self.queue.put(job)
+        else:             self._do(job)
+
+    def wait(self):
+        '''
+        Wait for all the submitted checkpoints to be written.
+        '''
+        if self.threaded: self.queue.join()
+        self._raise()
+
+    def close(self):
+        if self.threaded and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
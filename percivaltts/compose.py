@@ -31,6 +31,29 @@ import scipy.signal
 
 import data
 
+def normalise_minmax_data(Y, mins, maxs, nrange=None, zerovarstozeros=True):
+    """
+    Normalise the data Y given its [min,max] values to nrange values ([-1,1] by default)
+    """
+    if nrange is None: nrange=[-1,1]
+
+    mins = mins.copy()
+    maxmindiff = (maxs-mins)
+
+    if zerovarstozeros:                 # Force idx of zero vars to zero values
+        mins[maxmindiff==0.0] = 0.0     # to avoid zero vars idx to -1, e.g.
+
+    maxmindiff[maxmindiff==0.0] = 1.0   # Avoid division by zero in dead dimensions
+
+    Y = (Y - mins)/maxmindiff
+
+    Y -= 0.5  # ... then center it ...
+    Y *= 2.0  # ... and scale it to put it in [-1, 1]. Now DWTFYW
+    Y *= (nrange[1]-nrange[0])/2.0    # 2.0 is the current range
+    Y += 0.5*(nrange[0]+nrange[1])
+
+    return Y
+
 def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange=None, keepidx=None, zerovarstozeros=True, verbose=1):
     """
     Normalisation function for compose.compose(.): Normalise [min,max] values to nrange values ([-1,1] by default)
@@ -59,13 +82,6 @@ def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange
     mins.astype('float32').tofile(os.path.dirname(outfilepath)+'/min4norm.dat')
     maxs.astype('float32').tofile(os.path.dirname(outfilepath)+'/max4norm.dat')
 
-    maxmindiff = (maxs-mins)
-
-    if zerovarstozeros:                 # Force idx of zero vars to zero values
-        mins[maxmindiff==0.0] = 0.0     # to avoid zero vars idx to -1, e.g.
-
-    maxmindiff[maxmindiff==0.0] = 1.0   # Avoid division by zero in dead dimensions
-
     for nf, fid in enumerate(fids):
         finpath = filepath.replace('*',fid)
         Y = np.fromfile(finpath, dtype='float32')
@@ -73,12 +89,7 @@ def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange
 
         Y = Y[:,keepidx]
 
-        Y = (Y - mins)/maxmindiff
-
-        Y -= 0.5  # ... then center it ...
-        Y *= 2.0  # ... and scale it to put it in [-1, 1]. Now DWTFYW
-        Y *= (nrange[1]-nrange[0])/2.0    # 2.0 is the current range
-        Y += 0.5*(nrange[0]+nrange[1])
+        Y = normalise_minmax_data(Y, mins, maxs, nrange=nrange, zerovarstozeros=zerovarstozeros)
 
         print_tty('\r    Write normed data file {}: {}                '.format(nf, fid))
 
@@ -294,8 +294,11 @@ def addstop(X, value=1.0):
 
     return X
 
-def load_inoutset(indir, outdir, outwdir, fid_lst, inouttimesync=True, length=None, lengthmax=None, maskpadtype='padright', cropmode='begend', verbose=0):
-    """Directly load batches of input and corresponding outputs (crop the lengths)."""
+def load_inoutset(indir, outdir, outwdir, fid_lst, inouttimesync=True, length=None, lengthmax=None, maskpadtype='padright', cropmode='begend', outmask=False, verbose=0):
+    """
+    Directly load batches of input and corresponding outputs (crop the lengths).
+    If outmask=True, the mask of the outputs is also returned (see batching).
+    """
 
     X_val = load(indir, fid_lst, verbose=verbose, label='Context labels: ')
     Y_val = load(outdir, fid_lst, verbose=verbose, label='Output features: ')
@@ -313,12 +316,13 @@ def load_inoutset(indir, outdir, outwdir, fid_lst, inouttimesync=True, length=No
 
     # Maskify the validation data according to the batchsize     # TODO rm
     if inouttimesync:
-        [X_val, Y_val, W_val], MX_val = batching([X_val, Y_val, W_val], length=length, lengthmax=lengthmax, padtype=maskpadtype)
+        [X_val, Y_val, W_val], MX_val = batching([X_val, Y_val, W_val], length=length, lengthmax=lengthmax, padtype=maskpadtype, outmask=outmask)
         MY_val = MX_val
     else:
-        [X_val], MX_val = batching([X_val], length=length, lengthmax=lengthmax, padtype=maskpadtype)
-        [Y_val], MY_val = batching([Y_val], length=length, lengthmax=lengthmax, padtype=maskpadtype)
+        [X_val], MX_val = batching([X_val], length=length, lengthmax=lengthmax, padtype=maskpadtype, outmask=outmask)
+        [Y_val], MY_val = batching([Y_val], length=length, lengthmax=lengthmax, padtype=maskpadtype, outmask=outmask)
 
+    if outmask: return X_val, Y_val, W_val, MY_val
     return X_val, Y_val, W_val
 
 
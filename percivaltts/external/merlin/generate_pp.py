@@ -189,3 +189,70 @@ def mcep_postproc_sptk(mcep, fs, dftlen=4096):
     #print(mgcpp.shape)
 
     return mgcpp
+
+
+# In-process equivalent of mcep_postproc_sptk ----------------------------------
+
+_fwcosmats = dict()
+
+def fwcosmat(alpha, order, dftlen):
+    '''
+    Matrix of cos(m*beta(w)), m in [0,order], for the dftlen/2+1 linear
+    frequencies w, beta being the all-pass frequency warping of factor alpha.
+    The log amplitude spectrum of a mel-cepstrum c is thus c.dot(fwcosmat(...)).
+    '''
+    key = (float(alpha), int(order), int(dftlen))
+    if not key in _fwcosmats:
+        w = 2*np.pi*np.arange(dftlen/2+1)/float(dftlen)
+        beta = w + 2*np.arctan(alpha*np.sin(w)/(1.0-alpha*np.cos(w)))
+        C = np.cos(np.outer(np.arange(order+1), beta))
+        _fwcosmats[key] = (C, np.linalg.pinv(C))
+    return _fwcosmats[key]
+
+def spec2mcep_numpy(SPEC, alpha, order):
+    '''
+    Least squares fit of a mel-cepstrum of the given order on the log amplitude spectrum SPEC.
+    '''
+    _, Ci = fwcosmat(alpha, order, (SPEC.shape[1]-1)*2)
+    return np.log(SPEC).dot(Ci)
+
+def mcep2spec_numpy(mcep, alpha, dftlen):
+    '''
+    Amplitude spectrum of the mel-cepstrum mcep.
+    '''
+    C, _ = fwcosmat(alpha, mcep.shape[1]-1, dftlen)
+    return np.exp(mcep.dot(C))
+
+def mcep_postproc_numpy(mcep, fs, dftlen=4096, pf_coef=1.4):
+    '''
+    Same post-processing as mcep_postproc_sptk, without temporary files nor
+    subprocesses. The SPTK chain (freqt|c2acr, mc2b|bcp|merge|b2mc) reduces to
+    weighting the mel-cepstrum and correcting c0 by half the log ratio of the
+    energies before and after weighting.
+    '''
+    C, _ = fwcosmat(bark_alpha(fs), mcep.shape[1]-1, dftlen)
+
+    weight = np.ones(mcep.shape[1])
+    weight[2:] = pf_coef
+
+    # Energy of the power spectrum, i.e. r0 of c2acr, over the full circle
+    wbins = 2*np.ones(C.shape[1])
+    wbins[0] = 1
+    wbins[-1] = 1
+    def r0(c): return np.exp(2*c.dot(C)).dot(wbins)
+
+    mceppp = mcep*weight
+    mceppp[:,0] += 0.5*np.log(r0(mcep)/r0(mceppp))
+
+    return mceppp
+
+def spec_postproc_numpy(SPEC, fs, order=256, pf_coef=1.4):
+    '''
+    Apply the post-processing of mcep_postproc_numpy to the amplitude spectrum SPEC.
+    As with the SPTK tools, SPEC is converted to a mel-cepstrum of the given
+    order and back, so that its details beyond that order are dropped.
+    '''
+    dftlen = (SPEC.shape[1]-1)*2
+    alpha = bark_alpha(fs)
+    mceppp = mcep_postproc_numpy(spec2mcep_numpy(SPEC, alpha, order), fs, dftlen=dftlen, pf_coef=pf_coef)
+    return mcep2spec_numpy(mceppp, alpha, dftlen)
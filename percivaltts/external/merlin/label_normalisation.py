@@ -602,9 +602,12 @@ class HTSLabelNormalisation(LabelNormalisation):
         state_number = 5
 
         lab_binary_vector = numpy.zeros((1, self.dict_size))
-        fid = open(file_name)
-        utt_labels = fid.readlines()
-        fid.close()
+        if isinstance(file_name, list):     # The label lines can also be given directly
+            utt_labels = file_name
+        else:
+            fid = open(file_name)
+            utt_labels = fid.readlines()
+            fid.close()
         current_index = 0
         label_number = len(utt_labels)
         # logger.info('loaded %s, %3d labels' % (file_name, label_number) )
@@ -94,6 +94,17 @@ class MLParameterGenerationFast(object):
 
     def generation(self, features, covariance, static_dimension):
 
+        logger = logging.getLogger('param_generation')
+        logger.debug('starting MLParameterGeneration.generation')
+
+        return self.generation_window(features, covariance, static_dimension)
+
+    def generation_window(self, features, covariance, static_dimension, win_mats=None):
+        '''
+        Solve MLPG over the given frames only. The first and last frames are
+        treated as boundaries (their deltas and delta-deltas are ignored).
+        '''
+
         windows = [
             (0, 0, np.array([1.0])),
             (1, 1, np.array([-0.5, 0.0, 0.5])),
@@ -103,12 +114,10 @@ class MLParameterGenerationFast(object):
 
         frame_number = features.shape[0]
 
-        logger = logging.getLogger('param_generation')
-        logger.debug('starting MLParameterGeneration.generation')
-        
         gen_parameter = np.zeros((frame_number, static_dimension))
 
-        win_mats = self.build_win_mats(windows, frame_number)
+        if win_mats is None:
+            win_mats = self.build_win_mats(windows, frame_number)
         mu_frames = np.zeros((frame_number, 3))
         var_frames = np.zeros((frame_number, 3))
 
@@ -134,4 +143,76 @@ class MLParameterGenerationFast(object):
 
         return  gen_parameter
 
+    def generation_stream(self, feature_blocks, covariance, static_dimension, chunksize=200, lookahead=50, overlap=50):
+        '''
+        Windowed MLPG, which yields the static trajectories chunk by chunk.
+
+        The frames can be given incrementally (feature_blocks is an iterable of
+        [frames x 3*static_dimension] matrices). Each chunk of `chunksize`
+        frames is solved as soon as `lookahead` frames after it are available,
+        using the `overlap` previous frames as left context. Only the frames of
+        the chunk are yielded, so that the time to first frame and the memory
+        used are bounded by chunksize+lookahead+overlap, whatever the length of
+        the utterance.
+
+        covariance is either a vector of 3*static_dimension variances (i.e.
+        time-invariant, as used in PercivalTTS) or a matrix covering all the
+        frames of the utterance.
+
+        The result is an approximation of the full-utterance solution, whose
+        error decreases exponentially with lookahead and overlap. The decay
+        depends on the ratio between the static and dynamic variances: With
+        the usual mean/std normalisation statistics (std of deltas ~10 times
+        smaller than std of statics), the default lookahead=overlap=50 gives a
+        maximum deviation smaller than 1% of the static std (10 frames only
+        gives ~20%). Increase lookahead and overlap if the dynamic variances
+        are much smaller than the static ones.
+        '''
+        if chunksize<1: raise ValueError('chunksize has to be strictly positive')
+
+        covariance = np.asarray(covariance)
 
+        windows = [
+            (0, 0, np.array([1.0])),
+            (1, 1, np.array([-0.5, 0.0, 0.5])),
+            (1, 1, np.array([1.0, -2.0, 1.0])),
+        ]
+        win_mats_cache = dict() # Most of the windows have the same length
+
+        def solve(buf, bufstart, wstart, wend):
+            wlen = wend-wstart
+            if covariance.ndim==1:  cov = np.tile(covariance, (wlen, 1))
+            else:                   cov = covariance[wstart:wend,]
+            if wlen not in win_mats_cache:
+                win_mats_cache[wlen] = self.build_win_mats(windows, wlen)
+            return self.generation_window(buf[wstart-bufstart:wend-bufstart,], cov, static_dimension, win_mats=win_mats_cache[wlen])
+
+        buf = np.zeros((0, 3*static_dimension))
+        bufstart = 0    # Frame index of buf[0]
+        emitted = 0     # Number of frames already yielded
+        for block in feature_blocks:
+            buf = np.vstack((buf, block))
+            while bufstart+buf.shape[0] >= emitted+chunksize+lookahead:
+                wstart = max(bufstart, emitted-overlap)
+                traj = solve(buf, bufstart, wstart, emitted+chunksize+lookahead)
+                yield traj[emitted-wstart:emitted-wstart+chunksize,]
+                emitted += chunksize
+                # Forget the frames that are not needed anymore
+                keepfrom = max(bufstart, emitted-overlap)
+                buf = buf[keepfrom-bufstart:,]
+                bufstart = keepfrom
+
+        # The remaining frames, including the true end of the utterance
+        if bufstart+buf.shape[0] > emitted:
+            wstart = max(bufstart, emitted-overlap)
+            traj = solve(buf, bufstart, wstart, bufstart+buf.shape[0])
+            yield traj[emitted-wstart:,]
+
+    def generation_chunked(self, features, covariance, static_dimension, chunksize=200, lookahead=50, overlap=50):
+        '''
+        Same as generation(.), but using the windowed solution of generation_stream(.)
+        (see generation_stream(.) for the tolerance wrt generation(.)).
+        '''
+        trajs = list(self.generation_stream([features], covariance, static_dimension, chunksize=chunksize, lookahead=lookahead, overlap=overlap))
+        if len(trajs)==0: return np.zeros((0, static_dimension))
+        return np.vstack(trajs)
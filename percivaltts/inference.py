@@ -0,0 +1,118 @@
+'''
+In-memory synthesis from HTS labels, without intermediate files.
+
+The labels are binarised, normalised with the min-max stats of the training
+contexts, predicted, de-normalised (with MLPG if the vocoder uses it) and
+vocoded, all in memory.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import compose
+import modeltts
+
+
+class Synthesizer:
+    '''
+    model:        A loaded ModelTTS.
+    inpath:       Path of the normalised contexts used for training, to find their min-max stats (min4norm.dat and max4norm.dat).
+    outpath:      Path of the output features, to find their mean and std stats (as in ModelTTS.generate_wav).
+    labquestions: Question file used to binarise the labels.
+    '''
+
+    def __init__(self, model, inpath, outpath, labquestions, subphone_feats='full', mlpg_chunksize=None, pp_mcep=False):
+        from external.merlin.label_normalisation import HTSLabelNormalisation
+
+        self.model = model
+        self.vocoder = model.vocoder
+        self.mlpg_chunksize = mlpg_chunksize
+        self.pp_mcep = pp_mcep
+
+        # Parse the question file once for all
+        self.label_normaliser = HTSLabelNormalisation(question_file_name=labquestions, add_frame_features=True, subphone_feats=subphone_feats)
+
+        self.Xmins = np.fromfile(os.path.dirname(inpath)+'/min4norm.dat', dtype='float32')
+        self.Xmaxs = np.fromfile(os.path.dirname(inpath)+'/max4norm.dat', dtype='float32')
+        self.Ymean = np.fromfile(os.path.dirname(outpath)+'/mean4norm.dat', dtype='float32')
+        self.Ystd = np.fromfile(os.path.dirname(outpath)+'/std4norm.dat', dtype='float32')
+
+    def binarise(self, labels=None, fpath=None):
+        '''
+        Binarise HTS labels (state aligned), given either as the list of their lines
+        or as the path fpath of a label file.
+        '''
+        if (labels is None)==(fpath is None): raise ValueError('Either the label lines or the path of a label file has to be given')
+        if not fpath is None:
+            with open(fpath) as f: labels = f.read().splitlines()
+        if not isinstance(labels, list): raise ValueError('The labels have to be given as a list of lines')
+        return self.label_normaliser.load_labels_with_state_alignment(labels)
+
+    def normalise(self, X):
+        return compose.normalise_minmax_data(X, self.Xmins, self.Xmaxs).astype('float32')
+
+    def contexts(self, labels=None, fpath=None):
+        '''
+        Binarise and normalise labels (see binarise).
+        '''
+        return self.normalise(self.binarise(labels, fpath=fpath))
+
+    def predict(self, X):
+        return self.model.predict(np.reshape(X, [1]+[s for s in X.shape]))[0,]
+
+    def synthesis(self, labels=None, predict=None, fpath=None):
+        '''
+        Synthesise labels or the label file fpath (see binarise). predict can replace self.predict
+        (e.g. to batch the predictions of multiple requests).
+        Returns the waveform and an OrderedDict of the duration of each stage [s].
+        '''
+        if predict is None: predict=self.predict
+        timings = OrderedDict()
+        timestart = time.time()
+
+        X = self.binarise(labels, fpath=fpath)
+        timings['binarisation'] = time.time()-timestart
+
+        timestage = time.time()
+        X = self.normalise(X)
+        timings['normalisation'] = time.time()-timestage
+
+        timestage = time.time()
+        CMP = predict(X)
+        timings['prediction'] = time.time()-timestage
+
+        timestage = time.time()
+        CMP = modeltts.denormalise(self.vocoder, CMP, self.Ymean, self.Ystd, mlpg_chunksize=self.mlpg_chunksize)
+        timings['denormalisation'] = time.time()-timestage
+
+        timestage = time.time()
+        wav = self.vocoder.synthesis(CMP, pp_mcep=self.pp_mcep)
+        timings['vocoding'] = time.time()-timestage
+
+        timings['total'] = time.time()-timestart
+        timings['rtf'] = timings['total']/(len(wav)/float(self.vocoder.fs))    # Real-time factor
+
+        return wav, timings
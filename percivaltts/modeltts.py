@@ -27,6 +27,7 @@ from percivaltts import *  # Always include this first to setup a few things
 import sys
 import os
 import cPickle
+import time
 from functools import partial
 
 import numpy as np
@@ -37,11 +38,34 @@ from backend_tensorflow import *
 print_sysinfo_backend()
 
 import tensorflow as tf
+from tensorflow import keras
 
 import networktts
+import checkpoint
 
 import data
 import vocoders
+from vocoders import denormalise, copyfile
+
+
+def length_buckets(maxlen, minlen=100, ratio=1.5):
+    '''
+    Geometric series of lengths from minlen up to maxlen, which limits the padding of a sequence to a factor ratio.
+    '''
+    buckets = [int(minlen)]
+    while buckets[-1]<maxlen: buckets.append(int(np.ceil(buckets[-1]*ratio)))
+    return buckets
+
+
+def quantise_int8(w):
+    '''
+    Symmetric quantisation of w to int8, with one scale per channel of the last axis (the output channels of kernels).
+    Returns the int8 values and the float32 scales (w ~ values*scales).
+    '''
+    absmax = np.max(np.abs(w.reshape((-1, w.shape[-1]))), axis=0)
+    scales = np.where(absmax>0.0, absmax/127.0, 1.0).astype('float32')
+    return np.clip(np.round(w/scales), -127, 127).astype('int8'), scales
+
 
 class ModelTTS:
 
@@ -50,6 +74,12 @@ class ModelTTS:
     vocoder = None
 
     kerasmodel = None
+    kerasmodel_mlpg = None  # Model which outputs denormalised static features (see build_kerasmodel_mlpg)
+    kerasmodel_mlpg_stats = None    # (Ymean, Ystd) kerasmodel_mlpg has been built with
+
+    predict_buckets = None  # Lengths predict pads its inputs to (see set_predict_buckets)
+
+    tflite = None   # Interpreter of the int8 TFLite model loaded along the checkpoint (see export_int8), used by predict if not None
 
     def __init__(self, ctxsize, vocoder, kerasmodel=None):
         # Force additional random inputs is using anyform of GAN
@@ -66,70 +96,474 @@ class ModelTTS:
 
 
     def predict(self, x):
-        return self.kerasmodel.predict(x)
+        if not self.tflite is None: return self.predict_tflite(x)
+        if self.predict_buckets is None: return self.kerasmodel.predict(x)
+
+        # Pad the time axis up to the length of a bucket, so that only a few shapes are ever run
+        # (the last frame is repeated rather than zeroed, since zeros are far from the usual contexts)
+        bucket = self.predict_bucket(x.shape[1])
+        xp = np.pad(x, [(0,0), (0,bucket-x.shape[1])]+[(0,0)]*(len(x.shape)-2), 'edge')
+        return self.kerasmodel.predict(xp)[:,:x.shape[1],]
+
+    def predict_tflite(self, x):
+        '''
+        Prediction of the batch x by the int8 TFLite model (see export_int8).
+        Its input has a fixed length, so each sequence is predicted by windows of this length,
+        which overlap by the receptive field of the model, so that the outputs are
+        the ones of a prediction of the whole sequence.
+        The sequences shorter than a window are predicted by kerasmodel instead.
+        '''
+        inp = self.tflite.get_input_details()[0]
+        out = self.tflite.get_output_details()[0]
+        length = inp['shape'][1]
+        lmargin = self.receptive_field()-1
+        rmargin = lmargin if self.lookahead() is None else min(lmargin, self.lookahead())
+        (inscale, inzero), (outscale, outzero) = inp['quantization'], out['quantization']
+
+        ys = []
+        for X in x:
+            if X.shape[0]<length:
+                ys.append(self.kerasmodel.predict(X[np.newaxis,])[0,])
+                continue
+            Y = np.zeros((X.shape[0], out['shape'][-1]), dtype='float32')
+            pos = 0     # Next frame to predict
+            while pos<X.shape[0]:
+                start = min(max(0, pos-lmargin), X.shape[0]-length)
+                self.tflite.set_tensor(inp['index'], np.clip(np.round(X[np.newaxis,start:start+length,]/inscale+inzero), 0, 255).astype(np.uint8))
+                self.tflite.invoke()
+                end = X.shape[0] if start+length==X.shape[0] else start+length-rmargin
+                Y[pos:end,] = (self.tflite.get_tensor(out['index'])[0,pos-start:end-start,].astype('float32')-outzero)*outscale
+                pos = end
+            ys.append(Y)
+
+        return np.array(ys)
+
+    def predict_bucket(self, length):
+        '''
+        Smallest bucket of predict_buckets which can hold length frames (or a multiple of the biggest one).
+        '''
+        for bucket in self.predict_buckets:
+            if length<=bucket: return bucket
+        return int(np.ceil(length/float(self.predict_buckets[-1])))*self.predict_buckets[-1]
+
+    def set_predict_buckets(self, buckets, warmup=True, nbwarmup=3):
+        '''
+        Make predict pad its inputs to the given lengths (None to disable it).
+        The padded frames are not masked, so the buckets are used only by models
+        whose outputs can't depend on them, i.e. frame-wise or causal models
+        (lookahead()==0). They are disabled for the others (e.g. recurrent or non-causal convolutions).
+        If warmup, each bucket is run once to build and cache everything
+        that depends on the shape (e.g. memory allocation, cuDNN algorithms), and
+        then nbwarmup times to measure the steady-state latency. The difference
+        is the cost that every new length pays without the buckets.
+        Returns a dictionary {bucket: (first call latency, steady-state latency)} [s].
+        '''
+        latencies = dict()
+        if (not buckets is None) and (not self.padding_invariant()):
+            print('    WARNING: the outputs of this model depend on future frames, which would be changed by the padding, so the length buckets are disabled')
+            buckets = None
+        self.predict_buckets = None if buckets is None else sorted(buckets)
+        if (self.predict_buckets is None) or (not warmup): return latencies
+
+        print('    Warm up the prediction for {} length buckets'.format(len(self.predict_buckets)))
+        for bucket in self.predict_buckets:
+            x = np.zeros((1, bucket, self.ctxsize), dtype='float32')
+            timestart = time.time()
+            self.kerasmodel.predict(x)
+            latencyfirst = time.time()-timestart
+            timestart = time.time()
+            for _ in xrange(nbwarmup): self.kerasmodel.predict(x)
+            latencies[bucket] = (latencyfirst, (time.time()-timestart)/nbwarmup)
+            print('        bucket {} frames: first call {:.4f}s, steady-state {:.4f}s'.format(bucket, latencies[bucket][0], latencies[bucket][1]))
+        print('    A new length costs {:.4f}s more on its first call, on average'.format(np.mean([first-steady for first, steady in latencies.values()])))
+
+        return latencies
+
+
+    def receptive_field(self):
+        '''
+        Number of input frames that an output frame depends on, through the convolutions over time.
+        It is an upper bound, since the convolutions are assumed to be all stacked.
+        Returns None if the model has recurrent layers, whose receptive field is unbounded.
+        '''
+        rf = 1
+        for layer in self.kerasmodel.layers:
+            if any([name in layer.__class__.__name__ for name in ['LSTM', 'GRU', 'RNN', 'Bidirectional']]): return None
+            if isinstance(layer, (keras.layers.Conv1D, keras.layers.Conv2D)):   # Time is the first spatial axis
+                rf += (layer.kernel_size[0]-1)*layer.dilation_rate[0]
+        return rf
+
+    def lookahead(self):
+        '''
+        Number of future input frames that an output frame depends on.
+        Returns None if unknown (e.g. non-causal layers).
+        '''
+        return None
+
+    def padding_invariant(self):
+        '''
+        True if the outputs of the model can't depend on frames appended at the end
+        of its input, i.e. frame-wise or causal models (lookahead()==0).
+        '''
+        rf = self.receptive_field()
+        return (not rf is None) and (rf==1 or self.lookahead()==0)
+
+    def predict_chunks(self, x, chunksize=1000, overlap=20, margin=None, rnn_margin=200, batch_size=4):
+        '''
+        Generator predicting the single sequence x [frames x ctxsize] by chunks of chunksize frames,
+        so that the memory used does not depend on the length of x.
+        Each chunk is predicted with margin frames of extra input context on both
+        sides (def. the receptive field of the model, or rnn_margin frames if it
+        has recurrent layers). If the look-ahead of the model is known (see
+        lookahead), the right margin is limited to it. Consecutive chunks overlap by overlap frames, which
+        are crossfaded linearly. The chunks are predicted by batches of batch_size,
+        in which only the chunks of the same length are stacked, so that no chunk
+        is padded (the length buckets of predict are not used, for the same reason).
+        Yields (first frame index, final output frames) in time order.
+        '''
+        T = x.shape[0]
+        if margin is None:
+            rf = self.receptive_field()
+            margin = rnn_margin if rf is None else rf
+        rmargin = margin if self.lookahead() is None else min(margin, self.lookahead())
+
+        nbchunks = max(1, int(np.ceil((T-overlap)/float(chunksize))))
+        outs = [(ci*chunksize, min(T, ci*chunksize+chunksize+overlap)) for ci in xrange(nbchunks)]
+        ramp = (np.arange(overlap)+0.5)/overlap if overlap>0 else np.zeros(0)
+
+        predict = self.kerasmodel.predict if self.tflite is None else self.predict_tflite
+        tail = None     # Faded-out overlap of the previous chunk
+        for bstart in xrange(0, nbchunks, batch_size):
+            bouts = outs[bstart:bstart+batch_size]
+            bins = [(max(0, a-margin), min(T, b+rmargin)) for a, b in bouts]
+            yb = [None]*len(bins)
+            for length in set([e-s for s, e in bins]):   # The first and last chunks are usually shorter
+                bidx = [bi for bi, (s, e) in enumerate(bins) if e-s==length]
+                ys = predict(np.array([x[bins[bi][0]:bins[bi][1],] for bi in bidx]))
+                for yi, bi in enumerate(bidx): yb[bi] = ys[yi]
+
+            for bi, (a, b) in enumerate(bouts):
+                y = yb[bi][a-bins[bi][0]:b-bins[bi][0],].copy()
+                ci = bstart+bi
+                if ci>0 and overlap>0: y[:overlap,] = y[:overlap,]*ramp[:,np.newaxis] + tail
+                if ci<nbchunks-1:
+                    tail = y[-overlap:,]*ramp[::-1,np.newaxis] if overlap>0 else None
+                    y = y[:len(y)-overlap,]
+                yield a, y
+
+    def predict_chunked(self, x, **kwargs):
+        '''
+        Prediction of the single sequence x [frames x ctxsize] by chunks (see predict_chunks).
+        '''
+        return np.vstack([y for _, y in self.predict_chunks(x, **kwargs)])
+
+    def predict_list(self, Xs, batch_size=8):
+        '''
+        Predict a list of input matrices [frames x ctxsize] by batches of batch_size.
+        The samples are sorted by length to limit the padding. The padding is not
+        masked, so the samples of different lengths are stacked in a batch only if
+        padding_invariant(), otherwise only the samples of the same length are.
+        Returns the list of the outputs, in the order of Xs.
+        '''
+        Ys = [None]*len(Xs)
+        order = np.argsort([X.shape[0] for X in Xs], kind='mergesort')
+        for bstart in xrange(0, len(order), batch_size):
+            bidx = order[bstart:bstart+batch_size]
+            if self.padding_invariant(): groups = [bidx]
+            else:                        groups = [[i for i in bidx if Xs[i].shape[0]==length] for length in sorted(set([Xs[i].shape[0] for i in bidx]))]
+            for gidx in groups:
+                maxlen = np.max([Xs[i].shape[0] for i in gidx])
+                Xb = np.zeros((len(gidx), maxlen, Xs[gidx[0]].shape[1]), dtype='float32')
+                for bi, i in enumerate(gidx): Xb[bi,:Xs[i].shape[0],] = Xs[i]
+                Yb = self.predict(Xb)
+                for bi, i in enumerate(gidx): Ys[i] = Yb[bi,:Xs[i].shape[0],]
+
+        return Ys
+
+    def build_kerasmodel_mlpg(self, Ymean, Ystd):
+        '''
+        Build a model sharing the layers of kerasmodel, which also takes a mask
+        of valid frames and outputs the denormalised static features (MLPG in the graph).
+        '''
+        l_mask = keras.layers.Input(shape=(None,), name='input.mask')
+        l_out = networktts.network_mlpg(self.kerasmodel.outputs[0], self.vocoder, Ymean, Ystd, l_mask=l_mask)
+        self.kerasmodel_mlpg = keras.Model(inputs=self.kerasmodel.inputs+[l_mask], outputs=l_out)
+        self.kerasmodel_mlpg_stats = (np.array(Ymean), np.array(Ystd))
+
+    def predict_static(self, Xs, Ymean, Ystd, batch_size=8):
+        '''
+        Predict the denormalised static features of a list of input matrices,
+        running the denormalisation and MLPG in the graph, batch by batch.
+        The samples are sorted by length to limit the padding.
+        The model is rebuilt if Ymean or Ystd differ from the ones it has been built with.
+        '''
+        if (self.kerasmodel_mlpg is None) or (not np.array_equal(self.kerasmodel_mlpg_stats[0], Ymean)) or (not np.array_equal(self.kerasmodel_mlpg_stats[1], Ystd)):
+            self.build_kerasmodel_mlpg(Ymean, Ystd)
+
+        CMPs = [None]*len(Xs)
+        order = np.argsort([X.shape[0] for X in Xs])
+        for bstart in xrange(0, len(order), batch_size):
+            bidx = order[bstart:bstart+batch_size]
+            maxlen = np.max([Xs[i].shape[0] for i in bidx])
+            Xb = np.zeros((len(bidx), maxlen, Xs[bidx[0]].shape[1]), dtype='float32')
+            Mb = np.zeros((len(bidx), maxlen), dtype='float32')
+            for bi, i in enumerate(bidx):
+                Xb[bi,:Xs[i].shape[0],] = Xs[i]
+                Mb[bi,:Xs[i].shape[0]] = 1.0
+            CMPb = self.kerasmodel_mlpg.predict([Xb, Mb], batch_size=len(bidx))
+            for bi, i in enumerate(bidx):
+                CMPs[i] = CMPb[bi,:Xs[i].shape[0],]
+
+        return CMPs
 
 
     def count_params(self):
         return self.kerasmodel.count_params()
 
-    def save(self, fmodel, cfg=None, extras=None, printfn=print, infostr=''):
+    def save(self, fmodel, cfg=None, extras=None, printfn=print, infostr='', writer=None):
+        '''
+        Save the architecture, the weights, cfg and extras in the single file fmodel+checkpoint.EXT (see checkpoint).
+        If writer (a checkpoint.AsyncWriter) is given, the file is written in the background.
+        '''
         if extras is None: extras=dict()
         printfn('    saving parameters in {} ...'.format(fmodel), end='')
         sys.stdout.flush()
 
-        # Do it in two steps, so that the architecture file can be hacked, if need be.
+        # The architecture is stored as JSON, so that it can be hacked, if need be.
         # (e.g. can replace CuDNNLSTM layers by LSTM layers
         # https://machinelearningmastery.com/save-load-keras-deep-learning-models/
-        # Save the architecture
         try:
             model_json = self.kerasmodel.to_json()
-            with open(fmodel+'.arch.json', 'w') as json_file:
-                json_file.write(model_json)
         except TypeError:
-            print('WARNING: CANNOT SAVE ARCHITECTURE FILE in "'+fmodel+'.arch.json". I hope you can recover the architecture directly from the source code.')
-            pass
-
-        # Save the weights, i.e. parameters.
-        self.kerasmodel.save_weights(fmodel+'.weights.h5')
+            print('WARNING: CANNOT SAVE ARCHITECTURE IN "'+fmodel+checkpoint.EXT+'". I hope you can recover the architecture directly from the source code.')
+            model_json = None
 
-        # Save the parameters
-        # tf.keras.models.save_model(self._kerasmodel, fmodel, include_optimizer=False)
-        # Use Model.save instead ?
-        # https://github.com/keras-team/keras/blob/master/tests/test_model_saving.py#L624
+        if writer is None:
+            checkpoint.save(fmodel+checkpoint.EXT, checkpoint.named('model', self.kerasmodel.get_weights()), arch=model_json, extras=[cfg, extras])
+        else:
+            writer.submit(fmodel+checkpoint.EXT, checkpoint.named('model', self.kerasmodel.get_weights()), arch=model_json, extras=[cfg, extras])
 
-        # Save the extra data
-        DATA = [cfg, extras]
-        cPickle.dump(DATA, open(fmodel+'.cfgextras.pkl', 'wb'))
-
-        print(' done '+infostr)
+        print((' done ' if writer is None else ' queued ')+infostr)
         sys.stdout.flush()
 
-    def load(self, fmodel, printfn=print, compile=True):
+    def load(self, fmodel, printfn=print, compile=True, mmap=True):
+        '''
+        Load a model saved by save(.) or export_int8(.), or by the previous versions (.arch.json, .weights.h5 and .cfgextras.pkl files).
+        If mmap is True, the weights are read through a memory map of the checkpoint.
+        The int8 TFLite model written by export_int8 is also loaded, if any.
+        Returns [cfg, extras].
+        '''
         printfn('    reloading parameters from {} ...'.format(fmodel), end='')
         sys.stdout.flush()
 
-        if self.kerasmodel==None:
-            # Load the architecture if it has not been be pre-created
-            json_file = open(fmodel+'.arch.json', 'r')
-            loaded_model_json = json_file.read()
-            json_file.close()
-            self.kerasmodel = tf.keras.models.model_from_json(loaded_model_json, custom_objects={'GaussianNoiseInput': networktts.GaussianNoiseInput})
-
-        # Load the weights, i.e. parameters.
-        self.kerasmodel.load_weights(fmodel+'.weights.h5')
-
-        # Load the parameters
-        # self._kerasmodel = tf.keras.models.load_model(fmodel, compile=compile)
-        # self._kerasmodel.load_weights(fmodel)
-
-        # Load the extra data
-        DATA = cPickle.load(open(fmodel+'.cfgextras.pkl', 'rb'))
+        self.tflite = None
+
+        if os.path.isfile(fmodel+checkpoint.EXT):
+            tensors, model_json, DATA = checkpoint.load(fmodel+checkpoint.EXT, mmap=mmap)
+            # De-quantise the weights exported by export_int8
+            weights = [w if not 'scale/'+name.split('/')[1] in tensors else w.astype('float32')*tensors['scale/'+name.split('/')[1]] for name, w in tensors.items() if name.startswith('model/')]
+            if (not self.kerasmodel is None) and (not model_json is None) and any([isinstance(layer, networktts.FakeQuant) for layer in self.kerasmodel.layers]):
+                print(' (the pre-created architecture has quantised activations (e.g. loaded from export_int8), rebuilding it)', end='')
+                self.kerasmodel = None
+            if (not self.kerasmodel is None) and (not model_json is None) and [tuple(keras.backend.int_shape(w)) for w in self.kerasmodel.weights]!=[w.shape for w in weights]:
+                print(' (the pre-created architecture differs from the saved one (e.g. pruned), rebuilding it)', end='')
+                self.kerasmodel = None
+            if self.kerasmodel==None:
+                # Load the architecture if it has not been be pre-created
+                if model_json is None: raise ValueError('No architecture saved in '+fmodel+checkpoint.EXT)
+                self.kerasmodel = tf.keras.models.model_from_json(model_json, custom_objects=networktts.custom_objects())
+            self.kerasmodel.set_weights(weights)
+            quantisation = DATA[1].get('quantisation', None) if isinstance(DATA[1], dict) else None
+            if (not quantisation is None) and (not quantisation['activations'] is None):
+                self.kerasmodel = networktts.insert_fakequant(self.kerasmodel, quantisation['activations'], num_bits=quantisation['bits'])
+            if os.path.isfile(fmodel+'.tflite'):
+                print(' (with its int8 TFLite model)', end='')
+                self.tflite = tf.contrib.lite.Interpreter(model_path=fmodel+'.tflite')
+                self.tflite.allocate_tensors()
+
+        else:
+            # Legacy checkpoints
+            if self.kerasmodel==None:
+                json_file = open(fmodel+'.arch.json', 'r')
+                loaded_model_json = json_file.read()
+                json_file.close()
+                self.kerasmodel = tf.keras.models.model_from_json(loaded_model_json, custom_objects=networktts.custom_objects())
+
+            # Load the weights, i.e. parameters.
+            self.kerasmodel.load_weights(fmodel+'.weights.h5')
+
+            # Load the extra data
+            DATA = cPickle.load(open(fmodel+'.cfgextras.pkl', 'rb'))
+
+        self.kerasmodel_mlpg = None
 
         print(' done')
         sys.stdout.flush()
+
+        if not self.predict_buckets is None: self.set_predict_buckets(self.predict_buckets)   # Warm up with the new weights
+
         return DATA
 
 
+    def flops(self):
+        '''
+        Number of floating point operations per output frame (see networktts.count_flops).
+        '''
+        return networktts.count_flops(self.kerasmodel)
+
+    def prune(self, ratio=0.5, mode='magnitude', Xs=None):
+        '''
+        Remove structurally the fraction ratio of the units and filters of the
+        Dense and convolutional layers (see networktts.prune_model), ranked by:
+            mode='magnitude':  the L1 norm of their kernels
+            mode='activation': their mean absolute activation over the normalised contexts Xs
+        The model is rebuilt smaller with the remaining weights, so that it has to be
+        fine-tuned with an optimizer (e.g. OptimizerTTS.train).
+        Returns a dictionary with the numbers of parameters, FLOPs per frame
+        and prediction times on Xs (if given) before and after pruning.
+        '''
+        plan = networktts.prunable_layers(self.kerasmodel)
+        scores = None
+        if mode=='activation':
+            if Xs is None: raise ValueError('Pruning by activation needs the contexts Xs')
+            # The activations seen by the consumers of each layer, after its normalisation and non-linearity
+            names = [plan[name][0][-1] if len(plan[name][0])>0 else name for name in plan]
+            probe = keras.Model(inputs=self.kerasmodel.inputs, outputs=[self.kerasmodel.get_layer(name).output for name in names])
+            sums = [0.0]*len(names)
+            nbframes = 0
+            for X in Xs:
+                outs = probe.predict(X[np.newaxis,])
+                if len(names)==1: outs=[outs]
+                for oi, out in enumerate(outs): sums[oi] = sums[oi] + np.sum(np.abs(out.reshape((-1, out.shape[-1]))), axis=0)
+                nbframes += X.shape[0]
+            scores = dict([(name, sums[ni]/nbframes) for ni, name in enumerate(plan)])
+        elif mode!='magnitude':
+            raise ValueError('Unknown pruning mode '+str(mode))
+
+        def timing():
+            if Xs is None: return None
+            self.predict(Xs[0][np.newaxis,])    # Warm up
+            timestart = time.time()
+            for X in Xs: self.predict(X[np.newaxis,])
+            return time.time()-timestart
+
+        sizes = dict([(name, self.kerasmodel.get_layer(name).get_weights()[0].shape[-1]) for name in plan])
+        report = {'params_before':self.count_params(), 'flops_before':self.flops(), 'time_before':timing()}
+        self.kerasmodel, keeps = networktts.prune_model(self.kerasmodel, ratio, scores=scores)
+        self.kerasmodel_mlpg = None
+        report.update({'params_after':self.count_params(), 'flops_after':self.flops(), 'time_after':timing()})
+
+        print('Pruned {} layers by {}: {}'.format(len(keeps), mode, ', '.join(['{} {}->{}'.format(name, sizes[name], len(keeps[name])) for name in sorted(keeps)])))
+        print('    #parameters {} -> {}, FLOPs/frame {} -> {}'.format(report['params_before'], report['params_after'], report['flops_before'], report['flops_after']))
+        if not Xs is None: print('    prediction time {:.3f}s -> {:.3f}s'.format(report['time_before'], report['time_after']))
+
+        return report
+
+    def activation_ranges(self, Xs, layers=None):
+        '''
+        Ranges (min, max) of the outputs of the layers (def. networktts.quantisable_layers) over the input sequences Xs.
+        Returns a dictionary of layer name: (min, max).
+        '''
+        if layers is None: layers=networktts.quantisable_layers(self.kerasmodel)
+        probe = keras.Model(inputs=self.kerasmodel.inputs, outputs=[layer.output for layer in layers])
+        ranges = dict()
+        for X in Xs:
+            outs = probe.predict(X[np.newaxis,])
+            if len(layers)==1: outs=[outs]
+            for layer, out in zip(layers, outs):
+                vmin, vmax = ranges.get(layer.name, (0.0, 0.0))
+                ranges[layer.name] = (min(vmin, float(np.min(out))), max(vmax, float(np.max(out))))
+        return ranges
+
+    def objmeasures_eval(self, Xs, Ys, Ymean, Ystd):
+        '''
+        Objective measures (see Vocoder.objmeasures_add) of the predictions of the
+        normalised contexts Xs against the normalised output features Ys (without MLPG).
+        Returns a dictionary of the mean measures and the prediction time [s].
+        '''
+        self.predict(Xs[0][np.newaxis,])    # Warm up
+        timestart = time.time()
+        CMPs = [self.predict(X[np.newaxis,])[0,] for X in Xs]
+        timepred = time.time()-timestart
+
+        features_err = self.vocoder.features_err
+        self.vocoder.objmeasures_clear()
+        for CMP, Y in zip(CMPs, Ys):
+            self.vocoder.objmeasures_add(denormalise(self.vocoder, CMP, Ymean, Ystd, mlpg_ignore=True), denormalise(self.vocoder, Y, Ymean, Ystd, mlpg_ignore=True))
+        measures = dict([(key, float(np.mean(np.vstack(self.vocoder.features_err[key])))) for key in self.vocoder.features_err])
+        self.vocoder.features_err = features_err
+
+        return measures, timepred
+
+    def export_int8(self, fexport, inpath, fid_lst_calib, outpath=None, fid_lst_eval=None, activations=False, cfg=None, tflite_length=400):
+        '''
+        Export the model in fexport (a checkpoint, see save) with its kernels quantised to int8 per output channel (see quantise_int8).
+        If activations is True, the outputs of the Dense and convolutional layers are also
+        quantised to int8, in the ranges observed on the normalised contexts of fid_lst_calib.
+        The model is also converted to a full-integer TFLite model fexport.tflite
+        (see networktts.tflite_int8), with the ranges of all its layers observed
+        on the same contexts and an input of tflite_length frames.
+        The exported model is loaded by load(fexport) and used by predict, which
+        runs the TFLite model (see predict_tflite). Recurrent layers and noise
+        inputs can't be converted, so those models only get the checkpoint, which
+        is de-quantised and computed in float32 (smaller, but not faster).
+        If outpath is given, the objective measures of the float32 and int8 models
+        are compared on fid_lst_eval (def. fid_lst_calib), along with the speed of the predictions.
+        Returns a dictionary of the measures.
+        '''
+        print('Exporting the model in int8 to {}'.format(fexport))
+        Xs = data.load(inpath, fid_lst_calib, verbose=1)
+
+        # Quantise the kernels, keep the biases and normalisation parameters in float32
+        tensors = []
+        for wi, w in enumerate(self.kerasmodel.get_weights()):
+            if w.ndim>=2:
+                q, scales = quantise_int8(w)
+                tensors.extend([('model/'+str(wi), q), ('scale/'+str(wi), scales)])
+            else:
+                tensors.append(('model/'+str(wi), w))
+
+        ranges = self.activation_ranges(Xs) if activations else None
+        checkpoint.save(fexport+checkpoint.EXT, tensors, arch=self.kerasmodel.to_json(), extras=[cfg, {'quantisation':{'bits':8, 'activations':ranges}}])
+
+        if os.path.isfile(fexport+'.tflite'): os.remove(fexport+'.tflite')
+        if (self.receptive_field() is None) or any([isinstance(layer, networktts.GaussianNoiseInput) for layer in self.kerasmodel.layers]):
+            print('    WARNING: recurrent layers and noise inputs can not run in TFLite, the int8 model will be computed in float32')
+        else:
+            if tflite_length<=2*(self.receptive_field()-1): raise ValueError('tflite_length has to be bigger than twice the receptive field of the model')
+            layers = [layer for layer in self.kerasmodel.layers if (not isinstance(layer, keras.layers.InputLayer)) and len(layer._inbound_nodes)==1]
+            inrange = (min(0.0, np.min([np.min(X) for X in Xs])), max(0.0, np.max([np.max(X) for X in Xs])))
+            with open(fexport+'.tflite', 'wb') as f:
+                f.write(networktts.tflite_int8(self.kerasmodel, self.activation_ranges(Xs, layers=layers), inrange, tflite_length))
+
+        report = dict()
+        report['size_float32'] = int(np.sum([w.nbytes for w in self.kerasmodel.get_weights()]))
+        report['size_int8'] = int(np.sum([w.nbytes for _, w in tensors]))
+        if os.path.isfile(fexport+'.tflite'): report['size_tflite'] = os.path.getsize(fexport+'.tflite')
+        print('    weights: {} bytes in float32, {} bytes in int8'.format(report['size_float32'], report['size_int8']))
+
+        if outpath is None: return report
+
+        # Measure the drift and the speed-up on the evaluation set
+        modelq = ModelTTS(self.ctxsize, self.vocoder)
+        modelq.load(fexport)
+        if fid_lst_eval is None: fid_lst_eval=fid_lst_calib
+        Xs = data.load(inpath, fid_lst_eval, verbose=1)
+        Ys = data.load(outpath, fid_lst_eval, verbose=1)
+        Xs, Ys = data.croplen((Xs, Ys))
+        Ymean = np.fromfile(os.path.dirname(outpath)+'/mean4norm.dat', dtype='float32')
+        Ystd = np.fromfile(os.path.dirname(outpath)+'/std4norm.dat', dtype='float32')
+
+        report['objmeasures_float32'], report['time_float32'] = self.objmeasures_eval(Xs, Ys, Ymean, Ystd)
+        report['objmeasures_int8'], report['time_int8'] = modelq.objmeasures_eval(Xs, Ys, Ymean, Ystd)
+        report['speedup'] = report['time_float32']/report['time_int8']
+
+        for key in sorted(report['objmeasures_float32']):
+            print('    {}: float32 {:.4f}, int8 {:.4f} (drift {:+.4f})'.format(key, report['objmeasures_float32'][key], report['objmeasures_int8'][key], report['objmeasures_int8'][key]-report['objmeasures_float32'][key]))
+        print('    prediction time: float32 {:.3f}s, int8 {:.3f}s (speed-up x{:.2f})'.format(report['time_float32'], report['time_int8'], report['speedup']))
+
+        return report
+
     def generate_cmp(self, inpath, outpath, fid_lst):
 
         if not os.path.isdir(os.path.dirname(outpath)): os.mkdir(os.path.dirname(outpath))
@@ -141,13 +575,54 @@ class ModelTTS:
             CMP.astype('float32').tofile(outpath.replace('*',fid_lst[vi]))
 
 
+    def generate_wav_stream(self, X, outpath, chunksize=100, overlap=20, margin=None, mlpg_lookahead=50, seglen=0.5, pp_mcep=False):
+        '''
+        Generator synthesising the single context sequence X [frames x ctxsize]
+        incrementally: The outputs are predicted by overlapping chunks (see
+        predict_chunks), de-normalised, passed through the windowed MLPG (if
+        the vocoder uses deltas, see MLParameterGenerationFast.generation_stream)
+        and vocoded segment by segment (see Vocoder.synthesis_stream).
+        Yields (waveform chunk, stats), where stats holds the time to first audio 'ttfa' [s],
+        the computation time of the chunk 'time' [s], the duration synthesised so far 'duration' [s]
+        and the real-time factor so far 'rtf'.
+        '''
+        Ymean = np.fromfile(os.path.dirname(outpath)+'/mean4norm.dat', dtype='float32')
+        Ystd = np.fromfile(os.path.dirname(outpath)+'/std4norm.dat', dtype='float32')
+
+        timestart = time.time()
+
+        def cmpblocks():
+            for _, CMP in self.predict_chunks(X, chunksize=chunksize, overlap=overlap, margin=margin, batch_size=1):
+                yield CMP*Ystd + Ymean  # De-normalise
+        blocks = cmpblocks()
+        if (not self.vocoder.mlpg_wins is None) and len(self.vocoder.mlpg_wins)>0:
+            from external.merlin.mlpg_fast import MLParameterGenerationFast as MLParameterGeneration
+            mlpg_algo = MLParameterGeneration(delta_win=self.vocoder.mlpg_wins[0], acc_win=self.vocoder.mlpg_wins[1])
+            blocks = mlpg_algo.generation_stream(blocks, Ystd**2, self.vocoder.featuressizeraw(), chunksize=chunksize, lookahead=mlpg_lookahead, overlap=mlpg_lookahead)
+
+        ttfa = None
+        duration = 0.0
+        timechunk = time.time()
+        for wav in self.vocoder.synthesis_stream(blocks, seglen=seglen, pp_mcep=pp_mcep):
+            timenow = time.time()
+            if ttfa is None: ttfa = timenow-timestart
+            duration += len(wav)/float(self.vocoder.fs)
+            yield wav, {'ttfa':ttfa, 'time':timenow-timechunk, 'duration':duration, 'rtf':(timenow-timestart)/duration if duration>0.0 else np.inf}
+            timechunk = time.time()
+
     def generate_wav(self, inpath, outpath, fid_lst, syndir, do_objmeas=True, do_resynth=True
             , pp_mcep=False
             , pp_spec_pf_coef=-1 # Common value is 1.2
             , pp_spec_extrapfreq=-1
             , pp_f0_smooth=None
+            , mlpg_chunksize=None   # If not None, use windowed MLPG with chunks of mlpg_chunksize frames
+            , mlpg_ingraph=False    # Predict, denormalise and run MLPG in the graph, by batches
+            , batch_size=8          # Number of utterances predicted at once (see predict_list, or predict_static if mlpg_ingraph)
+            , nbproc=1              # Number of processes used for post-processing and synthesis
+            , syn_segmented=False   # Split each utterance at silences and synthesise the segments in parallel (see Vocoder.synthesis_segmented)
+            , resynth_cachedir=None # If not None, directory caching the re-synthesised references
+            , predict_chunksize=None    # If not None, predict by overlapping chunks of predict_chunksize frames (see predict_chunks)
             ):
-        from external.pulsemodel import sigproc as sp
 
         print('Reloading output stats')
         # Assume mean/std normalisation of the output
@@ -160,45 +635,92 @@ class ModelTTS:
             y_test = data.load(outpath, fid_lst, verbose=1)
             X_test, y_test = data.croplen((X_test, y_test))
 
-        def denormalise(CMP, mlpg_ignore=False):
-
-            CMP = CMP*np.tile(Ystd, (CMP.shape[0], 1)) + np.tile(Ymean, (CMP.shape[0], 1)) # De-normalise
-
-            # TODO Should go in the vocoder, but there is Ystd to put as argument ...
-            #      Though, the vocoder is not taking care of the deltas composition during data composition either.
-            if (not self.vocoder.mlpg_wins is None) and len(self.vocoder.mlpg_wins)>0:    # If MLPG is used
-                if mlpg_ignore:
-                    CMP = CMP[:,:self.vocoder.featuressizeraw()]
-                else:
-                    # Apply MLPG
-                    from external.merlin.mlpg_fast import MLParameterGenerationFast as MLParameterGeneration
-                    mlpg_algo = MLParameterGeneration(delta_win=self.vocoder.mlpg_wins[0], acc_win=self.vocoder.mlpg_wins[1])
-                    var = np.tile(Ystd**2,(CMP.shape[0],1)) # Simplification!
-                    CMP = mlpg_algo.generation(CMP, var, self.vocoder.featuressizeraw())
-
-            return CMP
-
         if not os.path.isdir(syndir): os.makedirs(syndir)
         if do_resynth and (not os.path.isdir(syndir+'-resynth')): os.makedirs(syndir+'-resynth')
 
-        for vi in xrange(len(X_test)):
-
-            print('Generating {}/{} fid={} ...'.format(1+vi, len(X_test), fid_lst[vi]))
-            print('    Predict ...')
+        # The re-synthesised references are cached by the hash of the cropped
+        # reference features, the normalisation stats and the vocoder
+        # configuration, so that the same ground truth is vocoded only once
+        if do_resynth and (not resynth_cachedir is None) and (not os.path.isdir(resynth_cachedir)): os.makedirs(resynth_cachedir)
+        resynth_synargs = {'pp_mcep':False}
+        def resynth_hash(y):
+            import hashlib
+            h = hashlib.sha1()
+            h.update(str(y.shape).encode())
+            h.update(np.ascontiguousarray(y).tobytes())
+            h.update(Ymean.tobytes())
+            h.update(Ystd.tobytes())
+            h.update((self.vocoder.config()+str(sorted(resynth_synargs.items()))+str(syn_segmented)).encode())
+            return h.hexdigest()
+        nbresynthcached = 0
+
+        # The model predicts on the main process (batch_size utterances at once), while the post-processing,
+        # synthesis and wav writing run in a pool of nbproc processes.
+        # The workers are new interpreters rather than forks of this process,
+        # since a fork of a process running a TF session can deadlock (see SpawnPool).
+        # Results are collected in submission order, so that the output is deterministic.
+        # With syn_segmented, the utterances are processed one after the other
+        # and the pool is used for the segments of each utterance instead.
+        pool = None
+        segpool = None
+        if nbproc>1:
+            from spawnpool import SpawnPool
+            if syn_segmented: segpool = SpawnPool(nbproc)
+            else:             pool = SpawnPool(nbproc, initializer=vocoders._synthesis_init, initargs=(self.vocoder, Ymean, Ystd, mlpg_chunksize))
+        vocoders._synthesis_init(self.vocoder, Ymean, Ystd, mlpg_chunksize, syn_segmented, segpool)
+        pending = []    # (fid, index in y_test or None, async result or result)
+        def collect(maxpending):
+            while len(pending)>maxpending:
+                fid, refi, res = pending.pop(0)
+                CMP = res.get() if not pool is None else res
+                if not refi is None: self.vocoder.objmeasures_add(CMP, y_test[refi])
+        def submit(fid, refi, job):
+            if pool is None: pending.append((fid, refi, vocoders._synthesis_job(job)))
+            else:            pending.append((fid, refi, pool.apply_async(vocoders._synthesis_job, (job,))))
+            collect(2*nbproc)   # Bound the memory used by the queued jobs
+
+        if mlpg_ingraph:
+            print('    Predict, denormalise and MLPG in the graph ...')
+            CMPs = self.predict_static(X_test, Ymean, Ystd, batch_size=batch_size)
+
+        timestart = time.time()
+        try:
+            for vi in xrange(len(X_test)):
+
+                print('Generating {}/{} fid={} ...'.format(1+vi, len(X_test), fid_lst[vi]))
+
+                if do_resynth:
+                    fresynth = syndir+'-resynth/'+fid_lst[vi]+'.wav'
+                    fcache = None
+                    if not resynth_cachedir is None: fcache = os.path.join(resynth_cachedir, resynth_hash(y_test[vi])+'.wav')
+                    if (not fcache is None) and os.path.isfile(fcache):
+                        copyfile(fcache, fresynth)
+                        nbresynthcached += 1
+                    else:
+                        submit(fid_lst[vi], None, (y_test[vi], fresynth, True, True, resynth_synargs, False, fcache))
+
+                print('    Predict ...')
+                if mlpg_ingraph:
+                    CMP = CMPs[vi]
+                elif not predict_chunksize is None:
+                    CMP = self.predict_chunked(X_test[vi], chunksize=predict_chunksize)
+                else:
+                    if vi%batch_size==0: CMPb = self.predict_list(X_test[vi:vi+batch_size], batch_size=batch_size)
+                    CMP = CMPb[vi%batch_size]
 
-            if do_resynth:
-                CMP = denormalise(y_test[vi], mlpg_ignore=True)
-                resyn = self.vocoder.synthesis(CMP, pp_mcep=False)
-                sp.wavwrite(syndir+'-resynth/'+fid_lst[vi]+'.wav', resyn, self.vocoder.fs, norm_max=True, verbose=1)
+                submit(fid_lst[vi], vi if do_objmeas else None, (CMP, syndir+'/'+fid_lst[vi]+'.wav', not mlpg_ingraph, False, {'pp_mcep':pp_mcep, 'pp_f0_smooth':pp_f0_smooth}, do_objmeas, None))
 
-            CMP = self.predict(np.reshape(X_test[vi],[1]+[s for s in X_test[vi].shape]))
-            CMP = CMP[0,:,:]
+            collect(0)
+        finally:
+            for p in [pool, segpool]:
+                if not p is None:
+                    p.terminate()
+                    p.join()
 
-            CMP = denormalise(CMP)
-            syn = self.vocoder.synthesis(CMP, pp_mcep=pp_mcep, pp_f0_smooth=pp_f0_smooth)
-            sp.wavwrite(syndir+'/'+fid_lst[vi]+'.wav', syn, self.vocoder.fs, norm_max=True, verbose=1)
+        timeelapsed = time.time()-timestart
+        print('    {} utterances in {} ({:.2f} utterances/min, nbproc={})'.format(len(X_test), time2str(timeelapsed), 60.0*len(X_test)/timeelapsed, nbproc))
 
-            if do_objmeas: self.vocoder.objmeasures_add(CMP, y_test[vi])
+        if do_resynth and (not resynth_cachedir is None): print('    {}/{} re-synthesis taken from the cache {}'.format(nbresynthcached, len(X_test), resynth_cachedir))
 
         if do_objmeas: self.vocoder.objmeasures_stats()
 
@@ -124,3 +124,57 @@ class DCNNF0SpecNoiseFeatures(modeltts.ModelTTS):
 
         self.kerasmodel = keras.Model(inputs=l_in, outputs=l_out)
         self.kerasmodel.summary()
+
+
+class DCNNF0SpecNoiseFeaturesCausal(modeltts.ModelTTS):
+    '''
+    Causal variant of DCNNF0SpecNoiseFeatures, for streaming synthesis with a
+    bounded algorithmic latency: The convolutions are causal over time, the
+    F0 branch uses a unidirectional RNN (cfgarch.arch_causal_rnn, 'LSTM' or 'GRU')
+    and the input contexts are shifted by cfgarch.arch_lookahead frames,
+    so that an output frame depends on at most arch_lookahead future frames.
+    '''
+    def __init__(self, ctxsize, vocoder, cfgarch, nameprefix=None):
+        modeltts.ModelTTS.__init__(self, ctxsize, vocoder)
+
+        if nameprefix is None: nameprefix=''
+        self.arch_lookahead = getattr(cfgarch, 'arch_lookahead', 0)
+        rnn = getattr(cfgarch, 'arch_causal_rnn', 'LSTM')
+
+        l_in = kl.Input(shape=(None, ctxsize), name=nameprefix+'input.conditional')
+
+        l_ctx = networktts.TimeShift(shift=self.arch_lookahead)(l_in)
+        for _ in xrange(cfgarch.arch_ctx_nbcnnlayers):
+            l_ctx = networktts.pCNN1D(l_ctx, cfgarch.arch_hiddenwidth, cfgarch.arch_ctx_winlen, causal=True)
+        l_ctx = networktts.pFC(l_ctx, cfgarch.arch_hiddenwidth)
+        l_ctx = networktts.pFC(l_ctx, cfgarch.arch_hiddenwidth)
+
+        # F0
+        l_f0 = l_ctx
+        if rnn=='LSTM':  l_f0 = networktts.pLSTM(l_f0, width=cfgarch.arch_hiddenwidth)
+        elif rnn=='GRU': l_f0 = networktts.pGRU(l_f0, width=cfgarch.arch_hiddenwidth)
+        else:            raise ValueError('Unknown causal RNN type '+str(rnn))
+        l_f0 = kl.Dense(1, activation=None, use_bias=True)(l_f0)
+
+        # Spec
+        l_spec = kl.Dense(vocoder.specsize(), use_bias=True)(l_ctx)   # Projection
+        l_spec = kl.Reshape([-1,vocoder.specsize(), 1])(l_spec) # Add the channels after the spectral dimension
+        for _ in xrange(cfgarch.arch_gen_nbcnnlayers):
+            l_spec = networktts.pCNN2D(l_spec, cfgarch.arch_gen_nbfilters, cfgarch.arch_gen_winlen, cfgarch.arch_spec_freqlen, causal=True)
+        l_spec = networktts.causalpad2D(l_spec, cfgarch.arch_gen_winlen, cfgarch.arch_spec_freqlen)
+        l_spec = kl.Conv2D(1, [cfgarch.arch_gen_winlen,cfgarch.arch_spec_freqlen], strides=(1, 1), padding='valid', dilation_rate=(1, 1), use_bias=True, activation=None, data_format='channels_last')(l_spec)
+        l_spec = kl.Reshape([-1,l_spec.shape[-2]])(l_spec)
+
+        # NM
+        l_nm = l_ctx
+        for _ in xrange(cfgarch.arch_gen_nbcnnlayers/2):
+            l_nm = networktts.pFC(l_nm, cfgarch.arch_hiddenwidth)
+        l_nm = kl.Dense(vocoder.noisesize(), activation='sigmoid')(l_nm)  # TODO Sigmoid is for PML !
+
+        l_out = kl.Concatenate(axis=-1)([l_f0, l_spec, l_nm])
+
+        self.kerasmodel = keras.Model(inputs=l_in, outputs=l_out)
+        self.kerasmodel.summary()
+
+    def lookahead(self):
+        return self.arch_lookahead
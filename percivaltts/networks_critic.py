@@ -41,7 +41,12 @@ class Critic:
     ctxsize = -1
     cfgarch = None
 
-    def __init__(self, vocoder, ctxsize, cfgarch):
+    def __init__(self, vocoder, ctxsize, cfgarch, causal=False):
+        '''
+        causal: Use causal convolutions over time, with the look-ahead of
+                cfgarch.arch_lookahead frames on the contexts (as in
+                modeltts_common.DCNNF0SpecNoiseFeaturesCausal).
+        '''
 
         self.vocoder = vocoder
         self.ctxsize = ctxsize
@@ -64,7 +69,8 @@ class Critic:
             l_spec = kl.Reshape([-1,vocoder.specsize(), 1])(l_spec)
 
             for _ in xrange(cfgarch.arch_gen_nbcnnlayers):
-                l_spec = kl.Conv2D(cfgarch.arch_gen_nbfilters, [cfgarch.arch_gen_winlen,cfgarch.arch_spec_freqlen], strides=(1, 1), padding='same', dilation_rate=(1, 1), data_format='channels_last')(l_spec)
+                if causal: l_spec = causalpad2D(l_spec, cfgarch.arch_gen_winlen, cfgarch.arch_spec_freqlen)
+                l_spec = kl.Conv2D(cfgarch.arch_gen_nbfilters, [cfgarch.arch_gen_winlen,cfgarch.arch_spec_freqlen], strides=(1, 1), padding='valid' if causal else 'same', dilation_rate=(1, 1), data_format='channels_last')(l_spec)
                 l_spec = keras.layers.LeakyReLU(alpha=0.3)(l_spec)
 
             l_spec = kl.Reshape([-1,l_spec.shape[-2]*l_spec.shape[-1]])(l_spec)
@@ -79,8 +85,9 @@ class Critic:
 
         self.input_ctx = keras.layers.Input(shape=(None, self.ctxsize), name='input_ctx')
         l_ctx = self.input_ctx
+        if causal: l_ctx = TimeShift(shift=getattr(cfgarch, 'arch_lookahead', 0))(l_ctx)
         for _ in xrange(cfgarch.arch_ctx_nbcnnlayers):
-            l_ctx = pCNN1D(l_ctx, cfgarch.arch_hiddenwidth, cfgarch.arch_ctx_winlen, bn=bn)
+            l_ctx = pCNN1D(l_ctx, cfgarch.arch_hiddenwidth, cfgarch.arch_ctx_winlen, bn=bn, causal=causal)
         l_ctx = pFC(l_ctx, self.cfgarch.arch_hiddenwidth, bn=bn)
         l_ctx = pFC(l_ctx, self.cfgarch.arch_hiddenwidth, bn=bn)
 
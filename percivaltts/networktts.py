@@ -24,6 +24,7 @@ from __future__ import print_function
 import numpy as np
 from functools import partial
 
+import tensorflow as tf
 from tensorflow import keras
 import tensorflow.keras.layers as kl
 from tensorflow.keras import backend as K
@@ -56,6 +57,31 @@ class GaussianNoiseInput(kl.Layer):
         return config
 
 
+class TimeShift(kl.Layer):
+    '''
+    Shift the input sequence by shift frames towards the past, so that a causal
+    layer on top of it sees shift frames of look-ahead. The last frame is repeated.
+    '''
+
+    def __init__(self, shift=0, **kwargs):
+        super(TimeShift, self).__init__(**kwargs)
+        self.shift = shift
+
+    def call(self, inputs):
+        if self.shift==0: return inputs
+        T = K.shape(inputs)[1]
+        idx = K.minimum(K.arange(T)+self.shift, T-1)
+        return tf.gather(inputs, idx, axis=1)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super(TimeShift,self).get_config()
+        config['shift'] = self.shift
+        return config
+
+
 def pFC(input, width, bn=True, **kwargs):
     output = keras.layers.Dense(width, use_bias=not bn, **kwargs)(input)
     if bn: output=keras.layers.BatchNormalization(axis=-1)(output)
@@ -113,14 +139,22 @@ def pBGRU(input, width, bn=False, **kwargs):
     # l_out = kl.LeakyReLU(alpha=0.3)(l_out) # TODO Makes it unstable. tanh works though
     return output
 
-def pCNN1D(input, nbfilters, winlen, bn=True, **kwargs):
-    output = kl.Conv1D(nbfilters, winlen, strides=1, padding='same', dilation_rate=1, activation=None, use_bias=not bn, **kwargs)(input)
+def pCNN1D(input, nbfilters, winlen, bn=True, causal=False, **kwargs):
+    output = kl.Conv1D(nbfilters, winlen, strides=1, padding='causal' if causal else 'same', dilation_rate=1, activation=None, use_bias=not bn, **kwargs)(input)
     if bn: output=kl.BatchNormalization(axis=-1)(output)
     output = kl.LeakyReLU(alpha=0.3)(output)
     return output
 
-def pCNN2D(input, nbfilters, winlen, freqlen, bn=True, **kwargs):
-    output = kl.Conv2D(nbfilters, [winlen,freqlen], strides=(1, 1), padding='same', dilation_rate=(1, 1), use_bias=not bn, data_format='channels_last')(input)
+def causalpad2D(input, winlen, freqlen):
+    '''
+    Zero-pad [time x freq x channels] input so that a 'valid' Conv2D of kernel
+    [winlen,freqlen] is causal over time and keeps the size of the frequency axis.
+    '''
+    return kl.ZeroPadding2D(padding=((winlen-1, 0), ((freqlen-1)//2, freqlen-1-(freqlen-1)//2)), data_format='channels_last')(input)
+
+def pCNN2D(input, nbfilters, winlen, freqlen, bn=True, causal=False, **kwargs):
+    if causal: input = causalpad2D(input, winlen, freqlen)
+    output = kl.Conv2D(nbfilters, [winlen,freqlen], strides=(1, 1), padding='valid' if causal else 'same', dilation_rate=(1, 1), use_bias=not bn, data_format='channels_last')(input)
     if bn: output = kl.BatchNormalization(axis=-1)(output)
     output = kl.LeakyReLU(alpha=0.3)(output)
     return output
@@ -223,3 +257,329 @@ def network_final(l_in, vocoder, mlpg_wins=None):
     else:                       l_out = keras.layers.Concatenate(axis=-1, name='lo_concatenation')(layers_toconcat)
 
     return l_out
+
+
+def _timeshift(v, s):
+    """Shift a [batch, time, ...] tensor by s frames through time (v[t-s]), with zeros coming in."""
+    if s==0: return v
+    paddings = [[0,0]]*len(v.shape)
+    if s>0:
+        paddings[1] = [s,0]
+        return tf.pad(v, paddings)[:,:-s]
+    else:
+        paddings[1] = [0,-s]
+        return tf.pad(v, paddings)[:,-s:]
+
+class MLPG(kl.Layer):
+    '''
+    Denormalisation and Maximum Likelihood Parameter Generation (MLPG) inside
+    the graph, for whole batches.
+
+    Same assumptions as the NumPy MLPG used in ModelTTS.generate_wav:
+    time-invariant variances (std**2) and the dynamic features of the first
+    and last frames are ignored.
+    The banded system (window length 3, i.e. pentadiagonal precision matrix)
+    is solved by a band Cholesky decomposition through time using tf.scan.
+
+    The input is the normalised output of the network, or a list
+    [output, mask], with mask a [batch, time] matrix of ones for the valid
+    frames and zeros for the padding frames. The padding frames are decoupled
+    from the valid ones, so that each sample gets the same solution as if it
+    was solved alone.
+    The output is the denormalised static features (denormalisation only if
+    mlpg_wins is None or empty).
+    '''
+    def __init__(self, mean, std, mlpg_wins=None, **kwargs):
+        super(MLPG, self).__init__(**kwargs)
+        self.mean = [float(v) for v in mean]
+        self.std = [float(v) for v in std]
+        self.mlpg_wins = [] if mlpg_wins is None else [[float(c) for c in win] for win in mlpg_wins]
+        for win in self.mlpg_wins:
+            if len(win)!=3: raise ValueError('MLPG layer supports only windows of length 3 (got {})'.format(win))
+
+    def call(self, inputs):
+        if isinstance(inputs, (list, tuple)): x, mask = inputs
+        else:                                 x, mask = inputs, None
+
+        x = x*np.array(self.std, dtype=np.float32) + np.array(self.mean, dtype=np.float32)
+
+        if len(self.mlpg_wins)==0: return x
+
+        wins = [[0.0, 1.0, 0.0]]+self.mlpg_wins
+        size = len(self.mean)//len(wins)
+
+        if mask is None: mask = tf.ones_like(x[:,:,0])
+        mask = K.expand_dims(mask, axis=-1)
+        edges = mask*_timeshift(mask, 1)*_timeshift(mask, -1)  # Valid dynamic features
+
+        # Build the right hand side and the 3 bands of the precision matrix
+        b, P0, P1, P2 = 0.0, 0.0, 0.0, 0.0
+        for k, c in enumerate(wins):
+            std = np.array(self.std[k*size:(k+1)*size], dtype=np.float32)
+            tau = tf.ones_like(x[:,:,:size])/(std**2)
+            if k>0: tau *= edges
+            v = tau*x[:,:,k*size:(k+1)*size]
+            for j in [-1, 0, 1]:
+                b += c[j+1]*_timeshift(v, j)
+                P0 += (c[j+1]**2)*_timeshift(tau, j)
+            for j in [-1, 0]:
+                P1 += c[j+1]*c[j+2]*_timeshift(tau, j)
+            P2 += c[0]*c[2]*_timeshift(tau, -1)
+
+        # Time major for tf.scan
+        P0 = tf.transpose(P0, [1,0,2])
+        P1 = tf.transpose(_timeshift(P1, 1), [1,0,2])   # P[t-1,t]
+        P2 = tf.transpose(_timeshift(P2, 2), [1,0,2])   # P[t-2,t]
+        b = tf.transpose(b, [1,0,2])
+
+        # Cholesky decomposition and forward substitution
+        def forward(prev, elems):
+            l0p, l0pp, l1p, yp, ypp = prev[0], prev[1], prev[3], prev[4], prev[5]
+            p0, p1, p2, bt = elems
+            l2 = p2/l0pp
+            l1 = (p1-l2*l1p)/l0p
+            l0 = tf.sqrt(p0-l1**2-l2**2)
+            y = (bt-l1*yp-l2*ypp)/l0
+            return (l0, l0p, l2, l1, y, yp)
+        ones = tf.ones_like(b[0])
+        zeros = tf.zeros_like(b[0])
+        l0, _, l2, l1, y, _ = tf.scan(forward, (P0, P1, P2, b), initializer=(ones, ones, zeros, zeros, zeros, zeros))
+
+        # Backward substitution
+        l1n = tf.concat((l1[1:], tf.zeros_like(l1[:1])), axis=0)    # L[t+1,t]
+        l2n = tf.concat((l2[2:], tf.zeros_like(l2[:2])), axis=0)    # L[t+2,t]
+        def backward(prev, elems):
+            xn, xnn = prev
+            yt, l0t, l1t, l2t = elems
+            return ((yt-l1t*xn-l2t*xnn)/l0t, xn)
+        traj, _ = tf.scan(backward, (tf.reverse(y, [0]), tf.reverse(l0, [0]), tf.reverse(l1n, [0]), tf.reverse(l2n, [0])), initializer=(zeros, zeros))
+        traj = tf.reverse(traj, [0])
+
+        return tf.transpose(traj, [1,0,2])
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list): input_shape = input_shape[0]
+        return (input_shape[0], input_shape[1], len(self.mean)//(1+len(self.mlpg_wins)))
+
+    def get_config(self):
+        config = super(MLPG,self).get_config()
+        config['mean'] = self.mean
+        config['std'] = self.std
+        config['mlpg_wins'] = self.mlpg_wins
+        return config
+
+def network_mlpg(l_in, vocoder, mean, std, l_mask=None):
+    '''
+    Append the denormalisation and MLPG to the output of a network built by network_final.
+    '''
+    mlpg = MLPG(mean, std, mlpg_wins=vocoder.mlpg_wins, name='lo_mlpg')
+    if l_mask is None: return mlpg(l_in)
+    else:              return mlpg([l_in, l_mask])
+
+
+# Quantisation ------------------------------------------------------------------
+
+class FakeQuant(kl.Layer):
+    '''
+    Quantise the input to num_bits in [min,max] (and de-quantise it), to simulate
+    the quantisation of the activations.
+    '''
+
+    def __init__(self, min=-6.0, max=6.0, num_bits=8, **kwargs):
+        super(FakeQuant, self).__init__(**kwargs)
+        self.min = min
+        self.max = max
+        self.num_bits = num_bits
+
+    def call(self, inputs):
+        return tf.fake_quant_with_min_max_args(inputs, min=self.min, max=self.max, num_bits=self.num_bits)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        config = super(FakeQuant,self).get_config()
+        config['min'] = self.min
+        config['max'] = self.max
+        config['num_bits'] = self.num_bits
+        return config
+
+def custom_objects():
+    '''
+    Custom layers necessary to rebuild a model from its configuration.
+    '''
+    return {'GaussianNoiseInput': GaussianNoiseInput, 'MLPG': MLPG, 'TimeShift': TimeShift, 'FakeQuant': FakeQuant}
+
+def quantisable_layers(model):
+    '''
+    Layers whose outputs are quantised by insert_fakequant.
+    '''
+    return [layer for layer in model.layers if isinstance(layer, (kl.Dense, kl.Conv1D, kl.Conv2D)) and len(layer._inbound_nodes)==1]
+
+def insert_fakequant(model, ranges, num_bits=8):
+    '''
+    Rebuild model with a FakeQuant layer after each layer in ranges, a dictionary
+    of layer name: (min, max) of its outputs. The weights are copied.
+    '''
+    config = model.get_config()
+    layers = []
+    for layer in config['layers']:
+        layers.append(layer)
+        if layer['name'] in ranges:
+            name = layer['name']+'_fakequant'
+            layers.append({'name': name, 'class_name': 'FakeQuant',
+                           'config': {'name': name, 'trainable': False, 'min': float(ranges[layer['name']][0]), 'max': float(ranges[layer['name']][1]), 'num_bits': num_bits},
+                           'inbound_nodes': [[[layer['name'], 0, 0, {}]]]})
+
+    # Connect the consumers of the quantised layers to the FakeQuant layers
+    def redirect(inbound):
+        if inbound[0] in ranges: return [inbound[0]+'_fakequant', 0]+list(inbound[2:])
+        return inbound
+    for layer in layers:
+        if layer['class_name']=='FakeQuant': continue
+        layer['inbound_nodes'] = [[redirect(inbound) for inbound in node] for node in layer['inbound_nodes']]
+    config['output_layers'] = [redirect(output) for output in config['output_layers']]
+    config['layers'] = layers
+
+    qmodel = keras.Model.from_config(config, custom_objects=custom_objects())
+    for layer in model.layers:
+        if len(layer.get_weights())>0: qmodel.get_layer(layer.name).set_weights(layer.get_weights())
+    return qmodel
+
+def tflite_int8(model, ranges, inrange, length, num_bits=8):
+    '''
+    Convert model to a full-integer TFLite model, which runs with the integer
+    kernels of TFLite (uint8 inputs, activations and outputs).
+    ranges:  dictionary of layer name: (min, max) of its outputs, as for insert_fakequant
+             (the tensors without range, e.g. inside a layer, use the widest one).
+    inrange: (min, max) of the input values.
+    The input has the fixed shape [1, length, input size].
+    Returns the TFLite flatbuffer.
+    '''
+    config = model.get_config()
+    for layer in config['layers']:
+        if layer['class_name']=='InputLayer': layer['config']['batch_input_shape'] = [1, length]+list(layer['config']['batch_input_shape'][2:])
+    weights = dict([(layer.name, layer.get_weights()) for layer in model.layers if len(layer.get_weights())>0])
+
+    # Rebuild the model in a graph of its own, in inference mode, so that the current graph and session are left untouched
+    graph = tf.Graph()
+    with graph.as_default():
+        sess = tf.Session(graph=graph)
+        with sess.as_default():
+            K.set_learning_phase(0)
+            fmodel = keras.Model.from_config(config, custom_objects=custom_objects())
+            for name in weights: fmodel.get_layer(name).set_weights(weights[name])
+            qmodel = insert_fakequant(fmodel, ranges, num_bits=num_bits)
+            converter = tf.contrib.lite.TocoConverter.from_session(sess, qmodel.inputs, qmodel.outputs)
+            converter.inference_type = tf.contrib.lite.constants.QUANTIZED_UINT8
+            scale = (inrange[1]-inrange[0])/float(2**num_bits-1)
+            converter.quantized_input_stats = {qmodel.inputs[0].op.name: (-inrange[0]/scale, 1.0/scale)}  # real = (quantised-mean)/std
+            converter.default_ranges_stats = (min([r[0] for r in ranges.values()]), max([r[1] for r in ranges.values()]))
+            flatbuffer = converter.convert()
+        sess.close()
+
+    return flatbuffer
+
+
+# Structured pruning ------------------------------------------------------------
+
+# Layers which process the channels (last axis) independently, between a pruned layer and its consumers
+PRUNE_PASSTHROUGH = (kl.BatchNormalization, kl.LeakyReLU, kl.Activation, kl.ZeroPadding1D, kl.ZeroPadding2D, kl.Dropout)
+# Layers which can consume a pruned layer, through the second to last axis of their kernel
+PRUNE_CONSUMERS = (kl.Dense, kl.Conv1D, kl.Conv2D, kl.LSTM, kl.GRU, kl.CuDNNLSTM)
+
+def prunable_layers(model):
+    '''
+    Dense and convolutional layers whose output channels can be removed,
+    i.e. whose outputs reach only PRUNE_CONSUMERS layers through PRUNE_PASSTHROUGH layers.
+    Returns a dictionary of layer name: (passthrough layer names, consumer layer names).
+    '''
+    config = model.get_config()
+    consumers = dict()
+    for layer in config['layers']:
+        for node in layer['inbound_nodes']:
+            for inbound in node:
+                consumers.setdefault(inbound[0], []).append(layer['name'])
+    outputs = [output[0] for output in config['output_layers']]
+
+    def single(name):
+        layer = model.get_layer(name)
+        return len(layer._inbound_nodes)==1 and len(layer._inbound_nodes[0].inbound_layers)==1
+
+    plan = dict()
+    for layer in model.layers:
+        if not isinstance(layer, (kl.Dense, kl.Conv1D, kl.Conv2D)) or len(layer._inbound_nodes)!=1: continue
+        passthrough, terminals, tovisit, valid = [], [], list(consumers.get(layer.name, [])), not layer.name in outputs
+        while valid and len(tovisit)>0:
+            name = tovisit.pop()
+            sublayer = model.get_layer(name)
+            if name in outputs or not single(name):                 valid = False
+            elif isinstance(sublayer, PRUNE_PASSTHROUGH):
+                passthrough.append(name)
+                tovisit.extend(consumers.get(name, []))
+            elif isinstance(sublayer, PRUNE_CONSUMERS):             terminals.append(name)
+            else:                                                   valid = False
+        if valid and len(terminals)>0: plan[layer.name] = (passthrough, terminals)
+    return plan
+
+def prune_model(model, ratio, scores=None):
+    '''
+    Rebuild model without the fraction ratio of the output channels of its
+    prunable layers (see prunable_layers) of lowest scores, and copy the weights of the remaining channels.
+    scores: dictionary of layer name: score of each output channel (def. the L1 norm of the kernel of each channel).
+    Returns the new model and a dictionary of layer name: indices of the kept channels.
+    '''
+    plan = prunable_layers(model)
+
+    keeps = dict()
+    for name in plan:
+        kernel = model.get_layer(name).get_weights()[0]
+        score = scores[name] if (not scores is None) and (name in scores) else np.sum(np.abs(kernel.reshape((-1, kernel.shape[-1]))), axis=0)
+        nbkeep = max(1, int(round(len(score)*(1.0-ratio))))
+        keeps[name] = np.sort(np.argsort(score)[::-1][:nbkeep])
+
+    config = model.get_config()
+    for layer in config['layers']:
+        if layer['name'] in keeps:
+            layer['config']['units' if layer['class_name']=='Dense' else 'filters'] = len(keeps[layer['name']])
+    pmodel = keras.Model.from_config(config, custom_objects=custom_objects())
+
+    outkeeps = dict()   # Channels kept at the output of each layer
+    inkeeps = dict()    # Channels kept at the input of each layer
+    for name in plan:
+        outkeeps[name] = keeps[name]
+        for passname in plan[name][0]: outkeeps[passname] = keeps[name]
+        for consname in plan[name][1]: inkeeps[consname] = keeps[name]
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if len(weights)==0: continue
+        if layer.name in keeps:       weights = [weights[0][...,keeps[layer.name]]] + [w[keeps[layer.name]] for w in weights[1:]]
+        elif layer.name in outkeeps:  weights = [w[outkeeps[layer.name]] for w in weights]
+        if layer.name in inkeeps:     weights[0] = np.take(weights[0], inkeeps[layer.name], axis=-2)
+        pmodel.get_layer(layer.name).set_weights(weights)
+
+    return pmodel, keeps
+
+def count_flops(model):
+    '''
+    Number of floating point operations (multiplications and additions) per output frame of model,
+    for its Dense, convolutional and recurrent layers.
+    '''
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, kl.Bidirectional):
+            inner, nbdirs = layer.forward_layer, 2
+        else:
+            inner, nbdirs = layer, 1
+        nbin = layer.input_shape[-1] if not isinstance(layer.input_shape, list) else None
+        if isinstance(inner, kl.Dense):
+            flops += 2*nbin*inner.units
+        elif isinstance(inner, kl.Conv1D):
+            flops += 2*inner.kernel_size[0]*nbin*inner.filters
+        elif isinstance(inner, kl.Conv2D):
+            flops += 2*inner.kernel_size[0]*inner.kernel_size[1]*nbin*inner.filters*int(layer.output_shape[2])
+        elif isinstance(inner, (kl.LSTM, kl.CuDNNLSTM)):
+            flops += nbdirs*2*4*inner.units*(nbin+inner.units)
+        elif isinstance(inner, kl.GRU):
+            flops += nbdirs*2*3*inner.units*(nbin+inner.units)
+    return flops
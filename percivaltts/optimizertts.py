@@ -46,6 +46,9 @@ from external.pulsemodel import sigproc as sp
 import data
 
 import networktts
+import checkpoint
+import telemetry
+import trials
 
 # if tf_cuda_available():
 #     from pygpu.gpuarray import GpuArrayException   # pragma: no cover
@@ -62,6 +65,11 @@ class OptimizerTTS:
     _model = None # The model whose parameters will be optimised.
     _errtype = 'LSE' # or 'LSE'
 
+    writer = None   # Writer of the checkpoints during training (see checkpoint.AsyncWriter)
+    plotter = None  # Process plotting the costs and samples during training (see PlotWorker)
+    telemetry = None    # Sink of the per-step training metrics (see telemetry.TelemetrySink)
+    validation_full = None  # For each epoch, whether the validation used all the validation files (see cfg.train_validation_every)
+
     def __init__(self, cfgtomerge, model, errtype='LSE', **kwargs):
         self._model = model
         self._errtype = errtype
@@ -77,6 +85,9 @@ class OptimizerTTS:
         cfg.train_nbepochs_scalewdata = True
         cfg.train_cancel_nodecepochs = 50
         cfg.train_cancel_validthresh = 10.0     # Cancel train if valid err is more than N times higher than the initial worst valid err
+        cfg.train_validation_every = 1          # Validate on all the validation files every N epochs, and on a subset of them otherwise
+        cfg.train_validation_subset = None      # Number of validation files of the subset (a fixed random selection), None for all of them
+        cfg.train_validation_full_beforemin = 20 # Always validate on all the files from N epochs before train_min_nbepochs (i.e. when the models start to be saved)
         cfg.train_batch_size = 5                # [potential hyper-parameter]
         cfg.train_batch_padtype = 'randshift'   # See load_inoutset(..., maskpadtype)
         cfg.train_batch_cropmode = 'begendbigger'     # 'begend', 'begendbigger', 'all'
@@ -84,12 +95,23 @@ class OptimizerTTS:
         cfg.train_batch_lengthmax = None        # Maximum duration [frames] of each batch
         cfg.train_nbtrials = 1                  # Just run one training only
         cfg.train_hypers=[]
+        cfg.train_trials_parallel = 1           # Number of trials running at the same time in worker processes (see OptimizerTTS.run_trials)
+        cfg.train_trials_pin = True             # Pin each worker process to its own CPUs
+        cfg.train_halving_rungs = []            # Epochs at which the worst trials are stopped (successive halving, e.g. [10, 30, 90], see OptimizerTTS.train_search)
+        cfg.train_halving_keep = 1.0/3          # Fraction of the trials resumed after each rung
 
         cfg = self.default_options(cfg)
 
         #cfg.train_hypers = [('train_lse_learningrate_log10', -6.0, -2.0), ('adam_beta1', 0.8, 1.0)] # For ADAM
         #cfg.train_hyper = [('train_wgan_critic_learningrate', 0.0001, 0.1), ('train_wgan_critic_adam_beta1', 0.8, 1.0), ('train_wgan_critic_adam_beta2', 0.995, 1.0), ('train_batch_size', 1, 200)] # For ADAM
         cfg.train_log_plot=True
+        cfg.train_log_plot_every = 1            # Plot the costs and samples every N epochs
+        cfg.train_log_plot_async = True         # Plot in a separate process (see PlotWorker)
+        cfg.train_checkpoint_every = 1          # Save the last model and training state every N epochs
+        cfg.train_checkpoint_keep = 0           # Number of past training states kept along the last one (as -trainingstate-E<epoch>)
+        cfg.train_checkpoint_every_batches = None # Also save the training state every N batches, so that an interrupted epoch can be resumed from its next batch (e.g. on preemptible machines)
+        cfg.train_checkpoint_async = True       # Write the checkpoints in a background thread (see checkpoint.AsyncWriter)
+        cfg.train_telemetry = None              # Record the metrics of each training step in <params_savefile>-telemetry.<format>: None, 'jsonl' or 'csv' (see telemetry.TelemetrySink)
         # ... add/overwrite configuration from cfgtomerge ...
         if not cfgtomerge is None: cfg.merge(cfgtomerge)
         # ... and add/overwrite specific configuration from the generic arguments
@@ -100,30 +122,40 @@ class OptimizerTTS:
         print('Training configuration')
         self.cfg.print_content()
 
-    def saveTrainingState(self, fstate, extras=None, printfn=print):
-        # TODO TODO TODO FIX
+    def saveTrainingState(self, fstate, extras=None, printfn=print, writer=None, after=None):
+        '''
+        Save the training state (see trainingStateWeights) in the single file fstate+checkpoint.EXT.
+        If writer (a checkpoint.AsyncWriter) is given, the file is written in the background.
+        after() is called once the file is written, if not None.
+        '''
         if extras is None: extras=dict()
         printfn('    saving training state in {} ...'.format(fstate), end='')
         sys.stdout.flush()
 
-        self.saveTrainingStateLossSpecific(fstate)
-
-        # Save the extra data
+        # Save the weights and the extra data
         DATA = [self.cfg, extras, np.random.get_state()]
-        cPickle.dump(DATA, open(fstate+'.model.cfgextras.pkl', 'wb'))
+        if writer is None:
+            checkpoint.save(fstate+checkpoint.EXT, self.trainingStateWeights(), extras=DATA)
+            if not after is None: after()
+        else:
+            writer.submit(fstate+checkpoint.EXT, self.trainingStateWeights(), extras=DATA, after=after)
 
-        print(' done')
+        print(' done' if writer is None else ' queued')
         sys.stdout.flush()
 
     def loadTrainingState(self, fstate, printfn=print):
-        # TODO TODO TODO FIX
         printfn('    reloading parameters from {} ...'.format(fstate), end='')
         sys.stdout.flush()
 
-        self.loadTrainingStateLossSpecific(fstate)
+        if os.path.isfile(fstate+checkpoint.EXT):
+            tensors, _, DATA = checkpoint.load(fstate+checkpoint.EXT)
+            self.setTrainingStateWeights(tensors)
+        else:
+            # Legacy training states
+            self.loadTrainingStateLossSpecific(fstate)
 
-        # Load the extra data
-        DATA = cPickle.load(open(fstate+'.model.cfgextras.pkl', 'rb'))
+            # Load the extra data
+            DATA = cPickle.load(open(fstate+'.model.cfgextras.pkl', 'rb'))
 
         print(' done')
         sys.stdout.flush()
@@ -146,7 +178,12 @@ class OptimizerTTS:
 
     # Training =================================================================
 
-    def train_oneparamset(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr='', cont=None):
+    def train_oneparamset(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr='', cont=None, stop_epoch=None):
+        '''
+        Train the model with the current configuration.
+        If stop_epoch is not None, the training is suspended after this epoch, and
+        its training state is saved so that it can be resumed with cont=True.
+        '''
 
         print('Loading all validation data at once ...')
         # X_val, Y_val = data.load_inoutset(indir, outdir, wdir, fid_lst_val, verbose=1)
@@ -155,6 +192,14 @@ class OptimizerTTS:
         X_vals, Y_vals = data.croplen([X_vals, Y_vals])
         print('    {} validation files'.format(len(fid_lst_val)))
         print('    number of validation files / train files: {:.2f}%'.format(100.0*float(len(fid_lst_val))/len(fid_lst_tra)))
+        X_vals_sub, Y_vals_sub = X_vals, Y_vals
+        if (not self.cfg.train_validation_subset is None) and (self.cfg.train_validation_subset<len(X_vals)):
+            # The same subset for all the epochs, even after reloading the training state
+            subidx = np.sort(np.random.RandomState(0).choice(len(X_vals), self.cfg.train_validation_subset, replace=False))
+            X_vals_sub = [X_vals[idx] for idx in subidx]
+            Y_vals_sub = [Y_vals[idx] for idx in subidx]
+            print('    {} validation files between the full validations (every {} epochs)'.format(len(X_vals_sub), self.cfg.train_validation_every))
+        worst_val_sub = data.cost_0pred_rmse(Y_vals_sub)
 
         print('Model initial status before training')
         worst_val = data.cost_0pred_rmse(Y_vals)
@@ -175,16 +220,11 @@ class OptimizerTTS:
             nbtrainframes += X.shape[0]
         print('    Training set: {} sentences, #frames={} ({})'.format(len(fid_lst_tra), nbtrainframes, time.strftime('%H:%M:%S', time.gmtime((nbtrainframes*self._model.vocoder.shift)))))
         print('    #parameters/#frames={:.2f}'.format(float(self._model.count_params())/nbtrainframes))
+        min_nbepochs, max_nbepochs = self.nbepochs(nbtrainframes, len(fid_lst_tra))
         if self.cfg.train_nbepochs_scalewdata and not self.cfg.train_batch_lengthmax is None:
-            # During an epoch, the whole data is _not_ seen by the training since cfg.train_batch_lengthmax is limited and smaller to the sentence size.
-            # To compensate for it and make the config below less depedent on the data, the min ans max nbepochs are scaled according to the missing number of frames seen.
-            # TODO Should consider only non-silent frames, many recordings have a lot of pre and post silences
-            epochcoef = nbtrainframes/float((self.cfg.train_batch_lengthmax*len(fid_lst_tra)))
             print('    scale number of epochs wrt number of frames')
-            self.cfg.train_min_nbepochs = int(self.cfg.train_min_nbepochs*epochcoef)
-            self.cfg.train_max_nbepochs = int(self.cfg.train_max_nbepochs*epochcoef)
-            print('        train_min_nbepochs={}'.format(self.cfg.train_min_nbepochs))
-            print('        train_max_nbepochs={}'.format(self.cfg.train_max_nbepochs))
+            print('        train_min_nbepochs={}'.format(min_nbepochs))
+            print('        train_max_nbepochs={}'.format(max_nbepochs))
 
         self.prepare()  # This has to be overwritten by sub-classes
 
@@ -192,19 +232,28 @@ class OptimizerTTS:
         epochs_modelssaved = []
         epochs_durs = []
         nbnodecepochs = 0
-        generator_updates = 0
         epochstart = 1
-        if cont and len(glob.glob(os.path.splitext(params_savefile)[0]+'-trainingstate-last.h5*'))>0:
+        cost_val = None
+        resumebatch = None  # Position in the interrupted epoch, if any
+        self.validation_full = []
+        self.setTrainingStateCounters(dict())
+        fstatelast = os.path.splitext(params_savefile)[0]+'-trainingstate-last.h5'
+        if cont and (os.path.isfile(fstatelast+checkpoint.EXT) or os.path.isfile(fstatelast+'.model.cfgextras.pkl')):
             print('    reloading previous training state ...')
-            savedcfg, extras, rngstate = self.loadTrainingState(os.path.splitext(params_savefile)[0]+'-trainingstate-last.h5')
+            savedcfg, extras, rngstate = self.loadTrainingState(fstatelast)
             np.random.set_state(rngstate)
             cost_val = extras['cost_val']
             # Restoring some local variables
             costs = extras['costs']
             epochs_modelssaved = extras['epochs_modelssaved']
             epochs_durs = extras['epochs_durs']
-            generator_updates = extras['generator_updates']
+            self.setTrainingStateCounters(extras.get('counters', {'generator_updates':extras.get('generator_updates', 0)}))
+            self.validation_full = extras.get('validation_full', [True]*len(costs['model_training']))
             epochstart = extras['epoch']+1
+            resumebatch = extras.get('batch', None)
+            if (not resumebatch is None) and (len(resumebatch['rndidx'])!=int(nbbatches*self.cfg.train_batch_size)):
+                print('    WARNING: the batches have changed, restart epoch {} from its beginning'.format(epochstart))
+                resumebatch = None
             # Restore the saving criteria if only none of those 3 cfg values changed:
             if (savedcfg.train_min_nbepochs==self.cfg.train_min_nbepochs) and (savedcfg.train_max_nbepochs==self.cfg.train_max_nbepochs) and (savedcfg.train_cancel_nodecepochs==self.cfg.train_cancel_nodecepochs):
                 best_val = extras['best_val']
@@ -212,24 +261,35 @@ class OptimizerTTS:
 
         print_log("    start training ...")
         epoch = -1
-        for epoch in range(epochstart,1+self.cfg.train_max_nbepochs):
+        for epoch in range(epochstart,1+max_nbepochs):
             timeepochstart = time.time()
-            rndidx = np.arange(int(nbbatches*self.cfg.train_batch_size))    # Need to restart from ordered state to make the shuffling repeatable after reloading training state, the shuffling will be different anyway
-            np.random.shuffle(rndidx)
-            rndidxb = np.split(rndidx, nbbatches)
             cost_tra = None
-            costs_tra_batches = []
             costs_tra_gen_wgan_lse_ratios = []
-            load_times = []
-            train_times = []
-            for batchid in xrange(nbbatches):
+            if resumebatch is None:
+                rndidx = np.arange(int(nbbatches*self.cfg.train_batch_size))    # Need to restart from ordered state to make the shuffling repeatable after reloading training state, the shuffling will be different anyway
+                np.random.shuffle(rndidx)
+                batchstart = 0
+                costs_tra_batches = []
+                load_times = []
+                train_times = []
+            else:
+                # Continue the interrupted epoch with the same batches, from the one following the last saved state
+                print_log('    resume epoch {} from batch {}/{}'.format(epoch, 1+resumebatch['batchid'], nbbatches))
+                rndidx = resumebatch['rndidx']
+                batchstart = resumebatch['batchid']
+                costs_tra_batches = resumebatch['costs_tra_batches']
+                load_times = resumebatch['load_times']
+                train_times = resumebatch['train_times']
+                resumebatch = None
+            rndidxb = np.split(rndidx, nbbatches)
+            for batchid in xrange(batchstart, nbbatches):
 
                 timeloadstart = time.time()
                 print_tty('\r    Training batch {}/{}'.format(1+batchid, nbbatches))
 
                 # Load training data online, because data is often too heavy to hold in memory
                 fid_lst_trab = [fid_lst_tra[bidx] for bidx in rndidxb[batchid]]
-                X_trab, Y_trab, W_trab = data.load_inoutset(indir, outdir, wdir, fid_lst_trab, length=self.cfg.train_batch_length, lengthmax=self.cfg.train_batch_lengthmax, maskpadtype=self.cfg.train_batch_padtype, cropmode=self.cfg.train_batch_cropmode)
+                X_trab, Y_trab, W_trab, M_trab = data.load_inoutset(indir, outdir, wdir, fid_lst_trab, length=self.cfg.train_batch_length, lengthmax=self.cfg.train_batch_lengthmax, maskpadtype=self.cfg.train_batch_padtype, cropmode=self.cfg.train_batch_cropmode, outmask=True)
 
                 if 0: # Plot batch
                     import matplotlib.pyplot as plt
@@ -246,6 +306,9 @@ class OptimizerTTS:
 
                 train_times.append(time.time()-timetrainstart)
 
+                if not self.telemetry is None:
+                    self.telemetry.batch(epoch=epoch, batch=batchid, trial=trialstr, load=load_times[-1], train=train_times[-1], frames=int(np.sum(M_trab)), padding_ratio=1.0-float(np.mean(M_trab)), generator_step=not cost_tra is None, cost_tra=None if cost_tra is None else float(cost_tra), rss=proc_memresident(), **self.batch_telemetry())
+
                 if not cost_tra is None:
                     print_tty('err={:.4f} (iter train: {:.4f}s)                  '.format(cost_tra,train_times[-1]))
                     if np.isnan(cost_tra):                      # pragma: no cover
@@ -253,32 +316,49 @@ class OptimizerTTS:
                         print_log('    E{} Batch {}/{} train cost = {}'.format(epoch, 1+batchid, nbbatches, cost_tra))
                         raise ValueError('ERROR: Training cost is nan!')
                     costs_tra_batches.append(cost_tra)
+
+                if (not self.cfg.train_checkpoint_every_batches is None) and ((1+batchid)%self.cfg.train_checkpoint_every_batches==0) and (1+batchid<nbbatches):
+                    # Save the position in the epoch along the usual training state of the previous epoch (the RNG state is saved by saveTrainingState)
+                    extras = {'cost_val':cost_val, 'best_val':best_val, 'costs':costs, 'epochs_modelssaved':epochs_modelssaved, 'epochs_durs':epochs_durs, 'nbnodecepochs':nbnodecepochs, 'counters':self.trainingStateCounters(), 'validation_full':self.validation_full, 'epoch':epoch-1,
+                              'batch':{'rndidx':rndidx, 'batchid':1+batchid, 'costs_tra_batches':costs_tra_batches, 'load_times':load_times, 'train_times':train_times}}
+                    print_tty('\r')
+                    self.saveTrainingState(fstatelast, printfn=print_log, extras=extras, writer=self.writer)
             print_tty('\r                                                           \r')
             costs['model_training'].append(np.mean(costs_tra_batches))
 
-            cost_val = self.update_validation_cost(costs, X_vals, Y_vals)  # This has to be overwritten by sub-classes
-
-            print_log("    E{}/{} {}  cost_tra={:.6f} (load:{}s train:{}s)  cost_val={:.6f} ({:.4f}% RMSE)  {} MiB GPU {} MiB RAM".format(epoch, self.cfg.train_max_nbepochs, trialstr, costs['model_training'][-1], time2str(np.sum(load_times)), time2str(np.sum(train_times)), cost_val, 100*costs['model_rmse_validation'][-1]/worst_val, tf_gpu_memused(), proc_memresident()))
+            # Validate on all the files every train_validation_every epochs and whenever the cost is used to save the model
+            fullval = (epoch%self.cfg.train_validation_every==0) or (epoch>=min_nbepochs-self.cfg.train_validation_full_beforemin) or (epoch==max_nbepochs) or (epoch==stop_epoch)
+            self.validation_full.append(fullval)
+            timevalidstart = time.time()
+            if fullval: cost_val = self.update_validation_cost(costs, X_vals, Y_vals)  # This has to be overwritten by sub-classes
+            else:       cost_val = self.update_validation_cost(costs, X_vals_sub, Y_vals_sub)
+            timevalid = time.time()-timevalidstart
+
+            print_log("    E{}/{} {}  cost_tra={:.6f} (load:{}s train:{}s)  cost_val={:.6f} ({:.4f}% RMSE{})  {} MiB GPU {} MiB RAM".format(epoch, max_nbepochs, trialstr, costs['model_training'][-1], time2str(np.sum(load_times)), time2str(np.sum(train_times)), cost_val, 100*costs[self.validation_key('model_rmse_validation')][-1]/(worst_val if fullval else worst_val_sub), '' if fullval else ' subset', tf_gpu_memused(), proc_memresident()))
+            if not self.telemetry is None:
+                summary = self.telemetry.epoch(epoch=epoch, trial=trialstr, cost_tra=float(costs['model_training'][-1]), cost_val=float(cost_val), validation=timevalid, validation_full=fullval, gpu=tf_gpu_memused())
+                print_log('    {:.1f} frames/s  train step p50={:.4f}s p90={:.4f}s  load p90={:.4f}s  padding {:.1f}%'.format(summary['frames_per_s'], summary.get('train_p50', 0.0), summary.get('train_p90', 0.0), summary.get('load_p90', 0.0), 100*summary.get('padding_ratio', 0.0)))
             sys.stdout.flush()
 
             if np.isnan(cost_val): raise ValueError('ERROR: Validation cost is nan!')
             # if (self._errtype=='LSE') and (cost_val>=self.cfg.train_cancel_validthresh*worst_val): raise ValueError('ERROR: Validation cost blew up! It is higher than {} times the worst possible values'.format(self.cfg.train_cancel_validthresh)) # TODO
 
-            self._model.save(os.path.splitext(params_savefile)[0]+'-last.h5', printfn=print_log, extras={'cost_val':cost_val})
+            savestate = (epoch%self.cfg.train_checkpoint_every==0) or (epoch==max_nbepochs) or (epoch==stop_epoch)
+            if savestate: self._model.save(os.path.splitext(params_savefile)[0]+'-last.h5', printfn=print_log, extras={'cost_val':cost_val}, writer=self.writer)
 
             # Save model parameters
-            if epoch>=self.cfg.train_min_nbepochs: # Assume no model is good enough before self.cfg.train_min_nbepochs
+            if fullval and (epoch>=min_nbepochs): # Assume no model is good enough before min_nbepochs
                 if ((best_val is None) or (cost_val<best_val)): # Among all trials of hyper-parameter optimisation
                     best_val = cost_val
-                    self._model.save(params_savefile, printfn=print_log, extras={'cost_val':cost_val}, infostr='(E{} C{:.4f})'.format(epoch, best_val))
+                    self._model.save(params_savefile, printfn=print_log, extras={'cost_val':cost_val}, infostr='(E{} C{:.4f})'.format(epoch, best_val), writer=self.writer)
                     epochs_modelssaved.append(epoch)
                     nbnodecepochs = 0
                 else:
                     nbnodecepochs += 1
 
-            if self.cfg.train_log_plot:
+            if self.cfg.train_log_plot and ((epoch%self.cfg.train_log_plot_every==0) or (epoch==max_nbepochs)):
                 print_log('    saving plots')
-                log_plot_costs(costs, worst_val, fname=os.path.splitext(params_savefile)[0]+'-fig_costs_'+trialstr+'.svg', epochs_modelssaved=epochs_modelssaved)
+                self.log_plot('log_plot_costs', costs=costs, worst_val=worst_val, fname=os.path.splitext(params_savefile)[0]+'-fig_costs_'+trialstr+'.svg', epochs_modelssaved=epochs_modelssaved, validation_full=self.validation_full)
 
                 nbsamples = 2
                 nbsamples = min(nbsamples, len(X_vals))
@@ -288,19 +368,36 @@ class OptimizerTTS:
                 plotsuffix = ''
                 if len(epochs_modelssaved)>0 and epochs_modelssaved[-1]==epoch: plotsuffix='_best'
                 else:                                                           plotsuffix='_last'
-                log_plot_samples(Y_vals, Y_preds, nbsamples=nbsamples, fname=os.path.splitext(params_savefile)[0]+'-fig_samples_'+trialstr+plotsuffix+'.png', vocoder=self._model.vocoder, title='E{}'.format(epoch))
+                self.log_plot('log_plot_samples', Y_vals=Y_vals[:nbsamples], Y_preds=Y_preds, nbsamples=nbsamples, fname=os.path.splitext(params_savefile)[0]+'-fig_samples_'+trialstr+plotsuffix+'.png', vocoder=self._model.vocoder, title='E{}'.format(epoch))
 
             epochs_durs.append(time.time()-timeepochstart)
-            print_log('    ET: {}   max TT: {}s   train ~time left: {}'.format(time2str(epochs_durs[-1]), time2str(np.median(epochs_durs[-10:])*self.cfg.train_max_nbepochs), time2str(np.median(epochs_durs[-10:])*(self.cfg.train_max_nbepochs-epoch))))
-
-            self.saveTrainingState(os.path.splitext(params_savefile)[0]+'-trainingstate-last.h5', printfn=print_log, extras={'cost_val':cost_val, 'best_val':best_val, 'costs':costs, 'epochs_modelssaved':epochs_modelssaved, 'epochs_durs':epochs_durs, 'nbnodecepochs':nbnodecepochs, 'generator_updates':generator_updates, 'epoch':epoch})
+            print_log('    ET: {}   max TT: {}s   train ~time left: {}'.format(time2str(epochs_durs[-1]), time2str(np.median(epochs_durs[-10:])*max_nbepochs), time2str(np.median(epochs_durs[-10:])*(max_nbepochs-epoch))))
+
+            if savestate:
+                extras = {'cost_val':cost_val, 'best_val':best_val, 'costs':costs, 'epochs_modelssaved':epochs_modelssaved, 'epochs_durs':epochs_durs, 'nbnodecepochs':nbnodecepochs, 'counters':self.trainingStateCounters(), 'validation_full':self.validation_full, 'epoch':epoch}
+                if self.cfg.train_checkpoint_keep>0:
+                    # Keep the state of this epoch, link it as the last one and remove the oldest ones
+                    fstate = os.path.splitext(params_savefile)[0]+'-trainingstate-E{:05d}.h5'.format(epoch)
+                    def after(fstate=fstate):
+                        checkpoint.link(fstate+checkpoint.EXT, fstatelast+checkpoint.EXT)
+                        checkpoint.retain(os.path.splitext(params_savefile)[0]+'-trainingstate-E*.h5'+checkpoint.EXT, self.cfg.train_checkpoint_keep)
+                    self.saveTrainingState(fstate, printfn=print_log, extras=extras, writer=self.writer, after=after)
+                else:
+                    self.saveTrainingState(fstatelast, printfn=print_log, extras=extras, writer=self.writer)
 
             if nbnodecepochs>=self.cfg.train_cancel_nodecepochs: # pragma: no cover
                 print_log('WARNING: validation error did not decrease for {} epochs. Early stop!'.format(self.cfg.train_cancel_nodecepochs))
                 break
 
-        if best_val is None: raise ValueError('No model has been saved during training!')
-        return {'epoch_stopped':epoch, 'worst_val':worst_val, 'best_epoch':epochs_modelssaved[-1] if len(epochs_modelssaved)>0 else -1, 'best_val':best_val}
+            if epoch==stop_epoch:
+                print_log('    training suspended at epoch {}'.format(epoch))
+                break
+
+        if not self.writer is None: self.writer.wait()
+        if best_val is None:
+            if epoch!=stop_epoch: raise ValueError('No model has been saved during training!')
+            best_val = np.nan   # Suspended before any model has been saved
+        return {'epoch_stopped':epoch, 'worst_val':worst_val, 'best_epoch':epochs_modelssaved[-1] if len(epochs_modelssaved)>0 else -1, 'best_val':best_val, 'cost_val':cost_val}
 
 
     @classmethod
@@ -321,35 +418,81 @@ class OptimizerTTS:
 
         return cfg, hyperstr
 
-    def train(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, cont=None):
+    def train_trial(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr='', cont=None, stop_epoch=None):
+        '''
+        Run train_oneparamset with the checkpoint writer, the plotting process and the telemetry sink of the trial.
+        '''
+        self.writer = checkpoint.AsyncWriter(threaded=self.cfg.train_checkpoint_async)
+        if self.cfg.train_log_plot and self.cfg.train_log_plot_async: self.plotter = PlotWorker()
+        if not self.cfg.train_telemetry is None: self.telemetry = telemetry.TelemetrySink(os.path.splitext(params_savefile)[0]+'-telemetry.'+self.cfg.train_telemetry, fmt=self.cfg.train_telemetry)
+        try:
+            timewholetrainstart = time.time()
+            train_rets = self.train_oneparamset(indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr=trialstr, cont=cont, stop_epoch=stop_epoch)
+            print_log('Total trial run time: {}s'.format(time2str(time.time()-timewholetrainstart)))
+
+        finally:
+            self.writer.close()     # Finish writing the pending checkpoints
+            self.writer = None
+            if not self.plotter is None:
+                if self.plotter.nbdropped>0: print_log('    {} stale plots dropped'.format(self.plotter.nbdropped))
+                self.plotter.close()
+                self.plotter = None
+            if not self.telemetry is None:
+                self.telemetry.close()
+                self.telemetry = None
+
+        return train_rets
+
+    def save_trial(self, trialstable, triali, cfg, train_rets, params_savefile):
+        '''
+        Add the results of the trial triali to trialstable and save it in <params_savefile>-trials.txt
+        '''
+        ntrialline = [triali]+[getattr(cfg, field[0]) for field in self.cfg.train_hypers]
+        ntrialline = ntrialline+[train_rets[key] for key in sorted(train_rets.keys())]
+        header='trials '+' '.join([field[0] for field in self.cfg.train_hypers])+' '+' '.join(sorted(train_rets.keys()))
+        trialstable.append(ntrialline)
+        trialstable.sort(key=lambda line: line[0])
+        np.savetxt(os.path.splitext(params_savefile)[0]+'-trials.txt', np.vstack(trialstable), header=header)
+
+    def train(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, cont=None, builder=None):
+        '''
+        Run cfg.train_nbtrials trials, with hyper-parameters randomized according to cfg.train_hypers.
+        If cfg.train_trials_parallel>1, the trials run in parallel worker processes,
+        which need the builder of the optimizer, and if cfg.train_halving_rungs is set,
+        the worst trials are stopped at each rung (see train_search).
+        '''
 
         if self.cfg.train_nbtrials>1:
             self._model.save(os.path.splitext(params_savefile)[0]+'-init.h5', printfn=print_log)
 
+        if self.cfg.train_nbtrials>1 and (self.cfg.train_trials_parallel>1 or len(self.cfg.train_halving_rungs)>0):
+            self.train_search(indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, builder)
+            print_log('Finished')
+            return
+
+        cfgbase = self.cfg
         try:
-            trials = []
-            for triali in xrange(1,1+self.cfg.train_nbtrials):  # Run multiple trials with different hyper-parameters
+            trialstable = []
+            for triali in xrange(1,1+cfgbase.train_nbtrials):  # Run multiple trials with different hyper-parameters
                 print('\nStart trial {} ...'.format(triali))
 
                 try:
                     train_rets = None
                     trialstr = 'trial'+str(triali)
-                    if len(self.cfg.train_hypers)>0:
-                        cfg, hyperstr = self.randomize_hyper(cfg)
+                    if len(cfgbase.train_hypers)>0:
+                        self.cfg, hyperstr = self.randomize_hyper(cfgbase)
                         trialstr += ','+hyperstr
                         print('    randomized hyper-parameters: '+trialstr)
-                    if self.cfg.train_nbtrials>1:
+                    if cfgbase.train_nbtrials>1:
                         self._model.load(os.path.splitext(params_savefile)[0]+'-init.h5')
 
-                    timewholetrainstart = time.time()
-                    train_rets = self.train_oneparamset(indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr=trialstr, cont=cont)
+                    train_rets = self.train_trial(indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, trialstr=trialstr, cont=cont)
                     cont = None
-                    print_log('Total trial run time: {}s'.format(time2str(time.time()-timewholetrainstart)))
 
                 except KeyboardInterrupt:                   # pragma: no cover
                     raise KeyboardInterrupt
                 except (ValueError):     # TODO This needs , GpuArrayException ?  # pragma: no cover
-                    if len(self.cfg.train_hypers)>0:
+                    if len(cfgbase.train_hypers)>0:
                         print_log('WARNING: Training crashed!')
                         import traceback
                         traceback.print_exc()
@@ -357,20 +500,191 @@ class OptimizerTTS:
                         print_log('ERROR: Training crashed!')
                         raise   # Crash the whole training if there is only one trial
 
-                if self.cfg.train_nbtrials>1:
+                if cfgbase.train_nbtrials>1:
                     # Save the results of each trial, but only the non-crashed trials
                     if not train_rets is None:
-                        ntrialline = [triali]+[getattr(cfg, field[0]) for field in self.cfg.train_hypers]
-                        ntrialline = ntrialline+[train_rets[key] for key in sorted(train_rets.keys())]
-                        header='trials '+' '.join([field[0] for field in self.cfg.train_hypers])+' '+' '.join(sorted(train_rets.keys()))
-                        trials.append(ntrialline)
-                        np.savetxt(os.path.splitext(params_savefile)[0]+'-trials.txt', np.vstack(trials), header=header)
+                        self.save_trial(trialstable, triali, self.cfg, train_rets, params_savefile)
 
         except KeyboardInterrupt:                           # pragma: no cover
             print_log('WARNING: Training interrupted by user!')
 
+        finally:
+            self.cfg = cfgbase
+
         print_log('Finished')
 
+    def run_trials(self, jobs, indir, outdir, wdir, fid_lst_tra, fid_lst_val):
+        '''
+        Run the trials described by jobs (see trials.schedule) and yield (job, result) as soon as each one is finished.
+        They run in cfg.train_trials_parallel worker processes, or in this process one after the other.
+        '''
+        if self.cfg.train_trials_parallel>1:
+            for job, result in trials.schedule(jobs, self.cfg.train_trials_parallel, pin=self.cfg.train_trials_pin, printfn=print_log):
+                yield job, result
+            return
+
+        cfgbase = self.cfg
+        for job in jobs:
+            print('\nStart {} ...'.format(job['trialstr']))
+            result = {'train_rets':None, 'error':None}
+            try:
+                self.cfg = job['cfg']
+                if not job['finit'] is None: self._model.load(job['finit'])
+                np.random.seed(job['seed'])
+                result['train_rets'] = self.train_trial(indir, outdir, wdir, fid_lst_tra, fid_lst_val, job['params_savefile'], trialstr=job['trialstr'], cont=job['cont'], stop_epoch=job['stop_epoch'])
+            except (ValueError) as e:   # pragma: no cover
+                import traceback
+                traceback.print_exc()
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            finally:
+                self.cfg = cfgbase
+            yield job, result
+
+    def train_search(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, builder=None):
+        '''
+        Run the trials in parallel (see run_trials) and/or by successive halving:
+        All the trials are trained up to the first epoch of cfg.train_halving_rungs,
+        only the cfg.train_halving_keep best ones (according to their last validation cost)
+        are resumed from their training state up to the next rung, and so on until
+        the last epoch (cfg.train_max_nbepochs, possibly scaled, see nbepochs).
+        builder: (python file, function name) of a function returning an optimizer like this one (necessary only for parallel trials).
+        Each trial saves its model in its own file (see trials.trialfile), the best
+        one is then copied to params_savefile and loaded in this optimizer's model.
+        '''
+        if self.cfg.train_trials_parallel>1 and builder is None: raise ValueError('Running the trials in parallel needs the builder of the optimizer (see OptimizerTTS.train)')
+
+        jobs = []
+        for triali in xrange(1,1+self.cfg.train_nbtrials):
+            cfg, hyperstr = self.randomize_hyper(self.cfg)
+            cfg.train_nbtrials = 1
+            cfg.train_trials_parallel = 1
+            trialstr = 'trial'+str(triali)+(','+hyperstr if len(hyperstr)>0 else '')
+            jobs.append({'triali':triali, 'trialstr':trialstr, 'cfg':cfg, 'builder':builder,
+                         'params_savefile':trials.trialfile(params_savefile, triali),
+                         'finit':os.path.splitext(params_savefile)[0]+'-init.h5', 'cont':False,
+                         'args':(indir, outdir, wdir, fid_lst_tra, fid_lst_val),
+                         'seed':np.random.randint(2**31-1)})
+
+        trialstable = []
+        finished = []
+        # The rungs beyond the last epoch of the training (possibly scaled, see nbepochs) would never be reached
+        _, max_nbepochs = self.nbepochs(np.sum([data.loadfile(outdir, fid).shape[0] for fid in fid_lst_tra]), len(fid_lst_tra))
+        rungs = sorted([rung for rung in self.cfg.train_halving_rungs if rung<max_nbepochs])+[None]
+        for rung in rungs:
+            if rung is None: print_log('Training {} trials up to the end'.format(len(jobs)))
+            else:            print_log('Training {} trials up to epoch {}'.format(len(jobs), rung))
+            for job in jobs: job['stop_epoch'] = rung
+
+            suspended = []
+            for job, result in self.run_trials(jobs, indir, outdir, wdir, fid_lst_tra, fid_lst_val):
+                train_rets = result['train_rets']
+                if train_rets is None:
+                    print_log('WARNING: {} crashed: {}'.format(job['trialstr'], result['error']))
+                    continue
+                print_log('    {} at epoch {}: cost_val={} best_val={}'.format(job['trialstr'], train_rets['epoch_stopped'], train_rets['cost_val'], train_rets['best_val']))
+                if train_rets['epoch_stopped']==rung:
+                    suspended.append((job, train_rets))
+                else:   # Finished or stopped early
+                    self.save_trial(trialstable, job['triali'], job['cfg'], train_rets, params_savefile)
+                    finished.append((job, train_rets))
+
+            # Keep the best suspended trials and resume them from their training state
+            suspended = sorted(suspended, key=lambda jobrets: jobrets[1]['cost_val'])
+            nbkept = max(1, int(np.ceil(len(suspended)*self.cfg.train_halving_keep))) if len(suspended)>0 else 0
+            for job, train_rets in suspended[nbkept:]:
+                print_log('    {} stopped (cost_val={})'.format(job['trialstr'], train_rets['cost_val']))
+                if not np.isnan(train_rets['best_val']): finished.append((job, train_rets))
+                self.save_trial(trialstable, job['triali'], job['cfg'], train_rets, params_savefile)
+            jobs = [job for job, _ in suspended[:nbkept]]
+            for job in jobs:
+                job['finit'] = None
+                job['cont'] = True
+
+        finished = [(job, train_rets) for job, train_rets in finished if not np.isnan(train_rets['best_val'])]
+        if len(finished)==0: raise ValueError('ERROR: No trial has saved any model!')
+
+        # As for the sequential trials, the model with the lowest validation cost ends up in params_savefile
+        job, train_rets = min(finished, key=lambda jobrets: jobrets[1]['best_val'])
+        print_log('Best trial: {} (best_val={})'.format(job['trialstr'], train_rets['best_val']))
+        checkpoint.link(job['params_savefile']+checkpoint.EXT, params_savefile+checkpoint.EXT)
+        self._model.load(params_savefile, printfn=print_log)
+
+
+    def log_plot(self, fn, **kwargs):
+        '''
+        Call the plotting function named fn (e.g. 'log_plot_costs') in the plotting process, or directly if there is none.
+        '''
+        if self.plotter is None: globals()[fn](**kwargs)
+        else:                    self.plotter.submit(fn, **kwargs)
+
+    # Distillation =============================================================
+
+    def teacher_cache(self, teacher, indir, fid_lst, teacherdir):
+        '''
+        Predict the outputs of the teacher model for the contexts of fid_lst and
+        cache them in teacherdir, so that they are computed only once.
+        The cache is cleared if the teacher's weights have changed.
+        Returns the path of the cached outputs (as outdir in train).
+        '''
+        import hashlib
+        if not os.path.isdir(teacherdir): os.makedirs(teacherdir)
+        h = hashlib.sha1()
+        for w in teacher.kerasmodel.get_weights():
+            h.update(str(w.shape).encode())
+            h.update(w.tobytes())
+        fhash = teacherdir+'/teacher.sha1'
+        if (not os.path.isfile(fhash)) or open(fhash).read()!=h.hexdigest():
+            for fcmp in glob.glob(teacherdir+'/*.cmp'): os.remove(fcmp)
+            with open(fhash, 'w') as f: f.write(h.hexdigest())
+
+        nbpredicted = 0
+        for fid in fid_lst:
+            fcmp = teacherdir+'/'+fid+'.cmp'
+            if os.path.isfile(fcmp): continue
+            X = data.loadfile(indir, fid)
+            CMP = teacher.predict(np.reshape(X, [1]+[s for s in X.shape]))[0,]
+            CMP.astype('float32').tofile(fcmp+'.tmp{}'.format(os.getpid()))
+            os.rename(fcmp+'.tmp{}'.format(os.getpid()), fcmp)
+            nbpredicted += 1
+        print('    teacher outputs: {} predicted, {} taken from the cache {}'.format(nbpredicted, len(fid_lst)-nbpredicted, teacherdir))
+
+        return teacherdir+'/*.cmp:(-1,{})'.format(teacher.kerasmodel.output_shape[-1])
+
+    def distill(self, teacher, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params_savefile, teacherdir=None, cont=None):
+        '''
+        Train the model (the student) to match the outputs of the frozen teacher
+        model on the contexts of indir, instead of the features of outdir.
+        The teacher's outputs are cached in teacherdir (see teacher_cache, def. next to params_savefile).
+        Once trained, the objective measures of the best student and the teacher
+        are compared on fid_lst_val against the features of outdir, along with their prediction speeds.
+        Returns a dictionary of the measures.
+        '''
+        if teacherdir is None: teacherdir=os.path.splitext(params_savefile)[0]+'-teacher'
+        print('Distillation of the teacher model ({} parameters) in the student model ({} parameters)'.format(teacher.count_params(), self._model.count_params()))
+        teacherpath = self.teacher_cache(teacher, indir, fid_lst_tra+fid_lst_val, teacherdir)
+
+        self.train(indir, teacherpath, wdir, fid_lst_tra, fid_lst_val, params_savefile, cont=cont)
+
+        print_log('Comparing the student with the teacher')
+        self._model.load(params_savefile)
+        Xs = data.load(indir, fid_lst_val, verbose=1)
+        Ys = data.load(outdir, fid_lst_val, verbose=1)
+        Xs, Ys = data.croplen((Xs, Ys))
+        Ymean = np.fromfile(os.path.dirname(outdir)+'/mean4norm.dat', dtype='float32')
+        Ystd = np.fromfile(os.path.dirname(outdir)+'/std4norm.dat', dtype='float32')
+        duration = np.sum([X.shape[0] for X in Xs])*self._model.vocoder.shift
+
+        report = dict()
+        for name, model in [('teacher', teacher), ('student', self._model)]:
+            report['objmeasures_'+name], timepred = model.objmeasures_eval(Xs, Ys, Ymean, Ystd)
+            report['rtf_'+name] = timepred/duration     # Real-time factor of the prediction
+            report['params_'+name] = model.count_params()
+        for key in sorted(report['objmeasures_teacher']):
+            print_log('    {}: teacher {:.4f}, student {:.4f} (gap {:+.4f})'.format(key, report['objmeasures_teacher'][key], report['objmeasures_student'][key], report['objmeasures_student'][key]-report['objmeasures_teacher'][key]))
+        print_log('    prediction RTF: teacher {:.5f}, student {:.5f} (speed-up x{:.2f})'.format(report['rtf_teacher'], report['rtf_student'], report['rtf_teacher']/report['rtf_student']))
+
+        return report
+
 
     # The functions below should be overwritten by any sub-class of OptimizerTTS
     # Default is LSE(MSE) training
@@ -401,26 +715,69 @@ class OptimizerTTS:
 
         return cost_tra # It has to return a cost/error/loss related to the generator/predictor's error, no matter the type of error (e.g. MSE, discri/critic error)
 
+    def batch_telemetry(self):
+        '''
+        Returns a dictionary of extra values to record for the last training step (see telemetry.TelemetrySink.batch).
+        '''
+        return dict()
+
+    def nbepochs(self, nbtrainframes, nbtrainfiles):
+        '''
+        Returns the min and max numbers of epochs of the training, for a training set of nbtrainfiles files of nbtrainframes frames in total.
+        '''
+        min_nbepochs = self.cfg.train_min_nbepochs
+        max_nbepochs = self.cfg.train_max_nbepochs
+        if self.cfg.train_nbepochs_scalewdata and not self.cfg.train_batch_lengthmax is None:
+            # During an epoch, the whole data is _not_ seen by the training since cfg.train_batch_lengthmax is limited and smaller to the sentence size.
+            # To compensate for it and make the config below less depedent on the data, the min ans max nbepochs are scaled according to the missing number of frames seen.
+            # TODO Should consider only non-silent frames, many recordings have a lot of pre and post silences
+            epochcoef = nbtrainframes/float((self.cfg.train_batch_lengthmax*nbtrainfiles))
+            # (without modifying self.cfg, so that the scaling doesn't compound when resuming the training)
+            min_nbepochs = int(min_nbepochs*epochcoef)
+            max_nbepochs = int(max_nbepochs*epochcoef)
+        return min_nbepochs, max_nbepochs
+
+    def validation_key(self, key):
+        '''
+        Name of the series of costs where the validation cost key of the current epoch goes:
+        key itself for a full validation, key+'_subset' for a validation on the subset (see cfg.train_validation_subset).
+        '''
+        if (self.validation_full is None) or (len(self.validation_full)==0) or self.validation_full[-1]: return key
+        return key+'_subset'
+
     def update_validation_cost(self, costs, X_vals, Y_vals):
         cost_validation_rmse = data.cost_model_prediction_rmse(self._model, [X_vals], Y_vals)
-        costs['model_rmse_validation'].append(cost_validation_rmse)
+        costs[self.validation_key('model_rmse_validation')].append(cost_validation_rmse)
 
-        cost_val = costs['model_rmse_validation'][-1]
+        cost_val = costs[self.validation_key('model_rmse_validation')][-1]
 
         return cost_val # It should return a cost value that is used for validation purpose. This cost_val will be used for saving the model if smaller than previous cost_val.
 
-    def saveTrainingStateLossSpecific(self, fstate):
-        # # Apparently the tf.keras.models.save_model saves the optimizer setup, but doesn't
-        # # save its current parameter values. So save them in a seperate file.
-        # # Or only necessary when using TF optimizers?
-        # # https://stackoverflow.com/questions/49503748/save-and-load-model-optimizer-state
-        # symbolic_weights = getattr(self._model.kerasmodel.optimizer, 'weights')
-        # weight_values = tf.keras.backend.batch_get_value(symbolic_weights)
-        # with open(fstate+'.optimizer.pkl', 'wb') as f:
-        #     cPickle.dump(weight_values, f)
-
-        self._model.kerasmodel.save(fstate+'.model', include_optimizer=True)
-        # self._model.kerasmodel.save_weights(fstate+'.model.weights.h5')
+    def trainingStateWeights(self):
+        '''
+        Returns the (name, value) list of all the weights of the training state
+        (e.g. the model's parameters and the optimizer's momentums).
+        '''
+        self._model.kerasmodel._make_train_function()
+        return checkpoint.named('model', self._model.kerasmodel.get_weights()) \
+             + checkpoint.named('optimizer', K.batch_get_value(self._model.kerasmodel.optimizer.weights))
+
+    def setTrainingStateWeights(self, tensors):
+        self._model.kerasmodel.set_weights(checkpoint.group(tensors, 'model'))
+        self._model.kerasmodel._make_train_function()
+        self._model.kerasmodel.optimizer.set_weights(checkpoint.group(tensors, 'optimizer'))
+
+    def trainingStateCounters(self):
+        '''
+        Returns a dictionary of the counters of the optimizer saved in the training state (e.g. the number of updates).
+        '''
+        return dict()
+
+    def setTrainingStateCounters(self, counters):
+        '''
+        Restore the counters returned by trainingStateCounters (an empty dictionary resets them).
+        '''
+        pass
 
     def loadTrainingStateLossSpecific(self, fstate):
         # # Apparently the tf.keras.models.save_model saves the optimizer setup, but doesn't
@@ -432,5 +789,5 @@ class OptimizerTTS:
         #     weight_values = cPickle.load(f)
         # self._model.kerasmodel.optimizer.set_weights(weight_values)
 
-        self._model.kerasmodel = load_model(fstate+'.model', custom_objects={'GaussianNoiseInput':networktts.GaussianNoiseInput, 'lse_loss':lse_loss}, compile=True)
+        self._model.kerasmodel = load_model(fstate+'.model', custom_objects={'GaussianNoiseInput':networktts.GaussianNoiseInput, 'TimeShift':networktts.TimeShift, 'lse_loss':lse_loss}, compile=True)
         # self._model.kerasmodel.load_weights(fstate+'.model.weights.h5')
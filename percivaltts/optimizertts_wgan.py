@@ -40,6 +40,7 @@ from external.pulsemodel import sigproc as sp
 import data
 
 import optimizertts
+import checkpoint
 
 class RandomWeightedAverage(keras.layers.merge._Merge):
     batchsize = None
@@ -113,6 +114,7 @@ class OptimizerTTSWGAN(optimizertts.OptimizerTTS):
         # Construct Computational Graph for Critic
 
         critic = keras.Model(inputs=[self.critic.input_features, self.critic.input_ctx], outputs=self.critic.output)
+        self.critic_net = critic
         print('    critic architecture:')
         critic.summary()
 
@@ -240,10 +242,13 @@ class OptimizerTTSWGAN(optimizertts.OptimizerTTS):
 
         return cost_tra
 
+    def batch_telemetry(self):
+        return {'cost_critic':self.costs_tra_critic_batches[-1]}
+
 
     def update_validation_cost(self, costs, X_vals, Y_vals):
         cost_validation_rmse = data.cost_model_prediction_rmse(self._model, [X_vals], Y_vals)
-        costs['model_rmse_validation'].append(cost_validation_rmse)
+        costs[self.validation_key('model_rmse_validation')].append(cost_validation_rmse)
 
 
         # TODO The following often breaks when loss functions, etc. Try to find a design which is more prototype-friendly
@@ -254,11 +259,15 @@ class OptimizerTTSWGAN(optimizertts.OptimizerTTS):
             generator_train_validation_fn_args = [X_vals, [self.wgan_valid[0,] for _ in xrange(len(Y_vals))], Y_vals]
             fn = lambda x, valid, y: self.generator_model.evaluate(x=x, y=[valid,y], batch_size=1, verbose=0)[0]
         vvv = data.cost_model_mfn(fn, generator_train_validation_fn_args)
-        costs['model_validation'].append(vvv)
+        costs[self.validation_key('model_validation')].append(vvv)
         costs['critic_training'].append(np.mean(self.costs_tra_critic_batches))
         critic_train_validation_fn_args = [Y_vals, X_vals]
-        costs['critic_validation'].append(data.cost_model_mfn(lambda y,x: self.critic_model.evaluate(x=[y, x], y=[self.wgan_valid[:1,], self.wgan_fake[:1,], self.wgan_dummy[:1,]], batch_size=1, verbose=0)[0], critic_train_validation_fn_args))
-        costs['critic_validation_ltm'].append(np.mean(costs['critic_validation'][-self.cfg.train_wgan_validation_ltm_winlen:]))
+        costs[self.validation_key('critic_validation')].append(data.cost_model_mfn(lambda y,x: self.critic_model.evaluate(x=[y, x], y=[self.wgan_valid[:1,], self.wgan_fake[:1,], self.wgan_dummy[:1,]], batch_size=1, verbose=0)[0], critic_train_validation_fn_args))
+        # The long term mean uses only the full validations (see cfg.train_validation_every)
+        if self.validation_key('critic_validation')=='critic_validation' or len(costs['critic_validation_ltm'])==0:
+            costs['critic_validation_ltm'].append(np.mean(costs[self.validation_key('critic_validation')][-self.cfg.train_wgan_validation_ltm_winlen:]))
+        else:
+            costs['critic_validation_ltm'].append(costs['critic_validation_ltm'][-1])
         cost_val = costs['critic_validation_ltm'][-1]
 
         if np.mean(self.costs_tra_critic_batches)<=0.0: print('Average critic loss is negative: Training is likely to take ages to converge or not converge at all. ')
@@ -305,15 +314,28 @@ class OptimizerTTSWGAN(optimizertts.OptimizerTTS):
 
         f.close()
 
-    def saveTrainingStateLossSpecific(self, fstate):
-
-        # TODO That's not enough
-
-        self.saveOptimizer(self.generator_model.optimizer, fstate+'.generator.optimizer.h5')
+    def trainingStateWeights(self):
+        self.generator_model._make_train_function()
+        self.critic_model._make_train_function()
+        return checkpoint.named('model', self._model.kerasmodel.get_weights()) \
+             + checkpoint.named('critic', self.critic_net.get_weights()) \
+             + checkpoint.named('generator.optimizer', K.batch_get_value(self.generator_model.optimizer.weights)) \
+             + checkpoint.named('critic.optimizer', K.batch_get_value(self.critic_model.optimizer.weights))
+
+    def setTrainingStateWeights(self, tensors):
+        self._model.kerasmodel.set_weights(checkpoint.group(tensors, 'model'))
+        if len(checkpoint.group(tensors, 'critic'))>0: self.critic_net.set_weights(checkpoint.group(tensors, 'critic'))
+        self.generator_model._make_train_function()
+        self.generator_model.optimizer.set_weights(checkpoint.group(tensors, 'generator.optimizer'))
+        self.critic_model._make_train_function()
+        self.critic_model.optimizer.set_weights(checkpoint.group(tensors, 'critic.optimizer'))
 
-        self.saveOptimizer(self.critic_model.optimizer, fstate+'.critic.optimizer.h5')
+    def trainingStateCounters(self):
+        return {'generator_updates':self.generator_updates, 'costs_tra_critic_batches':list(self.costs_tra_critic_batches)}
 
-        self._model.kerasmodel.save_weights(fstate+'.model.weights.h5')
+    def setTrainingStateCounters(self, counters):
+        self.generator_updates = counters.get('generator_updates', 0)
+        self.costs_tra_critic_batches = list(counters.get('costs_tra_critic_batches', []))
 
     def loadTrainingStateLossSpecific(self, fstate):
 
@@ -172,6 +172,12 @@ def weights_normal_ortho(insiz, outsiz, std, rng, dtype):
 
 def proc_memresident():
     """Return something close to RAM used by the process [MiB]"""
+    try:
+        # Cheap enough to be called at each training step
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+    except (IOError, OSError, ValueError):                  # pragma: no cover
+        pass
     PID_memsize = subprocess.Popen(['ps', 'h', '-p', str(os.getpid()), '-o', 'rssize'], stdout=subprocess.PIPE).communicate()[0].rstrip()
     if len(PID_memsize)>0:
         return int(PID_memsize)/1024
@@ -296,7 +302,7 @@ def nvidia_smi_gpu_memused():                               # pragma: no cover
 
 # Logging plot functions -------------------------------------------------------
 
-def log_plot_costs(costs, worst_val, fname, epochs_modelssaved):
+def log_plot_costs(costs, worst_val, fname, epochs_modelssaved, validation_full=None):
     """
     Plot cost functions.
 
@@ -304,21 +310,28 @@ def log_plot_costs(costs, worst_val, fname, epochs_modelssaved):
     ----------
     costs : dict
         A dictionary of cost functions. Each entry will be ploted on the same axis.
+        An entry shorter than costs['model_training'] has a value only for the
+        epochs of the full validations (or of the subset ones if its name ends with '_subset').
     worst_val : float
         Worst/Upper limit of the costs values (mainly useful when using LSE).
 
     fname : str
         File name to save the plots (e.g. costs.png)
+    validation_full : list
+        For each epoch, whether the validation used all the validation files (None if it always did).
     """
     import matplotlib
     matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
     import matplotlib.pyplot as plt
     fig = plt.figure(figsize=(16, 8), dpi=200)
     plt.title('Cost functions')
-    epochs = np.arange(1,1+len(costs[costs.keys()[0]]))
+    epochs = np.arange(1,1+len(costs['model_training']))
+    if validation_full is None: validation_full = [True]*len(epochs)
     plt.plot(epochs, worst_val*np.ones(len(epochs)), ':k', label='0-pred')
     for key in sorted(costs.keys()):
-        plt.plot(epochs, np.array(costs[key]), label=key)
+        keyepochs = epochs
+        if len(costs[key])<len(epochs): keyepochs = [epoch for epoch, full in zip(epochs, validation_full) if full!=key.endswith('_subset')]
+        plt.plot(keyepochs[:len(costs[key])], np.array(costs[key]), label=key)
     if not epochs_modelssaved is None and len(epochs_modelssaved)>0:
         plt.stem(epochs_modelssaved, worst_val*np.ones(len(epochs_modelssaved)), 'gray', markerfmt='.', basefmt=' ')
     plt.xlim([0, len(epochs)])
@@ -379,3 +392,65 @@ def log_plot_samples(Y_vals, Y_preds, nbsamples, fname, vocoder, title=''):
     if not title is None: plt.suptitle(title)
     fig.savefig(fname)
     plt.close()
+
+def _plot_worker(queue):
+    import Queue
+    while True:
+        jobs = [queue.get()]
+        while True:
+            try:
+                jobs.append(queue.get_nowait())
+            except Queue.Empty:
+                break
+        # Drop the stale requests, i.e. plot only the last request of each figure
+        latest = dict()
+        for job in jobs:
+            if not job is None: latest[job[0]] = job
+        for fname, fn, kwargs in latest.values():
+            try:
+                globals()[fn](fname=fname, **kwargs)
+            except Exception as e:
+                print('WARNING: plotting {} failed: {}'.format(fname, e))
+        if None in jobs: return
+
+class PlotWorker:
+    """
+    Run the log_plot_* functions in a separate process, so that the plots
+    don't slow down the training loop. The arguments are sent through a queue
+    of at most maxpending requests; the oldest ones are dropped when the plots
+    fall behind.
+    """
+
+    def __init__(self, maxpending=4):
+        import multiprocessing
+        self.queue = multiprocessing.Queue(maxsize=maxpending)
+        self.process = multiprocessing.Process(target=_plot_worker, args=(self.queue,))
+        self.process.daemon = True
+        self.process.start()
+        self.nbdropped = 0
+
+    def submit(self, fn, fname, **kwargs):
+        """
+        Call fn(fname=fname, **kwargs) in the plotting process, fn being the name of a log_plot_* function.
+        """
+        import Queue
+        job = (fname, fn, kwargs)
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            try:
+                self.queue.get_nowait()
+                self.nbdropped += 1
+            except Queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                self.nbdropped += 1
+
+    def close(self):
+        """
+        Wait for the pending plots and stop the plotting process.
+        """
+        self.queue.put(None)
+        self.process.join()
@@ -118,6 +118,7 @@ cfg.arch_gen_nbcnnlayers = 8
 cfg.arch_gen_nbfilters = 4
 cfg.arch_gen_winlen = 5        # [frames] 5*0.005=0.025s.
 cfg.arch_spec_freqlen = 5      # [bins] CNN only 5
+cfg.arch_lookahead = 4         # [frames] Look-ahead of the causal model (DCNNF0SpecNoiseFeaturesCausal)
 
 # Training options
 cfg.fparams_fullset = 'model.h5'
@@ -138,20 +139,17 @@ cfg.train_wgan_critic_use_WGAN_incnoisefeature = False
 
 # cfg.train_hypers = [('train_wgan_critic_learningrate_log10', -5.0, -1.0), ('train_wgan_critic_adam_beta1', 0.0, 0.9), ('train_wgan_critic_adam_beta2', 0.8, 0.9999), ('train_wgan_gen_learningrate_log10', -5.0, -1.0), ('train_wgan_gen_adam_beta1', 0.0, 0.9), ('train_wgan_gen_adam_beta2', 0.8, 0.9999), ('train_wgan_gen_adam_beta2', 0.8, 0.9999)]
 # cfg.train_nbtrials = 36
+# cfg.train_trials_parallel = 4  # Run 4 trials at the same time, each one on a quarter of the CPUs
 
 cfg.print_content()
 
 # Processes --------------------------------------------------------------------
 
-def pfs_map_vocoder(fid): return vocoder.analysisfid(fid, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_path, 'noise':noise_path, 'vuv':vuv_path})
 def features_extraction():
 
-    # Use this tool for parallel extraction of the acoustic features ...
-    from external import pfs
-    pfs.map(pfs_map_vocoder, fids)
-
-    # ... or uncomment this line below to extract them file by file.
-    # for fid in fids: pfs_map_vocoder(fid)
+    # Parallel extraction of the acoustic features, skipping the files already extracted
+    # (use force=True to re-extract them all, or nbproc=1 to extract them file by file)
+    vocoder.analysisfids(fids, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_path, 'noise':noise_path, 'vuv':vuv_path}, ftimings=cp+wav_dir+feats_dir+'_analysis_timings.txt')
 
     # Create time weights (column vector in [0,1]). The frames at begining or end of
     # each file whose weights are smaller than 0.5 will be ignored by the training
@@ -186,22 +184,56 @@ def build_model():
 
     # mod = modeltts_common.Generic(ctxsize, vocoder, layertypes=[['RNDUNI', 100], ['CNN1D',cfg.arch_hiddenwidth,cfg.arch_ctx_winlen], 'FC', 'FC', 'FC', 'FC', 'FC'], cfgarch=cfg)    # CNNFC in the paper
     mod = modeltts_common.DCNNF0SpecNoiseFeatures(ctxsize, vocoder, cfg)    # DCNN in the paper
+    # mod = modeltts_common.DCNNF0SpecNoiseFeaturesCausal(ctxsize, vocoder, cfg)  # Causal DCNN for streaming synthesis (use networks_critic.Critic(..., causal=True))
 
     return mod
 
 
+def build_optimizer():
+    mod = build_model()
+
+    if errtype=='LSE': opti=optimizertts.OptimizerTTS(cfg, mod)
+    else:              opti=optimizertts_wgan.OptimizerTTSWGAN(cfg, mod, errtype=errtype, critic=networks_critic.Critic(vocoder, ctxsize, cfg))
+
+    return opti
+
+
 def training(cont=False):
     fid_lst_tra = fids[:cfg.id_train_nb()]
     fid_lst_val = fids[cfg.id_valid_start:cfg.id_valid_start+cfg.id_valid_nb]
 
-    mod = build_model()
+    opti = build_optimizer()
 
-    if errtype=='LSE': opti=optimizertts.OptimizerTTS(cfg, mod)
-    else:              opti=optimizertts_wgan.OptimizerTTSWGAN(cfg, mod, errtype=errtype, critic=networks_critic.Critic(vocoder, ctxsize, cfg))
+    # The builder is used by the worker processes of the parallel trials (see cfg.train_trials_parallel)
+    opti.train(cfg.inpath, cfg.outpath, cfg.wpath, fid_lst_tra, fid_lst_val, cfg.fparams_fullset, cont=cont, builder=(os.path.realpath(__file__), 'build_optimizer'))
+
+    del opti
+
+
+def distillation(fteacher=cfg.fparams_fullset):
+    # Train a compact student to match the outputs of the trained model (see OptimizerTTS.distill)
+    teacher = build_model()
+    teacher.load(fteacher)
+
+    fid_lst_tra = fids[:cfg.id_train_nb()]
+    fid_lst_val = fids[cfg.id_valid_start:cfg.id_valid_start+cfg.id_valid_nb]
+
+    student = modeltts_common.Generic(ctxsize, vocoder, layertypes=[['CNN1D',cfg.arch_hiddenwidth,cfg.arch_ctx_winlen], 'FC', 'FC', 'FC'], cfgarch=cfg)
+    opti = optimizertts.OptimizerTTS(cfg, student)
+    opti.distill(teacher, cfg.inpath, cfg.outpath, cfg.wpath, fid_lst_tra, fid_lst_val, os.path.splitext(fteacher)[0]+'-student.pkl')
+
+
+def pruning(fparams=cfg.fparams_fullset, ratio=0.5):
+    # Remove the filters and units of lowest activations and fine-tune the smaller model (see ModelTTS.prune)
+    mod = build_model()
+    mod.load(fparams)
 
-    opti.train(cfg.inpath, cfg.outpath, cfg.wpath, fid_lst_tra, fid_lst_val, cfg.fparams_fullset, cont=cont)
+    fid_lst_tra = fids[:cfg.id_train_nb()]
+    fid_lst_val = fids[cfg.id_valid_start:cfg.id_valid_start+cfg.id_valid_nb]
 
-    del mod
+    mod.prune(ratio, mode='activation', Xs=data.load(cfg.inpath, fid_lst_val))
+    opti = optimizertts.OptimizerTTS(cfg, mod)
+    opti.train(cfg.inpath, cfg.outpath, cfg.wpath, fid_lst_tra, fid_lst_val, os.path.splitext(fparams)[0]+'-pruned.pkl')
 
 
 def generate(fparams=cfg.fparams_fullset):
@@ -216,14 +248,39 @@ def generate(fparams=cfg.fparams_fullset):
 
     demostart = cfg.id_test_demostart if hasattr(cfg, 'id_test_demostart') else 0
     mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test[demostart:demostart+10], os.path.splitext(fparams)[0]+'-demo-snd', do_objmeas=True, do_resynth=True, pp_mcep=False)
-    # mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test[demostart:demostart+10], os.path.splitext(fparams)[0]+'-demo-pp-snd', do_objmeas=False, do_resynth=False, pp_mcep=True) # Need SPTK
+    mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test[demostart:demostart+10], os.path.splitext(fparams)[0]+'-demo-pp-snd', do_objmeas=False, do_resynth=False, pp_mcep=True)
+
+    # Export the model in int8 for CPU serving, and compare its objective measures with the float32 model
+    # mod.export_int8(os.path.splitext(fparams)[0]+'-int8', cfg.inpath, fids[:cfg.id_train_nb()][:20], outpath=cfg.outpath, fid_lst_eval=fid_lst_test[demostart:demostart+10], activations=True, cfg=cfg)
 
     # And generate all of them for listening tests
     # mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test, os.path.splitext(fparams)[0]+'-snd', do_objmeas=True, do_resynth=True, pp_mcep=False)
     # mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test, os.path.splitext(fparams)[0]+'-pp-snd', do_objmeas=True, do_resynth=True, pp_mcep=True)
 
 
+def serve(fparams=cfg.fparams_fullset, port=8000):
+    # Keep the model loaded and synthesise on request (see server.py)
+    import server
+
+    mod = build_model()
+    mod.load(fparams)
+
+    server.InferenceServer(mod, cfg.outpath, inpath=cfg.inpath, labquestions=lab_questions, port=port).serve_forever()
+
+
 if  __name__ == "__main__" :                                 # pragma: no cover
+    if '--serve' in sys.argv:
+        serve()
+        sys.exit(0)
+
+    if '--prune' in sys.argv:
+        pruning()
+        sys.exit(0)
+
+    if '--distill' in sys.argv:
+        distillation()
+        sys.exit(0)
+
     features_extraction()
     contexts_extraction()
     training(cont='--continue' in sys.argv)
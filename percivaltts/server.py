@@ -0,0 +1,272 @@
+'''
+Long-lived inference server.
+
+It loads a model and its vocoder once and serves synthesis requests over HTTP:
+    POST /cmp   Normalised context matrix (raw float32), returns the de-normalised acoustic features (raw float32)
+    POST /wav   Normalised context matrix (raw float32), returns a wav file
+    POST /lab   HTS label file (state aligned), returns a wav file (with the timings of each stage in the header X-Timings)
+    GET /metrics  Returns latency and throughput statistics (JSON)
+The number of rows of the returned features is given in the header X-Shape.
+
+Concurrent requests are gathered for at most batch_wait seconds, sorted by
+length, and predicted by batches of at most batch_size padded sequences.
+The post-processing (de-normalisation, MLPG and vocoding) runs in the
+threads of the requests.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import os
+import time
+import json
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+
+import numpy as np
+
+import tensorflow as tf
+from tensorflow import keras
+
+import modeltts
+
+
+def wav2bytes(wav, fs):
+    '''
+    Encode the waveform wav as a 16bits wav file, normalised to its maximum amplitude.
+    '''
+    import wave
+    import StringIO
+    amp = np.max(np.abs(wav)) if len(wav)>0 else 0.0
+    if amp>0.0: wav = 0.99*wav/amp
+    buf = StringIO.StringIO()
+    fwav = wave.open(buf, 'wb')
+    fwav.setnchannels(1)
+    fwav.setsampwidth(2)
+    fwav.setframerate(int(fs))
+    fwav.writeframes((wav*32767).astype('<i2').tostring())
+    fwav.close()
+    return buf.getvalue()
+
+
+class _Request:
+    def __init__(self, X):
+        self.X = X
+        self.CMP = None
+        self.error = None
+        self.done = threading.Event()
+        self.timestart = time.time()
+
+
+class InferenceServer:
+    '''
+    model:    A loaded ModelTTS.
+    outpath:  Path of the output features, to find the normalisation stats (as in ModelTTS.generate_wav).
+    inpath:   Path of the input features, to find the min-max stats of the contexts (only necessary for /lab).
+    labquestions: Question file used to binarise the labels (only necessary for /lab).
+    port:     Port to listen on, 0 to pick a free one (see self.port).
+    '''
+
+    def __init__(self, model, outpath, inpath=None, labquestions=None, host='127.0.0.1', port=0, batch_size=8, batch_wait=0.010, mlpg_chunksize=None, pp_mcep=False, nbmetrics=1000):
+        self.model = model
+        self.vocoder = model.vocoder
+        self.Ymean = np.fromfile(os.path.dirname(outpath)+'/mean4norm.dat', dtype='float32')
+        self.Ystd = np.fromfile(os.path.dirname(outpath)+'/std4norm.dat', dtype='float32')
+        self.synthesizer = None
+        if (not inpath is None) and (not labquestions is None):
+            import inference
+            self.synthesizer = inference.Synthesizer(model, inpath, outpath, labquestions, mlpg_chunksize=mlpg_chunksize, pp_mcep=pp_mcep)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.mlpg_chunksize = mlpg_chunksize
+        self.pp_mcep = pp_mcep
+
+        # The graph and session have to be set explicitly in the prediction thread
+        self.graph = tf.get_default_graph()
+        self.session = keras.backend.get_session()
+        self.model.kerasmodel._make_predict_function()
+
+        self.queue = Queue.Queue()
+        self.running = False
+
+        self.lock = threading.Lock()
+        self.timestart = time.time()
+        self.nbrequests = dict()
+        self.latencies = dict()         # Last nbmetrics latencies of each endpoint
+        self.nbmetrics = nbmetrics
+        self.batchsizes = deque(maxlen=nbmetrics)
+        self.audioduration = 0.0
+
+        server = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, format, *args): pass
+            def do_GET(self):
+                if self.path=='/metrics': self.reply(json.dumps(server.metrics()), 'application/json')
+                else:                     self.send_error(404)
+            def do_POST(self):
+                timestart = time.time()
+                body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+                try:
+                    if self.path=='/cmp':
+                        CMP = server.synthesis_cmp(server.bytes2contexts(body))
+                        response = (CMP.astype('float32').tostring(), 'application/octet-stream', {'X-Shape':str(CMP.shape)})
+                    elif self.path=='/wav':
+                        response = (server.synthesis_wav(server.bytes2contexts(body)), 'audio/wav', None)
+                    elif self.path=='/lab':
+                        wavbytes, timings = server.synthesis_lab(body)
+                        response = (wavbytes, 'audio/wav', {'X-Timings':json.dumps(timings)})
+                    else:
+                        self.send_error(404)
+                        return
+                except Exception as e:
+                    self.send_error(400, str(e))
+                    return
+                # Count the request before replying, so that the client's next /metrics includes it
+                server.metrics_add(self.path, time.time()-timestart)
+                self.reply(*response)
+            def reply(self, data, contenttype, headers=None):
+                self.send_response(200)
+                self.send_header('Content-Type', contenttype)
+                self.send_header('Content-Length', str(len(data)))
+                if not headers is None:
+                    for key in headers: self.send_header(key, headers[key])
+                self.end_headers()
+                self.wfile.write(data)
+
+        class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.host, self.port = self.httpd.server_address
+
+    def start(self):
+        '''Start serving in background threads.'''
+        self.running = True
+        self.threads = [threading.Thread(target=self._predict_loop), threading.Thread(target=self.httpd.serve_forever)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+        print('Inference server listening on http://{}:{}'.format(self.host, self.port))
+
+    def stop(self):
+        self.running = False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for thread in self.threads: thread.join()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True: time.sleep(1.0)
+        except KeyboardInterrupt:   # pragma: no cover
+            self.stop()
+
+    # Inputs -------------------------------------------------------------------
+
+    def bytes2contexts(self, body):
+        X = np.frombuffer(body, dtype='float32')
+        if len(X)==0 or len(X)%self.model.ctxsize!=0: raise ValueError('The context matrix size has to be a multiple of {}'.format(self.model.ctxsize))
+        return X.reshape((-1, self.model.ctxsize))
+
+    def synthesis_lab(self, body):
+        '''
+        Synthesise an HTS label file in memory (see inference.Synthesizer), with batched predictions.
+        '''
+        if self.synthesizer is None: raise ValueError('The server needs inpath and labquestions to synthesise labels')
+        wav, timings = self.synthesizer.synthesis(body.splitlines(), predict=self.predict)  # Never read as a path
+        with self.lock: self.audioduration += len(wav)/float(self.vocoder.fs)
+        return wav2bytes(wav, self.vocoder.fs), timings
+
+    # Synthesis ----------------------------------------------------------------
+
+    def predict(self, X):
+        '''Queue X for prediction and wait for the result.'''
+        req = _Request(X)
+        self.queue.put(req)
+        req.done.wait()
+        if not req.error is None: raise req.error
+        return req.CMP
+
+    def synthesis_cmp(self, X):
+        CMP = self.predict(X)
+        return modeltts.denormalise(self.vocoder, CMP, self.Ymean, self.Ystd, mlpg_chunksize=self.mlpg_chunksize)
+
+    def synthesis_wav(self, X):
+        CMP = self.synthesis_cmp(X)
+        wav = self.vocoder.synthesis(CMP, pp_mcep=self.pp_mcep)
+        with self.lock: self.audioduration += len(wav)/float(self.vocoder.fs)
+        return wav2bytes(wav, self.vocoder.fs)
+
+    def _predict_loop(self):
+        with self.session.as_default(), self.graph.as_default():
+            while self.running:
+                try:
+                    reqs = [self.queue.get(timeout=0.1)]
+                except Queue.Empty:
+                    continue
+                # Gather the requests arriving in the next batch_wait seconds
+                timeend = time.time()+self.batch_wait
+                while len(reqs)<self.batch_size*4:
+                    try:
+                        reqs.append(self.queue.get(timeout=max(0.0, timeend-time.time())))
+                    except Queue.Empty:
+                        break
+
+                reqs = sorted(reqs, key=lambda req: req.X.shape[0])
+                for bstart in xrange(0, len(reqs), self.batch_size):
+                    breqs = reqs[bstart:bstart+self.batch_size]
+                    try:
+                        maxlen = np.max([req.X.shape[0] for req in breqs])
+                        Xb = np.zeros((len(breqs), maxlen, self.model.ctxsize), dtype='float32')
+                        for bi, req in enumerate(breqs): Xb[bi,:req.X.shape[0],] = req.X
+                        CMPb = self.model.kerasmodel.predict(Xb, batch_size=len(breqs))
+                        for bi, req in enumerate(breqs): req.CMP = CMPb[bi,:req.X.shape[0],]
+                    except Exception as e:
+                        for req in breqs: req.error = e
+                    with self.lock: self.batchsizes.append(len(breqs))
+                    for req in breqs: req.done.set()
+
+    # Metrics ------------------------------------------------------------------
+
+    def metrics_add(self, endpoint, latency):
+        with self.lock:
+            self.nbrequests[endpoint] = self.nbrequests.get(endpoint, 0)+1
+            self.latencies.setdefault(endpoint, deque(maxlen=self.nbmetrics)).append(latency)
+
+    def metrics(self):
+        with self.lock:
+            uptime = time.time()-self.timestart
+            metrics = {'uptime': uptime,
+                       'requests': sum(self.nbrequests.values()),
+                       'throughput': sum(self.nbrequests.values())/uptime,   # [requests/s]
+                       'audio_duration': self.audioduration,                # [s]
+                       'batch_size_mean': float(np.mean(self.batchsizes)) if len(self.batchsizes)>0 else 0.0,
+                       'endpoints': dict()}
+            for endpoint in self.latencies:
+                lat = np.array(self.latencies[endpoint])
+                metrics['endpoints'][endpoint] = {'requests': self.nbrequests[endpoint],
+                                                  'latency_mean': float(np.mean(lat)),
+                                                  'latency_p50': float(np.percentile(lat, 50)),
+                                                  'latency_p90': float(np.percentile(lat, 90)),
+                                                  'latency_p99': float(np.percentile(lat, 99))}
+        return metrics
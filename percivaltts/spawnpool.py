@@ -0,0 +1,144 @@
+'''
+Pool of worker processes started as new Python interpreters.
+
+Unlike multiprocessing.Pool, the workers are not forks of the current process,
+so that they don't inherit the threads and locks of a TensorFlow session
+(a fork of a process running TF can deadlock). The functions and their
+arguments are sent to the workers pickled, so that the functions have to be
+defined at the top level of a module which can be imported without TF
+(e.g. vocoders).
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+import sys
+import os
+import subprocess
+import cPickle
+
+
+class AsyncResult:
+    '''
+    Result of a job sent to a worker by SpawnPool.apply_async.
+    '''
+
+    def __init__(self, pool, worker, order):
+        self.pool = pool
+        self.worker = worker
+        self.order = order
+        self.ready = False
+        self.value = None
+
+    def get(self):
+        if not self.ready: self.pool._receive(self.worker)
+        ok, value = self.value
+        if not ok: raise ValueError('The job failed in the worker process:\n'+value)
+        return value
+
+
+class SpawnPool:
+    '''
+    nbproc:      Number of worker processes.
+    initializer: If not None, initializer(*initargs) is called once in each worker.
+    A worker runs a single job at a time, so that the pipes of a worker never
+    hold more than one job and its result.
+    '''
+
+    def __init__(self, nbproc, initializer=None, initargs=()):
+        self.workers = []
+        self.running = dict()   # worker -> AsyncResult of its current job
+        self.nbsent = 0
+        for _ in xrange(nbproc):
+            self.workers.append(subprocess.Popen([sys.executable, os.path.realpath(__file__).replace('.pyc', '.py')], stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+        if not initializer is None:
+            for worker in xrange(nbproc): self._send(worker, initializer, initargs).get()
+
+    def _send(self, worker, func, args):
+        # The job is pickled twice, so that the worker can report a failure to unpickle it (e.g. an ImportError)
+        cPickle.dump(cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL), self.workers[worker].stdin, cPickle.HIGHEST_PROTOCOL)
+        self.workers[worker].stdin.flush()
+        self.nbsent += 1
+        self.running[worker] = AsyncResult(self, worker, self.nbsent)
+        return self.running[worker]
+
+    def _receive(self, worker):
+        try:
+            value = cPickle.load(self.workers[worker].stdout)
+        except (EOFError, cPickle.UnpicklingError):
+            value = (False, 'the worker exited with code {}'.format(self.workers[worker].wait()))
+        result = self.running.pop(worker)
+        result.value = value
+        result.ready = True
+
+    def apply_async(self, func, args=()):
+        '''
+        Run func(*args) in an idle worker (after waiting for the oldest running job if none is idle).
+        Returns an AsyncResult.
+        '''
+        idle = [worker for worker in xrange(len(self.workers)) if not worker in self.running]
+        if len(idle)==0:
+            worker = min(self.running.keys(), key=lambda w: self.running[w].order)
+            self._receive(worker)
+            idle = [worker]
+        return self._send(idle[0], func, args)
+
+    def map(self, func, iterable):
+        results = [self.apply_async(func, (arg,)) for arg in iterable]
+        return [result.get() for result in results]
+
+    def close(self):
+        '''
+        Let the workers exit once their current job is done.
+        '''
+        for process in self.workers: process.stdin.close()
+
+    def terminate(self):
+        for process in self.workers:
+            if process.poll() is None: process.kill()
+
+    def join(self):
+        for worker in self.running.keys(): self._receive(worker)   # So that no worker is blocked on writing a result
+        for process in self.workers: process.wait()
+
+
+def worker():
+    '''
+    Run the jobs received on stdin and send their results on stdout, until stdin is closed.
+    '''
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdout = sys.stderr     # So that the prints of the jobs don't corrupt the results
+    while True:
+        try:
+            job = cPickle.load(stdin)
+        except EOFError:
+            break
+        try:
+            func, args = cPickle.loads(job)
+            reply = (True, func(*args))
+        except Exception:
+            import traceback
+            reply = (False, traceback.format_exc())
+        cPickle.dump(reply, stdout, cPickle.HIGHEST_PROTOCOL)
+        stdout.flush()
+
+
+if  __name__ == "__main__" :                                 # pragma: no cover
+    # Make the package importable first, since the jobs' functions are pickled with their module's full name (e.g. percivaltts.vocoders)
+    sys.path.insert(0, os.path.dirname(sys.path[0]))
+    worker()
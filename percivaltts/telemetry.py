@@ -0,0 +1,130 @@
+'''
+Structured telemetry of the training.
+
+A TelemetrySink records one line per training step (e.g. the loading and
+training times, the number of frames, the losses, the memory used) and one
+line per epoch summarising them (e.g. frames/s and percentiles of the times),
+so that the throughput of different runs can be compared without parsing the
+logs.
+
+Two formats are supported:
+    'jsonl'  All the records are written in the same file, one JSON object per line, with a field 'kind' ('batch' or 'epoch').
+    'csv'    The records of each kind are written in a separate file: <fpath without extension>-<kind>.csv
+             The columns are given by the first record of each kind.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+import os
+import time
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+FORMATS = ['jsonl', 'csv']
+PERCENTILES = [50, 90, 99]
+
+def summary(values, name, percentiles=PERCENTILES):
+    '''
+    Returns an OrderedDict of the sum, mean and percentiles of values, whose keys are prefixed by name.
+    '''
+    sums = OrderedDict()
+    if len(values)==0: return sums
+    sums[name+'_sum'] = float(np.sum(values))
+    sums[name+'_mean'] = float(np.mean(values))
+    for p in percentiles: sums[name+'_p{}'.format(p)] = float(np.percentile(values, p))
+    sums[name+'_max'] = float(np.max(values))
+    return sums
+
+
+class TelemetrySink:
+    '''
+    fpath:  Path of the telemetry file (for 'csv', its extension is replaced by -<kind>.csv).
+    fmt:    'jsonl' or 'csv'.
+    The batch records are buffered and written to the file at each epoch summary.
+    '''
+
+    def __init__(self, fpath, fmt='jsonl'):
+        if not fmt in FORMATS: raise ValueError('Unknown telemetry format {} (has to be in {})'.format(fmt, FORMATS))
+        self.fpath = fpath
+        self.fmt = fmt
+        self.files = dict()
+        self.columns = dict()
+        self.batches = []
+
+    def _file(self, kind):
+        fpath = self.fpath if self.fmt=='jsonl' else os.path.splitext(self.fpath)[0]+'-'+kind+'.csv'
+        if not fpath in self.files: self.files[fpath] = open(fpath, 'a')
+        return self.files[fpath]
+
+    def write(self, kind, record):
+        '''
+        Write the dictionary record of type kind (e.g. 'batch', 'epoch').
+        '''
+        f = self._file(kind)
+        if self.fmt=='jsonl':
+            line = OrderedDict([('kind',kind)])
+            line.update(record)
+            f.write(json.dumps(line)+'\n')
+        else:
+            if not kind in self.columns:
+                self.columns[kind] = list(record.keys())
+                if f.tell()==0: f.write(','.join(self.columns[kind])+'\n')
+            f.write(','.join(['' if record.get(col) is None else str(record.get(col)) for col in self.columns[kind]])+'\n')
+
+    def batch(self, **fields):
+        '''
+        Record a training step (e.g. load, train, frames, padding_ratio, cost_tra).
+        '''
+        record = OrderedDict([('time',time.time())])
+        record.update(sorted(fields.items()))
+        self.batches.append(record)
+
+    def epoch(self, **fields):
+        '''
+        Write the buffered batch records and the summary of the epoch.
+        Returns the summary (an OrderedDict).
+        '''
+        for record in self.batches: self.write('batch', record)
+
+        record = OrderedDict([('time',time.time())])
+        record.update(sorted(fields.items()))
+        record['batches'] = len(self.batches)
+        for name in ['load', 'train']:
+            record.update(summary([b[name] for b in self.batches if name in b], name))
+        frames = np.sum([b['frames'] for b in self.batches if 'frames' in b])
+        steptime = record.get('load_sum', 0.0)+record.get('train_sum', 0.0)
+        record['frames'] = int(frames)
+        record['frames_per_s'] = float(frames/steptime) if steptime>0.0 else 0.0
+        if len(self.batches)>0:
+            record['padding_ratio'] = float(np.mean([b.get('padding_ratio', 0.0) for b in self.batches]))
+            record['rss_max'] = max([b.get('rss', -1) for b in self.batches])
+        self.write('epoch', record)
+        self.batches = []
+        self.flush()
+
+        return record
+
+    def flush(self):
+        for f in self.files.values(): f.flush()
+
+    def close(self):
+        for f in self.files.values(): f.close()
+        self.files = dict()
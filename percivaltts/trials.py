@@ -0,0 +1,150 @@
+'''
+Run hyper-parameter trials in parallel local worker processes.
+
+Each trial runs in its own process (this file run as a script), with:
+    its own output files (the parameter file of the trial, e.g. model-trial3.h5, its plots, training states and logs),
+    a bounded number of TF intra/inter-op threads,
+    a CPU set (through taskset, if available), disjoint from the ones of the other workers.
+The worker builds the optimizer (and its model) by calling a function given
+as (python file, function name), e.g. ('run.py', 'build_optimizer'), since
+TF sessions can't be shared with forked processes.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import sys
+import os
+import time
+import subprocess
+import multiprocessing
+import cPickle
+from distutils.spawn import find_executable
+
+import numpy as np
+
+
+def cpusets(nbworkers, nbcpus=None):
+    '''
+    Split the CPUs in nbworkers disjoint sets (or single CPUs shared round-robin if there are more workers than CPUs).
+    '''
+    if nbcpus is None: nbcpus = multiprocessing.cpu_count()
+    if nbworkers>=nbcpus: return [[wi%nbcpus] for wi in xrange(nbworkers)]
+    return [[int(cpu) for cpu in cpus] for cpus in np.array_split(np.arange(nbcpus), nbworkers)]
+
+def trialfile(params_savefile, triali):
+    '''
+    Returns the parameter file of the trial triali, e.g. model-trial3.h5 for model.h5.
+    '''
+    return os.path.splitext(params_savefile)[0]+'-trial{}'.format(triali)+os.path.splitext(params_savefile)[1]
+
+def schedule(jobs, nbworkers, pin=True, interop=2, poll=1.0, printfn=print):
+    '''
+    Run the jobs in at most nbworkers processes at the same time.
+    jobs: list of dictionaries with, at least, the keys:
+        builder:         (python file, function name) of a function returning the optimizer to train.
+        params_savefile: Parameter file of the trial, its other files are named after it.
+        finit:           Parameter file to initialise the model from (or None).
+        cont:            Resume the training from the trial's training state (see OptimizerTTS.train_oneparamset).
+        stop_epoch:      Epoch at which the training is suspended (or None).
+        cfg:             Training configuration of the trial.
+        args:            (indir, outdir, wdir, fid_lst_tra, fid_lst_val) as for OptimizerTTS.train.
+        trialstr:        Name of the trial.
+    Yields (job, result) as soon as a job is finished, result being a dictionary
+    with 'train_rets' (as returned by OptimizerTTS.train_oneparamset, None if it crashed) and 'error'.
+    '''
+    if len(jobs)==0: return
+    nbworkers = max(1, min(nbworkers, len(jobs)))
+    taskset = find_executable('taskset') if pin else None
+    if pin and taskset is None: printfn('WARNING: taskset is not available, the workers are not pinned to CPUs')
+    slots = cpusets(nbworkers)
+    printfn('Running {} trials in {} worker processes'.format(len(jobs), nbworkers))
+
+    pending = list(jobs)
+    running = dict()    # slot -> (job, process, log file)
+    while len(pending)>0 or len(running)>0:
+        for slot in xrange(nbworkers):
+            if len(pending)==0 or slot in running: continue
+            job = pending.pop(0)
+            job['threads'] = (len(slots[slot]), interop)  # intra/inter-op threads
+            fbase = os.path.splitext(job['params_savefile'])[0]
+            job['fresult'] = fbase+'-result.pkl'
+            if os.path.isfile(job['fresult']): os.remove(job['fresult'])
+            with open(fbase+'-job.pkl', 'wb') as f: cPickle.dump(job, f, cPickle.HIGHEST_PROTOCOL)
+
+            env = dict(os.environ)
+            env['OMP_NUM_THREADS'] = str(len(slots[slot]))
+            env['MKL_NUM_THREADS'] = str(len(slots[slot]))
+            # This file runs as a script, so make the package importable even if it isn't installed
+            pkgparent = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+            env['PYTHONPATH'] = os.pathsep.join([pkgparent]+([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+            cmd = [sys.executable, os.path.realpath(__file__).replace('.pyc', '.py'), fbase+'-job.pkl']
+            if not taskset is None: cmd = [taskset, '-c', ','.join([str(cpu) for cpu in slots[slot]])]+cmd
+            flog = open(fbase+'-log.txt', 'w')
+            running[slot] = (job, subprocess.Popen(cmd, env=env, stdout=flog, stderr=subprocess.STDOUT), flog)
+            printfn('    {} started on CPUs {} (log in {})'.format(job['trialstr'], slots[slot], flog.name))
+
+        time.sleep(poll)
+
+        for slot in running.keys():
+            job, process, flog = running[slot]
+            if process.poll() is None: continue
+            flog.close()
+            del running[slot]
+            result = {'train_rets':None, 'error':'the worker exited with code {}'.format(process.returncode)}
+            if os.path.isfile(job['fresult']):
+                with open(job['fresult'], 'rb') as f: result=cPickle.load(f)
+            yield job, result
+
+def worker(fjob):
+    '''
+    Run the trial described in the file fjob (see schedule) and write its result.
+    '''
+    with open(fjob, 'rb') as f: job=cPickle.load(f)
+
+    import backend_tensorflow   # Create its default session first, so that it is replaced by the one below
+    import tensorflow as tf
+    from tensorflow import keras
+    sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=job['threads'][0], inter_op_parallelism_threads=job['threads'][1]))
+    sess.__enter__()
+    keras.backend.set_session(sess)
+
+    result = {'train_rets':None, 'error':None}
+    try:
+        import imp
+        builder = getattr(imp.load_source('percivaltts_trialbuilder', job['builder'][0]), job['builder'][1])
+        opti = builder()
+        opti.cfg = job['cfg']
+        if not job['finit'] is None: opti._model.load(job['finit'])
+        np.random.seed(job['seed'])
+
+        indir, outdir, wdir, fid_lst_tra, fid_lst_val = job['args']
+        result['train_rets'] = opti.train_trial(indir, outdir, wdir, fid_lst_tra, fid_lst_val, job['params_savefile'], trialstr=job['trialstr'], cont=job['cont'], stop_epoch=job['stop_epoch'])
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    with open(job['fresult']+'.tmp', 'wb') as f: cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(job['fresult']+'.tmp', job['fresult'])
+
+
+if  __name__ == "__main__" :                                 # pragma: no cover
+    worker(sys.argv[1])
@@ -36,11 +36,16 @@ class Vocoder:
 
     mlpg_wins = None
 
+    fwcache_dir = None  # If not None, the frequency warping matrices are also cached on disk in this directory
+
+    analysis_outputs = []   # Keys of the `outputpathdicts` argument of analysisfid
+
     def __init__(self, name, fs, shift, mlpg_wins=None):
         self._name = name
         self.fs = fs
         self.shift = shift
         self.mlpg_wins = mlpg_wins
+        self._fwmats = dict()
 
     def preprocwav(self, wav, fs, highpass=None):
         '''
@@ -89,9 +94,133 @@ class Vocoder:
         #             from IPython.core.debugger import  Pdb; Pdb().set_trace()
         #         SPEC[n,:] = spec_pp
 
+    # Frequency warping conversions, using cached matrices
+    def _fwconvert(self, direction, X, fs, dftlen, nbbnds, smooth=None):
+        if direction=='lin2fw':
+            return sp.linbnd2fwbnd(X, fs, dftlen, nbbnds)
+        else:
+            if smooth is None: return sp.fwbnd2linbnd(X, fs, dftlen)
+            else:              return sp.fwbnd2linbnd(X, fs, dftlen, smooth=smooth)
+
+    def _fwmatrix(self, direction, fs, dftlen, nbbnds, smooth=None):
+        '''
+        Return a sparse matrix M such that M.T.dot(X.T).T is equivalent to
+        sp.linbnd2fwbnd(X, fs, dftlen, nbbnds) (direction='lin2fw') or to
+        sp.fwbnd2linbnd(X, fs, dftlen, smooth) (direction='fw2lin').
+        For fixed (fs, dftlen, nbbnds), these conversions are linear and
+        frame-independent, so the matrix is obtained by converting an identity
+        matrix. It is built once and kept in self._fwmats (and in
+        self.fwcache_dir if set). Returns None if the conversion turns out
+        not to be linear, the direct conversion should then be used.
+        '''
+        key = (direction, int(fs), int(dftlen), int(nbbnds), smooth)
+        if key in self._fwmats: return self._fwmats[key]
+
+        import scipy.sparse
+
+        insize = dftlen//2+1 if direction=='lin2fw' else nbbnds
+
+        fcache = None
+        if not self.fwcache_dir is None:
+            fcache = os.path.join(self.fwcache_dir, 'fwmat_{}_fs{}_dftlen{}_nbbnds{}_smooth{}.npz'.format(*key))
+
+        if (not fcache is None) and os.path.isfile(fcache):
+            M = scipy.sparse.load_npz(fcache)
+        else:
+            M = self._fwconvert(direction, np.eye(insize), fs, dftlen, nbbnds, smooth)
+            M[abs(M)<1e-12*np.max(abs(M))] = 0.0
+            M = scipy.sparse.csc_matrix(M)
+
+            # Verify the linearity assumption on random data
+            X = np.random.RandomState(0).randn(4, insize)
+            if not np.allclose(M.T.dot(X.T).T, self._fwconvert(direction, X, fs, dftlen, nbbnds, smooth), rtol=1e-6, atol=1e-9):
+                print('WARNING: {} conversion is not linear, the cached matrices cannot be used'.format(direction)) # pragma: no cover
+                M = None                                                                                            # pragma: no cover
+
+            if (not fcache is None) and (not M is None):
+                makedirs(self.fwcache_dir)
+                ftmp = fcache+'.tmp{}.npz'.format(os.getpid())
+                scipy.sparse.save_npz(ftmp, M)
+                os.rename(ftmp, fcache)
+
+        self._fwmats[key] = M
+
+        return M
+
+    def linbnd2fwbnd(self, X, fs, dftlen, nbbnds):
+        '''Equivalent of sp.linbnd2fwbnd, as a single matrix product over all frames.'''
+        M = self._fwmatrix('lin2fw', fs, dftlen, nbbnds)
+        if M is None: return self._fwconvert('lin2fw', X, fs, dftlen, nbbnds)  # pragma: no cover
+        return np.ascontiguousarray(M.T.dot(X.T).T)
+
+    def fwbnd2linbnd(self, X, fs, dftlen, smooth=None):
+        '''Equivalent of sp.fwbnd2linbnd, as a single matrix product over all frames.'''
+        M = self._fwmatrix('fw2lin', fs, dftlen, X.shape[1], smooth=smooth)
+        if M is None: return self._fwconvert('fw2lin', X, fs, dftlen, X.shape[1], smooth)   # pragma: no cover
+        return np.ascontiguousarray(M.T.dot(X.T).T)
+
+    def analysisfids(self, fids, wav_path, f0_min, f0_max, outputpathdicts, nbproc=None, force=False, ftimings=None, **kwargs):
+        '''
+        Run analysisfid on all fids, using nbproc processes (def. the number of CPUs).
+        The fids whose output files all exist and are newer than their waveform are skipped, unless force=True.
+        The outputs of each fid are written under temporary names and renamed
+        once its analysis is over, so that an interruption leaves no half-written file.
+        The duration of each analysis is appended to the text file ftimings (if not None).
+        Returns the list of the analysed fids.
+        '''
+        def uptodate(fid):
+            twav = os.path.getmtime(wav_path.replace('*',fid))
+            for key in self.analysis_outputs:
+                fout = outputpathdicts[key].replace('*',fid)
+                if (not os.path.isfile(fout)) or os.path.getmtime(fout)<twav: return False
+            return True
+
+        todo = [fid for fid in fids if force or (not uptodate(fid))]
+        print('Analysing {} files ({} are up to date)'.format(len(todo), len(fids)-len(todo)))
+        if len(todo)==0: return todo
+
+        jobs = [(self, fid, wav_path, f0_min, f0_max, outputpathdicts, kwargs) for fid in todo]
+        if nbproc is None:
+            import multiprocessing
+            nbproc = multiprocessing.cpu_count()
+        pool = None
+        if nbproc>1:
+            import multiprocessing
+            pool = multiprocessing.Pool(nbproc)
+            results = pool.imap_unordered(_analysis_job, jobs)
+        else:
+            results = (_analysis_job(job) for job in jobs)
+
+        try:
+            ftim = None
+            if not ftimings is None:
+                makedirs(os.path.dirname(os.path.abspath(ftimings)))
+                ftim = open(ftimings, 'a')
+            durations = []
+            for fid, duration in results:
+                durations.append(duration)
+                if not ftim is None:
+                    ftim.write('{} {}\n'.format(fid, duration))
+                    ftim.flush()
+        finally:
+            if not ftim is None: ftim.close()
+            if not pool is None:
+                pool.terminate()
+                pool.join()
+
+        print('Analysed {} files in {}s ({}s per file on average)'.format(len(todo), np.sum(durations), np.mean(durations)))
+
+        return todo
+
     def __str__(self):
          return '{} (fs={}, shift={})'.format(self.name(), self.fs, self.shift)
 
+    def config(self):
+        '''
+        Full configuration of the vocoder, e.g. to identify the waveforms it synthesises.
+        '''
+        return '{} {}'.format(self.__class__.__name__, sorted([(key, value) for key, value in vars(self).items() if not key.startswith('_') and not key in ['features_err', 'fwcache_dir']]))
+
     def name(self): return self._name
 
     def featuressizeraw(self):
@@ -136,7 +265,7 @@ class VocoderF0Spec(Vocoder):
         dftlen = (SPEC.shape[1]-1)*2
 
         if self.spec_type=='fwbnd':
-            COMPSPEC = sp.linbnd2fwbnd(np.log(abs(SPEC)), self.fs, dftlen, spec_size)
+            COMPSPEC = self.linbnd2fwbnd(np.log(abs(SPEC)), self.fs, dftlen, spec_size)
 
         elif self.spec_type=='mcep':  # pragma: no cover   Need SPTK to test this
             # TODO test
@@ -145,27 +274,194 @@ class VocoderF0Spec(Vocoder):
         return COMPSPEC
 
     def decompress_spectrum(self, COMPSPEC, spec_type, pp_mcep=False):
+        '''
+        pp_mcep: Apply Merlin's post-processing on the spectral envelope.
+                 True (or 'numpy') runs it in-process, 'sptk' runs the original SPTK command line tools.
+        '''
+        import external.merlin.generate_pp
 
         if self.spec_type=='fwbnd':
-            SPEC = np.exp(sp.fwbnd2linbnd(COMPSPEC, self.fs, self.dftlen, smooth=True))
-            if pp_mcep:             # pragma: no cover Would need SPTK to test it
+            SPEC = np.exp(self.fwbnd2linbnd(COMPSPEC, self.fs, self.dftlen, smooth=True))
+            if pp_mcep=='sptk':     # pragma: no cover Would need SPTK to test it
                 print('        Merlin/SPTK Post-proc on MCEP')
-                import external.merlin.generate_pp
                 mcep = sp.spec2mcep(SPEC*self.fs, sp.bark_alpha(self.fs), 256)    # Arbitrary high order
                 mcep_pp = external.merlin.generate_pp.mcep_postproc_sptk(mcep, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
                 SPEC = sp.mcep2spec(mcep_pp, sp.bark_alpha(self.fs), dftlen=self.dftlen)/self.fs
+            elif pp_mcep:
+                print('        Merlin Post-proc on MCEP')
+                SPEC = external.merlin.generate_pp.spec_postproc_numpy(SPEC, self.fs, order=256)    # Arbitrary high order
 
         elif self.spec_type=='mcep':# pragma: no cover Would need SPTK to test it
             # TODO test
-            if pp_mcep:
+            if pp_mcep=='sptk':
                 print('        Merlin/SPTK Post-proc on MCEP')
-                import external.merlin.generate_pp
                 COMPSPEC = external.merlin.generate_pp.mcep_postproc_sptk(COMPSPEC, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
+            elif pp_mcep:
+                print('        Merlin Post-proc on MCEP')
+                COMPSPEC = external.merlin.generate_pp.mcep_postproc_numpy(COMPSPEC, self.fs, dftlen=self.dftlen)
             SPEC = sp.mcep2spec(COMPSPEC, sp.bark_alpha(self.fs), dftlen=self.dftlen)
 
         return SPEC
 
 
+    def vuv(self, CMP):
+        '''
+        Voicing decision of each frame of CMP, or None if the vocoder doesn't have a voicing stream.
+        '''
+        return None
+
+    def energy(self, CMP):
+        '''
+        Energy [dB] of each frame of CMP, from its compressed amplitude spectrum
+        (log amplitudes of the frequency bands, or mel-cepstrum).
+        '''
+        if self.spec_type=='mcep':
+            import external.merlin.generate_pp
+            SPEC = external.merlin.generate_pp.mcep2spec_numpy(CMP[:,1:1+self.spec_size], external.merlin.generate_pp.bark_alpha(self.fs), self.dftlen)
+            return 10*np.log10(np.mean(SPEC**2, axis=1))
+
+        return 10*np.log10(np.mean(np.exp(2*CMP[:,1:1+self.spec_size]), axis=1))
+
+    def splitcandidates(self, CMP, Emax=None, sil_threshold=40.0):
+        '''
+        Frames of CMP where the synthesis can be split: either silent (energy sil_threshold dB
+        below Emax, def. the maximum energy of CMP) or unvoiced (if the vocoder has a voicing stream).
+        '''
+        E = self.energy(CMP)
+        if Emax is None: Emax = np.max(E)
+        cand = E < Emax-sil_threshold
+        vuv = self.vuv(CMP)
+        if not vuv is None: cand = np.logical_or(cand, np.logical_not(vuv))
+        return cand
+
+    def synthesis_segments(self, CMP, seglen=2.0, sil_threshold=40.0):
+        '''
+        Find where CMP can be split for synthesis, so that each segment lasts at least seglen [s].
+        Splits are placed in the middle of runs of frames which are either silent
+        (energy sil_threshold dB below the maximum) or unvoiced (if the vocoder has a voicing stream).
+        Returns the list of frame indices of the splits.
+        '''
+        cand = self.splitcandidates(CMP, sil_threshold=sil_threshold)
+
+        seglenframes = int(np.round(seglen/self.shift))
+        splits = []
+        last = 0
+        t = seglenframes
+        while t < len(cand)-seglenframes//2:
+            if cand[t]:
+                end = t
+                while end<len(cand) and cand[end]: end+=1
+                split = (t+end)//2
+                if split >= len(cand)-seglenframes//2: break
+                splits.append(split)
+                last = split
+                t = last+seglenframes
+            else:
+                t += 1
+
+        return splits
+
+    def synthesis_segmented(self, CMP, pool=None, seglen=2.0, sil_threshold=40.0, xfade=0.010, margin=0.050, **kwargs):
+        '''
+        Same as synthesis, but CMP is split into segments (see synthesis_segments)
+        which are synthesised independently, possibly in parallel through the
+        multiprocessing pool `pool`. The segments are joined by linear crossfades
+        of xfade [s] centered on the split frames. Each segment is synthesised with
+        margin [s] of extra context on each side of the crossfades, to avoid its edge effects.
+        kwargs are passed to synthesis.
+        '''
+        splits = self.synthesis_segments(CMP, seglen=seglen, sil_threshold=sil_threshold)
+        if len(splits)==0: return self.synthesis(CMP, **kwargs)
+
+        ovl = int(np.ceil((0.5*xfade+margin)/self.shift))
+        bounds = [0]+splits+[CMP.shape[0]]
+        jobs = []
+        for si in xrange(len(bounds)-1):
+            start = max(0, bounds[si]-ovl)
+            end = min(CMP.shape[0], bounds[si+1]+ovl)
+            jobs.append((self, CMP[start:end,:], kwargs))
+        if pool is None: wavs = map(_synthesis_segment, jobs)
+        else:            wavs = pool.map(_synthesis_segment, jobs)
+
+        xfadelen = max(1, int(np.round(xfade*self.fs)))
+        ramp = (np.arange(xfadelen)+0.5)/xfadelen
+        syn = np.zeros(max([int(np.round(max(0, bounds[si]-ovl)*self.shift*self.fs))+len(wav) for si, wav in enumerate(wavs)]))
+        for si, wav in enumerate(wavs):
+            offset = int(np.round(max(0, bounds[si]-ovl)*self.shift*self.fs))
+            win = np.ones(len(wav))
+            if si>0:            # Fade in around the split at the start
+                c = int(np.round(bounds[si]*self.shift*self.fs))-offset-xfadelen//2
+                win[:c] = 0.0
+                win[c:c+xfadelen] = ramp[:len(win[c:c+xfadelen])]
+            if si<len(wavs)-1:  # Fade out around the split at the end
+                c = int(np.round(bounds[si+1]*self.shift*self.fs))-offset-xfadelen//2
+                win[c:c+xfadelen] *= ramp[::-1][:len(win[c:c+xfadelen])]
+                win[c+xfadelen:] = 0.0
+            syn[offset:offset+len(wav)] += win*wav
+
+        return syn
+
+    def synthesis_stream(self, CMPblocks, seglen=0.5, sil_threshold=40.0, xfade=0.010, margin=0.050, **kwargs):
+        '''
+        Generator synthesising the frames given incrementally by the iterable
+        CMPblocks, which yields the waveform chunk by chunk.
+        As soon as seglen [s] of new frames are available (plus the frames
+        needed for the crossfade and its margin), they are synthesised with
+        past context and split at the last silent or unvoiced frame (see
+        splitcandidates, with the maximum energy seen so far), or as late as
+        possible if there is none. The segments are joined as in synthesis_segmented.
+        kwargs are passed to synthesis.
+        '''
+        import itertools
+
+        hop = self.shift*self.fs
+        ovl = int(np.ceil((0.5*xfade+margin)/self.shift))
+        seglenframes = max(1, int(np.round(seglen/self.shift)))
+        xfadelen = max(1, int(np.round(xfade*self.fs)))
+        ramp = (np.arange(xfadelen)+0.5)/xfadelen
+
+        buf = None
+        bufstart = 0    # Frame index of buf[0]
+        split = 0       # Frame index where the next segment starts
+        emitted = 0     # Number of samples already yielded
+        tail = None     # Faded-out samples of the previous segment, after `emitted`
+        Emax = -np.inf
+        for block in itertools.chain(CMPblocks, [None]):
+            last = block is None
+            if not last:
+                if len(block)==0: continue
+                buf = block if buf is None else np.vstack((buf, block))
+                Emax = max(Emax, np.max(self.energy(block)))
+            if buf is None: return
+            total = bufstart+len(buf)
+
+            while (last and split<total) or ((not last) and total-split>=seglenframes+ovl):
+                if last:
+                    end = total
+                else:
+                    candstart = split+seglenframes//2
+                    cands = np.where(self.splitcandidates(buf[candstart-bufstart:total-ovl-bufstart,], Emax=Emax, sil_threshold=sil_threshold))[0]
+                    end = candstart+cands[-1] if len(cands)>0 else total-ovl
+
+                start = max(bufstart, split-ovl)
+                wav = self.synthesis(buf[start-bufstart:min(total, end+ovl)-bufstart,], **kwargs)
+                offset = int(np.round(start*hop))
+                if last: endsample = offset+len(wav)
+                else:    endsample = int(np.round(end*hop))-xfadelen//2
+
+                syn = wav[emitted-offset:endsample-offset].copy()
+                if not tail is None:
+                    syn[:len(tail)] = syn[:len(tail)]*ramp[:len(tail)] + tail[:len(syn)]
+                if not last: tail = wav[endsample-offset:endsample-offset+xfadelen]*ramp[::-1][:len(wav[endsample-offset:endsample-offset+xfadelen])]
+                emitted = endsample
+                split = end
+                yield syn
+
+                # Forget the frames that are not needed anymore
+                keep = max(bufstart, split-ovl)
+                buf = buf[keep-bufstart:,]
+                bufstart = keep
+
 class VocoderPML(VocoderF0Spec):
     nm_size = None
 
@@ -178,6 +474,8 @@ class VocoderPML(VocoderF0Spec):
 
     def noisesize(self): return self.nm_size
 
+    analysis_outputs = ['f0', 'spec', 'noise']
+
     def analysisf(self, fwav, ff0, f0_min, f0_max, fspec, fnm, **kwargs):
         print('Extracting PML features from: '+fwav)
 
@@ -199,7 +497,7 @@ class VocoderPML(VocoderF0Spec):
         SPEC = self.decompress_spectrum(CMP[:,1:1+self.spec_size], self.spec_type, pp_mcep=pp_mcep)
 
         NM = CMP[:,1+self.spec_size:1+self.spec_size+self.nm_size]
-        NM = sp.fwbnd2linbnd(NM, self.fs, self.dftlen)
+        NM = self.fwbnd2linbnd(NM, self.fs, self.dftlen)
 
         syn = pulsemodel.synthesis.synthesize(self.fs, np.vstack((self.shift*np.arange(len(f0)), f0)).T, SPEC, NM=NM, nm_cont=False, pp_atten1stharminsilences=-25, pp_f0_smooth=pp_f0_smooth)
 
@@ -228,9 +526,13 @@ class VocoderWORLD(VocoderF0Spec):
     def featuressizeraw(self):
         return 1+self.spec_size+self.aper_size+1
 
+    def vuv(self, CMP): return CMP[:,1+self.spec_size+self.aper_size]>=0.5
+
     def noisesize(self): return self.aper_size
     def vuvsize(self): return 1
 
+    analysis_outputs = ['f0', 'spec', 'noise', 'vuv']
+
     def analysisf(self, fwav, ff0, f0_min, f0_max, fspec, faper, fvuv, **kwargs):
         print('Extracting WORLD features from: '+fwav)
 
@@ -278,7 +580,7 @@ class VocoderWORLD(VocoderF0Spec):
         makedirs(os.path.dirname(fspec))
         SPEC.astype('float32').tofile(fspec)
 
-        APER = sp.linbnd2fwbnd(APER, fs, self.dftlen, self.aper_size)
+        APER = self.linbnd2fwbnd(APER, fs, self.dftlen, self.aper_size)
         APER = sp.mag2db(APER)
         makedirs(os.path.dirname(faper))
         APER.astype('float32').tofile(faper)
@@ -311,7 +613,7 @@ class VocoderWORLD(VocoderF0Spec):
 
         APER = CMP[:,1+self.spec_size:1+self.spec_size+self.aper_size]
         APER = sp.db2mag(APER)
-        APER = sp.fwbnd2linbnd(APER, self.fs, self.dftlen)
+        APER = self.fwbnd2linbnd(APER, self.fs, self.dftlen)
 
         if 0:
             import matplotlib.pyplot as plt
@@ -342,6 +644,86 @@ class VocoderWORLD(VocoderF0Spec):
         self.features_err.setdefault('APER[dB]', []).append(np.sqrt(np.mean((apertrg-apergen)**2, 0)))
         # TODO Add VUV
 
+def _analysis_job(job):
+    import time
+    vocoder, fid, wav_path, f0_min, f0_max, outputpathdicts, kwargs = job
+    tmppathdicts = dict([(key, outputpathdicts[key].replace('*', '*.part{}'.format(os.getpid()))) for key in vocoder.analysis_outputs])
+    timestart = time.time()
+    try:
+        vocoder.analysisfid(fid, wav_path, f0_min, f0_max, tmppathdicts, **kwargs)
+        for key in vocoder.analysis_outputs:
+            os.rename(tmppathdicts[key].replace('*',fid), outputpathdicts[key].replace('*',fid))
+    finally:
+        for key in vocoder.analysis_outputs:
+            if os.path.isfile(tmppathdicts[key].replace('*',fid)): os.remove(tmppathdicts[key].replace('*',fid))
+    return fid, time.time()-timestart
+
+def _synthesis_segment(job):
+    vocoder, CMP, kwargs = job
+    return vocoder.synthesis(CMP, **kwargs)
+
+def denormalise(vocoder, CMP, Ymean, Ystd, mlpg_ignore=False, mlpg_chunksize=None):
+    '''
+    De-normalise the network output CMP and apply MLPG if the vocoder uses it.
+    '''
+
+    CMP = CMP*np.tile(Ystd, (CMP.shape[0], 1)) + np.tile(Ymean, (CMP.shape[0], 1)) # De-normalise
+
+    # TODO Should go in the vocoder, but there is Ystd to put as argument ...
+    #      Though, the vocoder is not taking care of the deltas composition during data composition either.
+    if (not vocoder.mlpg_wins is None) and len(vocoder.mlpg_wins)>0:    # If MLPG is used
+        if mlpg_ignore:
+            CMP = CMP[:,:vocoder.featuressizeraw()]
+        else:
+            # Apply MLPG
+            from external.merlin.mlpg_fast import MLParameterGenerationFast as MLParameterGeneration
+            mlpg_algo = MLParameterGeneration(delta_win=vocoder.mlpg_wins[0], acc_win=vocoder.mlpg_wins[1])
+            var = np.tile(Ystd**2,(CMP.shape[0],1)) # Simplification!
+            if mlpg_chunksize is None:
+                CMP = mlpg_algo.generation(CMP, var, vocoder.featuressizeraw())
+            else:
+                CMP = mlpg_algo.generation_chunked(CMP, var, vocoder.featuressizeraw(), chunksize=mlpg_chunksize)
+
+    return CMP
+
+
+# State of the synthesis workers of generate_wav (set once per process by _synthesis_init)
+_synthesis_ctx = None
+
+def _synthesis_init(vocoder, Ymean, Ystd, mlpg_chunksize, segmented=False, segpool=None):
+    global _synthesis_ctx
+    _synthesis_ctx = (vocoder, Ymean, Ystd, mlpg_chunksize, segmented, segpool)
+
+def _synthesis_job(job):
+    '''
+    Post-process and synthesise one utterance, then write the waveform.
+    The waveform is also copied in the cache as fcache, if not None.
+    Returns the de-normalised features if return_cmp, None otherwise.
+    '''
+    vocoder, Ymean, Ystd, mlpg_chunksize, segmented, segpool = _synthesis_ctx
+    CMP, fwav, normalised, mlpg_ignore, synargs, return_cmp, fcache = job
+
+    if normalised: CMP = denormalise(vocoder, CMP, Ymean, Ystd, mlpg_ignore=mlpg_ignore, mlpg_chunksize=mlpg_chunksize)
+    if segmented: wav = vocoder.synthesis_segmented(CMP, pool=segpool, **synargs)
+    else:         wav = vocoder.synthesis(CMP, **synargs)
+    sp.wavwrite(fwav, wav, vocoder.fs, norm_max=True, verbose=1)
+
+    if not fcache is None: copyfile(fwav, fcache)
+
+    return CMP if return_cmp else None
+
+def copyfile(fsrc, fdst):
+    '''
+    Copy fsrc as fdst, replacing fdst by rename.
+    The copy is atomic, so that concurrent runs never see a partial file,
+    and fdst never shares its content with fsrc, so that re-writing one doesn't modify the other.
+    '''
+    import shutil
+    ftmp = fdst+'.tmp{}'.format(os.getpid())
+    shutil.copyfile(fsrc, ftmp)
+    os.rename(ftmp, fdst)
+
+
 def makedirs(path):
     """Create a directory."""
     import errno
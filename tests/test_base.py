@@ -62,12 +62,52 @@ class TestBase(unittest.TestCase):
         vocoder_world = percivaltts.vocoders.VocoderWORLD(cfg.vocoder_fs, cfg.vocoder_shift, spec_size, aper_size=nm_size)
         print('vocoder_world={} featuressize={}'.format(vocoder_world, vocoder_world.featuressize()))
 
+        # The cached frequency warping matrices have to give the same results as the direct conversions
+        import numpy as np
+        sp = percivaltts.vocoders.sp
+        vocoder_pml.fwcache_dir = 'tests/test_made__base_fwcache'
+        FWSPEC = np.random.RandomState(123).randn(100, spec_size)
+        self.assertTrue(np.allclose(vocoder_pml.fwbnd2linbnd(FWSPEC, cfg.vocoder_fs, vocoder_pml.dftlen, smooth=True), sp.fwbnd2linbnd(FWSPEC, cfg.vocoder_fs, vocoder_pml.dftlen, smooth=True)))
+        LSPEC = sp.fwbnd2linbnd(FWSPEC, cfg.vocoder_fs, vocoder_pml.dftlen)
+        self.assertTrue(np.allclose(vocoder_pml.linbnd2fwbnd(LSPEC, cfg.vocoder_fs, vocoder_pml.dftlen, spec_size), sp.linbnd2fwbnd(LSPEC, cfg.vocoder_fs, vocoder_pml.dftlen, spec_size)))
+
+        # The in-process post-processing has to match SPTK's
+        # (tests/mcep_postproc_sptk.npz holds mel-cepstra of order 59 at 16kHz and their post-processing
+        # by the chain of mcep_postproc_sptk, computed by the SPTK routines through pysptk, in float32 between the tools)
+        from percivaltts.external.merlin import generate_pp
+        ref = np.load('tests/mcep_postproc_sptk.npz')
+        self.assertTrue(np.allclose(generate_pp.mcep_postproc_numpy(ref['mcep'].astype('float64'), int(ref['fs']), dftlen=int(ref['dftlen']), pf_coef=float(ref['pf_coef'])), ref['mceppp'], atol=1e-5))
+        # As SPTK's, it keeps the spectrum up to the order of the mel-cepstrum, and preserves its energy
+        SPEC = np.exp(LSPEC)
+        alpha = generate_pp.bark_alpha(cfg.vocoder_fs)
+        SPECTRUNC = generate_pp.mcep2spec_numpy(generate_pp.spec2mcep_numpy(SPEC, alpha, 256), alpha, vocoder_pml.dftlen)
+        self.assertTrue(np.allclose(generate_pp.spec_postproc_numpy(SPEC, cfg.vocoder_fs, pf_coef=1.0), SPECTRUNC))
+        SPECPP = generate_pp.spec_postproc_numpy(SPEC, cfg.vocoder_fs)
+        self.assertTrue(np.allclose(np.sum(SPECPP[:,1:-1]**2, axis=1), np.sum(SPECTRUNC[:,1:-1]**2, axis=1), rtol=1e-2))
+
+        # The energy of the frames has to be the one of the decompressed spectrum, whatever the compression
+        vocoder_mcep = percivaltts.vocoders.VocoderF0Spec('F0MCEP', cfg.vocoder_fs, cfg.vocoder_shift, spec_size, spec_type='mcep')
+        MCEP = generate_pp.spec2mcep_numpy(SPEC, alpha, spec_size-1)
+        CMP = np.hstack((np.zeros((MCEP.shape[0], 1)), MCEP))
+        self.assertTrue(np.allclose(vocoder_mcep.energy(CMP), 10*np.log10(np.mean(generate_pp.mcep2spec_numpy(MCEP, alpha, vocoder_mcep.dftlen)**2, axis=1))))
+        self.assertTrue(np.allclose(vocoder_pml.energy(np.hstack((np.zeros((FWSPEC.shape[0], 1)), FWSPEC))), 10*np.log10(np.mean(np.exp(2*FWSPEC), axis=1))))
+
         for fid in fids:
             print('Extracting features from: '+fid)
             vocoder_pml.analysisfid(fid, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_fw_path, 'noise':nm_path})
             vocoder_world.analysisfid(fid, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':cp+wav_dir+'_world_lf0/*.lf0', 'spec':cp+wav_dir+'_world_fwlspec/*.fwlspec', 'noise':cp+wav_dir+'_world_fwdbaper/*.fwdbaper', 'vuv':cp+wav_dir+'_world_vuv/*.vuv'})
             # pulsemodel.analysisf(wav_path.replace('*',fid), f0_min=cfg.vocoder_f0_min, f0_max=cfg.vocoder_f0_max, ff0=f0_path.replace('*',fid), f0_log=True,
             # fspec=spec_fw_path.replace('*',fid), spec_nbfwbnds=spec_size, fnm=nm_path.replace('*',fid), nm_nbfwbnds=nm_size, verbose=1)
+        # Everything is now up to date
+        self.assertEqual(vocoder_pml.analysisfids(fids, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_fw_path, 'noise':nm_path}, nbproc=2), [])
+        vocoder_pml.analysisfids(fids[:2], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_fw_path, 'noise':nm_path}, nbproc=2, force=True, ftimings='tests/test_made__base_analysis_timings.txt')
+
+        import percivaltts.spawnpool
+        pool = percivaltts.spawnpool.SpawnPool(2)
+        self.assertEqual(pool.map(abs, [-1, 2, -3, 4, -5]), [1, 2, 3, 4, 5])
+        self.assertRaises(ValueError, pool.apply_async(int, ('x',)).get)
+        pool.close()
+        pool.join()
 
 
         import percivaltts.compose
@@ -48,6 +48,11 @@ class TestSmoke(unittest.TestCase):
 
         percivaltts.print_sysinfo()
 
+        import percivaltts.trials
+        self.assertEqual(percivaltts.trials.cpusets(2, nbcpus=4), [[0, 1], [2, 3]])
+        self.assertEqual(percivaltts.trials.cpusets(3, nbcpus=2), [[0], [1], [0]])
+        self.assertEqual(percivaltts.trials.trialfile('model.h5', 3), 'model-trial3.h5')
+
         # percivaltts.print_sysinfo_theano() TODO
         # percivaltts.log_plot_costs(costs_tra, costs_val, worst_val, fname, epochs_modelssaved, costs_critic=[]) TODO
         # percivaltts.log_plot_costs(costs, worst_val, fname, epochs_modelssaved) TODO
@@ -105,6 +110,8 @@ class TestSmoke(unittest.TestCase):
         X_train, Y_train, W_train = percivaltts.data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift')
         X_train, Y_train, W_train = percivaltts.data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift', cropmode='begendbigger')
         X_train, Y_train, W_train = percivaltts.data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift', cropmode='all')
+        X_train, Y_train, W_train, M_train = percivaltts.data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='padright', outmask=True)
+        self.assertEqual(M_train.shape, Y_train.shape[:2])
 
         worst_val = percivaltts.data.cost_0pred_rmse(Ys)
         print('worst_val={}'.format(worst_val))
@@ -166,6 +173,27 @@ class TestSmoke(unittest.TestCase):
 
         percivaltts.compose.create_weights_spec(spec_path+':(-1,'+str(spec_size)+')', fids, 'tests/test_made__smoke_compose_compose2_w1/*.w', spec_type='fwlspec', thresh=-32)
 
+    def test_mlpg(self):
+        from percivaltts.external.merlin.mlpg_fast import MLParameterGenerationFast
+
+        rng = np.random.RandomState(123)
+        nbframes = 777
+        static_dim = 3
+        stds = np.hstack((0.2*np.ones(static_dim), 0.02*np.ones(static_dim), 0.01*np.ones(static_dim)))
+        traj = np.cumsum(rng.randn(nbframes, static_dim), axis=0)*0.05
+        CMP = np.hstack((traj, np.gradient(traj, axis=0), np.zeros((nbframes, static_dim))))
+        CMP += rng.randn(nbframes, 3*static_dim)*stds
+
+        mlpg_algo = MLParameterGenerationFast()
+        gen_full = mlpg_algo.generation(CMP, np.tile(stds**2, (nbframes, 1)), static_dim)
+        gen_chunked = mlpg_algo.generation_chunked(CMP, stds**2, static_dim, chunksize=100)
+        self.assertEqual(gen_chunked.shape, gen_full.shape)
+        self.assertTrue(np.max(np.abs(gen_chunked-gen_full)) < 0.01*stds[0])
+
+        blocks = [CMP[n:n+37,] for n in xrange(0, nbframes, 37)]
+        gen_stream = np.vstack(list(mlpg_algo.generation_stream(blocks, stds**2, static_dim, chunksize=64)))
+        self.assertTrue(np.max(np.abs(gen_stream-gen_full)) < 0.01*stds[0])
+
 
 if __name__ == '__main__':
     unittest.main()
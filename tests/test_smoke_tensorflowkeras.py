@@ -1,5 +1,7 @@
 # http://pymbook.readthedocs.io/en/latest/testing.html
 
+import os
+
 from percivaltts import *
 
 import unittest
@@ -58,9 +60,12 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         cfg.train_nbtrials = 1        # Just run one training only
         cfg.train_hypers = []
         cfg.cropmode = 'begend'
+        cfg.train_telemetry = 'jsonl'
         optigan = percivaltts.optimizertts.OptimizerTTS(cfg,model)
 
         optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-telemetry.jsonl'))
+        cfg.train_telemetry = None
         model.save('tests/test_made__smoke_tfkeras_model/smokymodelparams.pkl')
 
         # Generate waveforms
@@ -77,6 +82,10 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         cfg_loaded, extras_loaded = model.load('tests/test_made__smoke_tfkeras_model/smokymodelparams.pkl')
         self.assertEqual(cfg, cfg_loaded)
         self.assertEqual({'cost_val':cost_val}, extras_loaded)
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model/smokymodelparams.pkl.pckpt'))
+        import percivaltts.checkpoint
+        tensors, _, _ = percivaltts.checkpoint.load('tests/test_made__smoke_tfkeras_model/smokymodelparams.pkl.pckpt', mmap=False)
+        for w, wl in zip(model.kerasmodel.get_weights(), percivaltts.checkpoint.group(tensors, 'model')): self.assertTrue(np.array_equal(w, wl))
 
         # # Save training state TODO Doesn't work anymore for GAN-based training, should use TensorFlow checkpoints instead
         # # import optimizertts
@@ -107,6 +116,51 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         cfg.train_nbtrials = 5        # Just run one training only
         optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
 
+        # Successive halving: 3 trials up to epoch 2, then only the best one up to the end
+        optigan.cfg.train_nbtrials = 3
+        optigan.cfg.train_halving_rungs = [2]
+        optigan.cfg.train_max_nbepochs = 4
+        optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokyhalving.pkl', cont=False)
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_train/smokyhalving.pkl.pckpt'))
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_train/smokyhalving-trials.txt'))
+        # The rungs are compared to the number of epochs scaled wrt the frames seen per epoch
+        optigan.cfg.train_batch_lengthmax = 100
+        self.assertEqual(optigan.nbepochs(8*200, 8), (2*optigan.cfg.train_min_nbepochs, 8))
+        optigan.cfg.train_batch_lengthmax = None
+        self.assertEqual(optigan.nbepochs(8*200, 8), (optigan.cfg.train_min_nbepochs, 4))
+        optigan.cfg.train_nbtrials = 1
+        optigan.cfg.train_halving_rungs = []
+        optigan.cfg.train_max_nbepochs = 5
+
+        # Parallel trials: 2 worker processes, which build their optimizer with the builder module below
+        fbuilder = 'tests/test_made__smoke_tfkeras_model_train/smokybuilder.py'
+        with open(fbuilder, 'w') as f:
+            f.write('from percivaltts import *\n'
+                    'import vocoders\n'
+                    'import modeltts_common\n'
+                    'import optimizertts\n'
+                    'def build_optimizer():\n'
+                    '    cfg = configuration()\n'
+                    '    cfg.arch_hiddenwidth = {}\n'
+                    '    vocoder = vocoders.VocoderPML({}, {}, {}, {})\n'
+                    '    model = modeltts_common.Generic({}, vocoder, layertypes=[\'FC\', \'FC\', \'FC\'], cfgarch=cfg)\n'
+                    '    return optimizertts.OptimizerTTS(cfg, model)\n'.format(cfg.arch_hiddenwidth, cfg.vocoder_fs, cfg.vocoder_shift, spec_size, nm_size, lab_size))
+        optigan.cfg.train_nbtrials = 2
+        optigan.cfg.train_trials_parallel = 2
+        optigan.cfg.train_max_nbepochs = 2
+        optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokyparallel.pkl', cont=False, builder=(os.path.realpath(fbuilder), 'build_optimizer'))
+        import cPickle
+        import filecmp
+        trialsrets = []
+        for triali in [1, 2]:
+            with open('tests/test_made__smoke_tfkeras_model_train/smokyparallel-trial{}-result.pkl'.format(triali), 'rb') as f: result = cPickle.load(f)
+            self.assertIsNone(result['error'])
+            trialsrets.append((result['train_rets']['best_val'], 'tests/test_made__smoke_tfkeras_model_train/smokyparallel-trial{}.pkl.pckpt'.format(triali)))
+        self.assertTrue(filecmp.cmp(min(trialsrets)[1], 'tests/test_made__smoke_tfkeras_model_train/smokyparallel.pkl.pckpt', shallow=False))    # The best trial ends up in params_savefile
+        optigan.cfg.train_nbtrials = 1
+        optigan.cfg.train_trials_parallel = 1
+        optigan.cfg.train_max_nbepochs = 5
+
         # Go back to single trial for the next tests
         cfg.train_nbtrials = 1
         cfg.train_hypers = []
@@ -116,15 +170,138 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         cfg.newdummyattribute = -1
         delattr(cfg, 'dummyattribute')
 
-        # Try to continue the last training
+        # Try to continue the last training, keeping the training states of the last 2 epochs
+        # (cfg was merged in optigan.cfg at construction, so the optimizer's copy has to be changed)
+        # The previous training ran 5 epochs at most, so at least 2 more epochs are run without early stop
+        optigan.cfg.train_max_nbepochs = 7
+        optigan.cfg.train_cancel_nodecepochs = 100
+        optigan.cfg.train_checkpoint_keep = 2
+        optigan.cfg.train_log_plot_every = 2
+        optigan.cfg.train_checkpoint_every_batches = 1     # Save the position in each epoch too
         optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=True)
+        import glob
+        self.assertEqual(len(glob.glob('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-trainingstate-E*.h5.pckpt')), 2)
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-trainingstate-last.h5.pckpt'))
+        optigan.cfg.train_max_nbepochs = 5
+        optigan.cfg.train_cancel_nodecepochs = cfg.train_cancel_nodecepochs
+        optigan.cfg.train_checkpoint_keep = 0
+        optigan.cfg.train_log_plot_every = 1
+        optigan.cfg.train_checkpoint_every_batches = None
+        self.assertTrue(len(glob.glob('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-fig_costs_*.svg'))>0)  # Written by the plotting process
+
+        # Interrupt the 2nd epoch and resume it from its last saved batch, twice
+        # (the training set has 4 batches, and the position in the epoch is saved after each one)
+        trainedbatches = []
+        interruptat = [7]   # Number of the train_on_batch call that is interrupted
+        train_on_batch = optigan.train_on_batch
+        def train_on_batch_interrupted(batchid, X_trab, Y_trab):
+            if len(trainedbatches)+1==interruptat[0]: raise KeyboardInterrupt
+            trainedbatches.append(batchid)
+            return train_on_batch(batchid, X_trab, Y_trab)
+        optigan.train_on_batch = train_on_batch_interrupted
+        optigan.cfg.train_max_nbepochs = 2
+        optigan.cfg.train_checkpoint_every_batches = 1
+        fstatelast = 'tests/test_made__smoke_tfkeras_model_train/smokyresume-trainingstate-last.h5'+percivaltts.checkpoint.EXT
+        optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokyresume.pkl', cont=False)
+        self.assertEqual(trainedbatches, [0, 1, 2, 3, 0, 1])
+        _, _, (_, extras1, _) = percivaltts.checkpoint.load(fstatelast)
+        self.assertEqual(extras1['epoch'], 1)
+        self.assertEqual(extras1['batch']['batchid'], 2)
+        trainedbatches[:] = []
+        interruptat[0] = 2
+        optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokyresume.pkl', cont=True)
+        self.assertEqual(trainedbatches, [2])  # Continued from the batch following the saved one
+        _, _, (_, extras2, _) = percivaltts.checkpoint.load(fstatelast)
+        self.assertEqual(extras2['batch']['batchid'], 3)
+        self.assertTrue(np.array_equal(extras2['batch']['rndidx'], extras1['batch']['rndidx']))   # With the same batches
+        self.assertEqual(len(extras2['batch']['costs_tra_batches']), 3)
+        trainedbatches[:] = []
+        interruptat[0] = None
+        optigan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokyresume.pkl', cont=True)
+        self.assertEqual(trainedbatches, [3])
+        _, _, (_, extras3, _) = percivaltts.checkpoint.load(fstatelast)
+        self.assertEqual(extras3['epoch'], 2)
+        self.assertFalse('batch' in extras3)
+        del optigan.train_on_batch
+        optigan.cfg.train_max_nbepochs = 5
+        optigan.cfg.train_checkpoint_every_batches = None
         model.save('tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl')
 
         model.generate_cmp(cfg.indir, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-cmp', fid_lst_val)
 
-        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd', do_objmeas=True, do_resynth=True)
-        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd-pp_spec_extrapfreq', do_objmeas=True, do_resynth=True, pp_spec_extrapfreq=8000)
+        resynth_cachedir = 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-resynth-cache'
+        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd', do_objmeas=True, do_resynth=True, resynth_cachedir=resynth_cachedir)
+        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd-pp_spec_extrapfreq', do_objmeas=True, do_resynth=True, pp_spec_extrapfreq=8000, resynth_cachedir=resynth_cachedir)
         model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd-pp_spec_pf_coef', do_objmeas=True, do_resynth=True, pp_spec_pf_coef=1.2)
+        fcaches = [os.path.join(resynth_cachedir, f) for f in os.listdir(resynth_cachedir)]
+        self.assertTrue(len(fcaches)>=len(fid_lst))   # The re-synthesis are cached
+        for fid in fid_lst:  # The re-synthesis taken from the cache are copies, not links to the cache entries
+            fresynth = 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams-snd-pp_spec_extrapfreq-resynth/'+fid+'.wav'
+            self.assertFalse(any([os.path.samefile(fresynth, fcache) for fcache in fcaches]))
+
+        # Inference server on localhost
+        import urllib2, json
+        import percivaltts.server
+        import percivaltts.data
+        server = percivaltts.server.InferenceServer(model, cfg.outdir, inpath=cfg.indir, labquestions='percivaltts/external/merlin/questions-radio_dnn_416.hed', batch_size=2)
+        server.start()
+        X = percivaltts.data.load(cfg.indir, fid_lst[:1])[0]
+        CMP = np.frombuffer(urllib2.urlopen('http://{}:{}/cmp'.format(server.host, server.port), X.astype('float32').tostring()).read(), dtype='float32').reshape((-1, vocoder.featuressize()))
+        self.assertTrue(np.allclose(CMP, server.synthesis_cmp(X), atol=1e-5))
+        wavbytes = urllib2.urlopen('http://{}:{}/wav'.format(server.host, server.port), X.astype('float32').tostring()).read()
+        self.assertEqual(wavbytes[:4], 'RIFF')
+        flab = cptest+'label_state_align/'+fid_lst[0]+'.lab'
+        wavbytes = urllib2.urlopen('http://{}:{}/lab'.format(server.host, server.port), open(flab).read()).read()
+        self.assertEqual(wavbytes[:4], 'RIFF')
+        metrics = json.loads(urllib2.urlopen('http://{}:{}/metrics'.format(server.host, server.port)).read())
+        self.assertEqual(metrics['requests'], 3)
+        server.stop()
+
+        # Length buckets
+        import percivaltts.modeltts
+        CMP = model.predict(X[np.newaxis,])
+        model.set_predict_buckets(percivaltts.modeltts.length_buckets(X.shape[0]//2, minlen=X.shape[0]//4))
+        self.assertTrue(np.allclose(model.predict(X[np.newaxis,]), CMP, atol=1e-5))   # Frame-wise model, so unaffected by the padding
+        model.set_predict_buckets(None)
+
+        # Chunked prediction
+        self.assertEqual(model.receptive_field(), 1)
+        self.assertTrue(np.allclose(model.predict_chunked(X, chunksize=X.shape[0]//3, overlap=10), CMP[0], atol=1e-5))
+
+        # Int8 export
+        import percivaltts.modeltts
+        import percivaltts.networktts
+        report = model.export_int8('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-int8', cfg.indir, fid_lst[:2], outpath=cfg.outdir, activations=True, tflite_length=100)
+        self.assertTrue(report['size_int8']<report['size_float32'])
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-int8.tflite'))
+        self.assertTrue(report['speedup']>1.0)  # The TFLite integer kernels are faster than the float32 model
+        self.assertTrue(all([np.isfinite(report['objmeasures_int8'][key]) for key in report['objmeasures_int8']]))
+        modelq = percivaltts.modeltts.ModelTTS(lab_size, vocoder)
+        modelq.load('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-int8')
+        self.assertFalse(modelq.tflite is None)
+        CMPq = modelq.predict(X[np.newaxis,])
+        self.assertEqual(CMPq.shape, CMP.shape)
+        nbfakequant = len([layer for layer in modelq.kerasmodel.layers if isinstance(layer, percivaltts.networktts.FakeQuant)])
+        self.assertTrue(nbfakequant>0)
+        modelq.load('tests/test_made__smoke_tfkeras_model_train/smokymodelparams-int8')  # Reloading doesn't quantise the activations twice
+        self.assertEqual(len([layer for layer in modelq.kerasmodel.layers if isinstance(layer, percivaltts.networktts.FakeQuant)]), nbfakequant)
+        self.assertTrue(np.allclose(modelq.predict(X[np.newaxis,]), CMPq, atol=1e-5))
+
+        # Streaming synthesis
+        wavs = []
+        for wav, stats in model.generate_wav_stream(X, cfg.outdir, chunksize=X.shape[0]//3, seglen=0.2):
+            print('    chunk of {} samples: {}'.format(len(wav), stats))
+            wavs.append(wav)
+        self.assertTrue(len(wavs)>1)
+
+        # In-memory synthesis from labels
+        import percivaltts.inference
+        synthesizer = percivaltts.inference.Synthesizer(model, cfg.indir, cfg.outdir, 'percivaltts/external/merlin/questions-radio_dnn_416.hed')
+        self.assertTrue(np.allclose(synthesizer.contexts(fpath=flab), X, atol=1e-5))
+        self.assertTrue(np.allclose(synthesizer.contexts(open(flab).read().splitlines()), X, atol=1e-5))
+        self.assertRaises(ValueError, synthesizer.contexts, flab)   # A path is not taken as label content
+        wav, timings = synthesizer.synthesis(fpath=flab)
+        print('In-memory synthesis timings: {}'.format(timings))
 
         # Test MLPG
         vocoder = percivaltts.vocoders.VocoderPML(cfg.vocoder_fs, cfg.vocoder_shift, spec_size, nm_size, mlpg_wins=[[-0.5, 0.0, 0.5], [1.0, -2.0, 1.0]])
@@ -135,6 +312,43 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         optiganwdeltas.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas.pkl', cont=False)
         modelwdeltas.save('tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas.pkl')
         modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas-snd', do_objmeas=True, do_resynth=True)
+        modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas-nbproc-snd', do_objmeas=True, do_resynth=True, nbproc=2)
+        modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas-segmented-snd', do_objmeas=True, do_resynth=False, nbproc=2, syn_segmented=True)
+        # The batched prediction has to match the prediction utterance by utterance
+        Xs = percivaltts.data.load(cfg.indir, fid_lst)
+        for X, Y in zip(Xs, modelwdeltas.predict_list(Xs, batch_size=3)):
+            self.assertTrue(np.allclose(Y, modelwdeltas.predict(X[np.newaxis,])[0,], atol=1e-5))
+        modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_wdeltas-mlpgingraph-snd', do_objmeas=True, do_resynth=False, mlpg_ingraph=True, batch_size=2)
+        # In-graph MLPG has to match the NumPy one
+        import percivaltts.data
+        from percivaltts.external.merlin.mlpg_fast import MLParameterGenerationFast
+        Ymean = np.fromfile(os.path.dirname(cfg.outdir)+'/mean4norm.dat', dtype='float32')
+        Ystd = np.fromfile(os.path.dirname(cfg.outdir)+'/std4norm.dat', dtype='float32')
+        X_test = percivaltts.data.load(cfg.indir, fid_lst)
+        CMPs = modelwdeltas.predict_static(X_test, Ymean, Ystd, batch_size=2)
+        for vi in xrange(len(X_test)):
+            CMP = modelwdeltas.predict(np.reshape(X_test[vi],[1]+[s for s in X_test[vi].shape]))[0,]
+            CMP = CMP*Ystd + Ymean
+            CMP = MLParameterGenerationFast().generation(CMP, np.tile(Ystd**2,(CMP.shape[0],1)), vocoder.featuressizeraw())
+            self.assertTrue(np.allclose(CMPs[vi], CMP, atol=1e-3))
+        # The in-graph MLPG has to follow a change of the stats
+        Ymean2 = Ymean+0.1
+        CMPs2 = modelwdeltas.predict_static(X_test, Ymean2, Ystd, batch_size=2)
+        CMP = modelwdeltas.predict(np.reshape(X_test[0],[1]+[s for s in X_test[0].shape]))[0,]
+        CMP = CMP*Ystd + Ymean2
+        CMP = MLParameterGenerationFast().generation(CMP, np.tile(Ystd**2,(CMP.shape[0],1)), vocoder.featuressizeraw())
+        self.assertTrue(np.allclose(CMPs2[0], CMP, atol=1e-3))
+        # The segmented synthesis has to match the synthesis of the whole utterance (up to the noise of PML)
+        import percivaltts.modeltts
+        CMP = percivaltts.modeltts.denormalise(vocoder, percivaltts.data.load(cfg.outdir, fid_lst[:1])[0], Ymean, Ystd, mlpg_ignore=True)
+        self.assertTrue(len(vocoder.synthesis_segments(CMP, seglen=0.3))>=2)   # Forces multiple segments
+        wavwhole = vocoder.synthesis(CMP)
+        wavseg = vocoder.synthesis_segmented(CMP, seglen=0.3)
+        hop = int(np.round(vocoder.shift*vocoder.fs))
+        self.assertTrue(abs(len(wavseg)-len(wavwhole))<=hop)
+        nbframes = min(len(wavwhole), len(wavseg))//hop
+        def frameenergies(wav): return 10*np.log10(np.mean(np.reshape(wav[:nbframes*hop], (nbframes, hop))**2, axis=1)+1e-12)
+        self.assertTrue(np.mean(np.abs(frameenergies(wavseg)-frameenergies(wavwhole)))<3.0)
         # Restore the non-MLPG features
         cfg.outdir = cptest+'wav_cmp_lf0_fwlspec65_fwnm17_bndnmnoscale/*.cmp:(-1,83)'
 
@@ -176,6 +390,23 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         optilse = percivaltts.optimizertts.OptimizerTTS(cfg, model)
         optilse.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
 
+        # The length buckets mustn't change the outputs (they are disabled for the models seeing the future, e.g. BLSTM)
+        import percivaltts.data
+        import percivaltts.modeltts
+        Xval = percivaltts.data.load(cfg.indir, fid_lst_val)[0][np.newaxis,]
+        def check_buckets(model, enabled):
+            CMP = model.predict(Xval)
+            latencies = model.set_predict_buckets(percivaltts.modeltts.length_buckets(Xval.shape[1]//2, minlen=Xval.shape[1]//4))
+            self.assertEqual(model.predict_buckets is None, not enabled)
+            self.assertTrue(np.allclose(model.predict(Xval), CMP, atol=1e-5))
+            model.set_predict_buckets(None)
+            return latencies
+        check_buckets(model, False)
+        # The chunks are not padded, so that their outputs are the ones of the whole prediction (given enough margin)
+        def check_chunked(model, margin=None):
+            self.assertTrue(np.allclose(model.predict_chunked(Xval[0], chunksize=Xval.shape[1]//3, overlap=10, margin=margin, batch_size=2), model.predict(Xval)[0], atol=1e-4))
+        check_chunked(model, margin=Xval.shape[1])   # The BLSTM sees the whole input
+
         # model = percivaltts.modeltts_common.Generic(lab_size, vocoder, layertypes=['RawBLSTM', 'RawBLSTM', 'RawBLSTM'], cfgarch=cfg)
         # optilse = percivaltts.optimizertts.OptimizerTTS(cfg, model)
         # optilse.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
@@ -191,6 +422,9 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         model = percivaltts.modeltts_common.DCNNF0SpecNoiseFeatures(lab_size, vocoder, cfg)
         optilse = percivaltts.optimizertts.OptimizerTTS(cfg, model)
         optilse.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
+        check_buckets(model, False)
+        self.assertTrue(model.receptive_field()>1)
+        check_chunked(model)    # The margin is the receptive field
         # model.generate_wav('test/test_made__smoke_tfkeras_model_train/smokymodelparams-snd', fid_lst, cfg, do_objmeas=True, do_resynth=True, indicestosynth=None, spec_comp='fwlspec', spec_size=spec_size, nm_size=nm_size)
 
         import percivaltts.optimizertts_wgan
@@ -202,6 +436,70 @@ class TestSmokeTensorflowKeras(unittest.TestCase):
         optilse = percivaltts.optimizertts_wgan.OptimizerTTSWGAN(cfg, model, errtype='WGAN', critic=percivaltts.networks_critic.Critic(vocoder, lab_size, cfg))
         optilse.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams.pkl', cont=False)
 
+        # Validate on a single file at the odd epochs before the models can be saved
+        optisub = percivaltts.optimizertts_wgan.OptimizerTTSWGAN(cfg, model, errtype='WGAN', critic=percivaltts.networks_critic.Critic(vocoder, lab_size, cfg))
+        optisub.cfg.train_min_nbepochs = 3
+        optisub.cfg.train_validation_every = 2
+        optisub.cfg.train_validation_subset = 1
+        optisub.cfg.train_validation_full_beforemin = 0
+        optisub.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokymodelparams_valsubset.pkl', cont=False)
+        self.assertEqual(optisub.validation_full[:2], [False, True])
+        # The subset costs are kept apart from the full validation costs
+        _, extras, _ = optisub.loadTrainingState('tests/test_made__smoke_tfkeras_model_train/smokymodelparams_valsubset-trainingstate-last.h5')
+        nbfull = np.sum(extras['validation_full'])
+        self.assertEqual(len(extras['costs']['model_rmse_validation']), nbfull)
+        self.assertEqual(len(extras['costs']['critic_validation']), nbfull)
+        self.assertEqual(len(extras['costs']['model_rmse_validation_subset']), len(extras['validation_full'])-nbfull)
+        self.assertEqual(len(extras['costs']['critic_validation_ltm']), len(extras['validation_full']))
+
+        # Distillation of the DCNN model in a small FC model
+        student = percivaltts.modeltts_common.Generic(lab_size, vocoder, layertypes=['FC'], cfgarch=cfg)
+        optistudent = percivaltts.optimizertts.OptimizerTTS(cfg, student)
+        report = optistudent.distill(model, cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokystudent.pkl')
+        self.assertTrue(len(os.listdir('tests/test_made__smoke_tfkeras_model_train/smokystudent-teacher'))>len(fid_lst_tra))    # Cached teacher's outputs
+        self.assertTrue(report['params_student']<report['params_teacher'])
+
+        # Structured pruning of the student, then fine-tuning
+        import percivaltts.data
+        report = student.prune(0.5, mode='activation', Xs=percivaltts.data.load(cfg.indir, fid_lst_val))
+        self.assertTrue(report['flops_after']<report['flops_before'])
+        optistudent = percivaltts.optimizertts.OptimizerTTS(cfg, student)
+        optistudent.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_train/smokystudent-pruned.pkl', cont=False)
+        studentloaded = percivaltts.modeltts_common.Generic(lab_size, vocoder, layertypes=['FC'], cfgarch=cfg)
+        studentloaded.load('tests/test_made__smoke_tfkeras_model_train/smokystudent-pruned.pkl')   # Rebuilt with the pruned architecture
+        self.assertEqual(studentloaded.count_params(), student.count_params())
+
+        # The causal variant without look-ahead can use the length buckets
+        cfg.arch_lookahead = 0
+        model = percivaltts.modeltts_common.DCNNF0SpecNoiseFeaturesCausal(lab_size, vocoder, cfg)
+        latencies = check_buckets(model, True)
+        self.assertTrue(np.mean([first for first, _ in latencies.values()])>np.mean([steady for _, steady in latencies.values()]))   # The first call of a new length is slower
+
+    def test_model_causal(self):
+        makedirs('tests/test_made__smoke_tfkeras_model_causal')
+
+        import copy
+        import percivaltts.vocoders
+        import percivaltts.modeltts_common
+        import percivaltts.optimizertts_wgan
+        import percivaltts.networks_critic
+        vocoder = percivaltts.vocoders.VocoderPML(cfg.vocoder_fs, cfg.vocoder_shift, spec_size, nm_size)
+
+        # The causal variant, with a bounded look-ahead
+        cfgcausal = copy.copy(cfg)  # So that the other tests keep the non-causal configuration
+        cfgcausal.arch_lookahead = 2
+        model = percivaltts.modeltts_common.DCNNF0SpecNoiseFeaturesCausal(lab_size, vocoder, cfgcausal)
+        self.assertEqual(model.lookahead(), 2)
+        X = np.random.randn(1, 50, lab_size).astype('float32')
+        Xf = X.copy()
+        Xf[:,30:,] += 1.0  # Modify the future
+        self.assertTrue(np.allclose(model.predict(X)[:,:30-cfgcausal.arch_lookahead,], model.predict(Xf)[:,:30-cfgcausal.arch_lookahead,], atol=1e-5))
+
+        # Trained against the causal critic
+        optiwgan = percivaltts.optimizertts_wgan.OptimizerTTSWGAN(cfgcausal, model, errtype='WLSWGAN', critic=percivaltts.networks_critic.Critic(vocoder, lab_size, cfgcausal, causal=True))
+        optiwgan.train(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, 'tests/test_made__smoke_tfkeras_model_causal/smokymodelparams.pkl', cont=False)
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_tfkeras_model_causal/smokymodelparams.pkl.pckpt'))
+
 
     # def test_backend_tensorflowkeras(self): # TODO
     #     import percivaltts.backend_tensorflow